@@ -1,16 +1,48 @@
 import configparser
 from datetime import datetime
+from functools import wraps
 from os import getenv
+import io
 import json
 import logging
 import logging.config
-
-from flask import Flask, request, render_template
-
-from db_client import DbClient as TransitClient
+import time
+
+from flask import (
+    Flask,
+    Response,
+    g,
+    redirect,
+    request,
+    render_template,
+    stream_with_context,
+    url_for,
+)
+
+from blind_index import BLIND_INDEX_COLUMNS
+from bulk_import import BULK_TRANSACTION_SIZE, import_customers, read_records
+from db_client import DbClient as TransitClient, TRANSIT_BATCH_SIZE, select_fields
+from vault_http import VAULT_POOL_SIZE, VAULT_TIMEOUT
 from db_client_transform import DbClient as TransformClient
+from db_retry import RECONNECT_ATTEMPTS, RECONNECT_BASE_DELAY, RECONNECT_MAX_DELAY
+from envelope import DATA_KEY_TTL
+from export import EXPORT_CHUNK_SIZE, CustomerExport
+from group_commit import GROUP_COMMIT_DELAY, GROUP_COMMIT_QUEUE_SIZE, GROUP_COMMIT_SIZE
+from lease import LeaseManager
+from metrics import CONTENT_TYPE, HTTP_REQUEST_DURATION, HTTP_REQUESTS, REGISTRY
+from migrations import parse_create_date
+from replicas import (
+    READ_PRIMARY,
+    REPLICA_POOL_SIZE,
+    REPLICA_RETRY_AFTER,
+    REPLICA_STICKINESS,
+    parse_replicas,
+)
+from response_cache import RESPONSE_CACHE_TTL, ResponseCache
+from rewrap import RewrapJob
 
 dbc: TransitClient = None
+response_cache: ResponseCache = None
 
 log_level = {"CRITICAL": 50, "ERROR": 40, "WARN": 30, "INFO": 20, "DEBUG": 10}
 
@@ -18,6 +50,52 @@ logger = logging.getLogger("app")
 
 app = Flask(__name__)
 app.config["TEMPLATES_AUTO_RELOAD"] = True
+app.config["MAX_PAGE_SIZE"] = 1000
+app.config["BULK_TRANSACTION_SIZE"] = BULK_TRANSACTION_SIZE
+app.config["EXPORT_CHUNK_SIZE"] = EXPORT_CHUNK_SIZE
+app.config["REPLICA_STICKINESS"] = REPLICA_STICKINESS
+
+STICKY_COOKIE = "read_primary_until"
+
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+
+# Read-your-writes with replicas: after a write the client is sent to the
+# primary for ReplicaStickiness seconds through a cookie, so it also sees its
+# own writes when the next request is served by another worker.
+@app.before_request
+def route_reads():
+    sticky_until = request.cookies.get(STICKY_COOKIE, type=float)
+    READ_PRIMARY.set(sticky_until is not None and sticky_until > time.time())
+
+
+@app.after_request
+def stick_to_primary(response):
+    stickiness = app.config["REPLICA_STICKINESS"]
+    if (
+        stickiness > 0
+        and dbc is not None
+        and dbc.replicas is not None
+        and request.method not in ("GET", "HEAD")
+        and response.status_code < 400
+    ):
+        response.set_cookie(
+            STICKY_COOKIE, str(time.time() + stickiness), max_age=stickiness
+        )
+    return response
+
+
+@app.after_request
+def record_request(response):
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    HTTP_REQUESTS.inc(route, request.method, response.status_code)
+    HTTP_REQUEST_DURATION.observe(
+        time.perf_counter() - g.started, route, request.method
+    )
+    return response
 
 
 def read_config() -> configparser.ConfigParser:
@@ -40,14 +118,114 @@ def health():
     return "Healthy", 200
 
 
+# Serves a read route from the response cache. Responses carry an ETag of
+# the current data version, a matching If-None-Match is answered with 304
+# before the view runs, so neither MySQL nor Vault are queried.
+def cached_response(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        # reads on the primary after an own write bypass the cache, it may hold
+        # responses read from a lagging replica
+        if response_cache is None or READ_PRIMARY.get():
+            return view(*args, **kwargs)
+        key = f"{request.full_path}|{request.headers.get('Accept', '')}"
+        version, last_modified = response_cache.version()
+        if response_cache.is_fresh(key, version, request.if_none_match):
+            response = Response(status=304)
+        else:
+            cached = response_cache.get(key, version)
+            if cached is None:
+                # fills read the primary, a lagging replica would store data
+                # older than the version the response is cached under
+                token = READ_PRIMARY.set(True)
+                try:
+                    response = app.make_response(view(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    # renders streamed responses into one body
+                    cached = (response.get_data(), response.mimetype)
+                finally:
+                    READ_PRIMARY.reset(token)
+                response_cache.put(key, version, cached)
+            response = Response(cached[0], mimetype=cached[1])
+        if version is not None:
+            response.set_etag(response_cache.etag(key, version))
+            response.last_modified = last_modified
+        # clients revalidate on every request, which costs a 304 at most
+        response.cache_control.no_cache = True
+        return response
+
+    return wrapper
+
+
+def stream_json_array(items):
+    yield "["
+    for i, item in enumerate(items):
+        yield ("," if i else "") + json.dumps(item)
+    yield "]"
+
+
+def stream_ndjson(items):
+    for item in items:
+        yield json.dumps(item) + "\n"
+
+
+# Returns the record fields of ?fields=first_name,last_name, or None for all
+# fields. Raises ValueError for unknown fields.
+def parse_fields(value):
+    return select_fields(value.split(",")) if value else None
+
+
+# Returns the datetime of a date such as 2020-01-01 or 2020-01-01T14:49:12,
+# or None without one. Raises ValueError for other values.
+def parse_date(value):
+    if not value:
+        return None
+    date = parse_create_date(value)
+    if date is None:
+        raise ValueError(f"invalid date: {value}")
+    return date
+
+
+# Pages through customers with ?after=<cust_no>&limit=<n>. The next page
+# starts after the customer_number of the last returned record. With
+# ?created_from= and/or ?created_before= only the customers created in that
+# range are listed, ordered by their creation time.
 @app.route("/customers", methods=["GET"])
+@cached_response
 def get_customers():
-    customers = dbc.get_customer_records()
-    logger.debug(f"Customers: {customers}")
-    return json.dumps(customers)
+    after = request.args.get("after", type=int)
+    limit = request.args.get("limit", default=50, type=int)
+    limit = max(0, min(limit, app.config["MAX_PAGE_SIZE"]))
+    try:
+        fields = parse_fields(request.args.get("fields"))
+        created_from = parse_date(request.args.get("created_from"))
+        created_before = parse_date(request.args.get("created_before"))
+    except ValueError as e:
+        return f"Error: {e}", 400
+    customers = dbc.iter_customer_records(
+        after=after,
+        limit=limit,
+        fields=fields,
+        created_from=created_from,
+        created_before=created_before,
+    )
+    if (
+        request.args.get("format") == "ndjson"
+        or request.accept_mimetypes.best == "application/x-ndjson"
+    ):
+        return Response(
+            stream_with_context(stream_ndjson(customers)),
+            mimetype="application/x-ndjson",
+        )
+    return Response(
+        stream_with_context(stream_json_array(customers)),
+        mimetype="application/json",
+    )
 
 
 @app.route("/customer", methods=["GET"])
+@cached_response
 def get_customer():
     cust_no = request.args.get("cust_no")
     if not cust_no:
@@ -55,45 +233,140 @@ def get_customer():
             "<html><body>Error: cust_no is a required argument for the customer endpoint.</body></html>",
             500,
         )
-    record = dbc.get_customer_record(cust_no)
+    try:
+        fields = parse_fields(request.args.get("fields"))
+    except ValueError as e:
+        return f"Error: {e}", 400
+    record = dbc.get_customer_record(cust_no, fields=fields)
     # logger.debug('Request: {}'.format(request))
     return json.dumps(record)
 
 
 @app.route("/customers", methods=["POST"])
 def create_customer():
-    logging.debug(f"Form Data: {dict(request.form)}")
     customer = dict(dict(request.form).items())
     for k, v in customer.items():
         if isinstance(v, list):
             customer[k] = v[0]
-    logging.debug(f"Customer: {customer}")
+    # the form holds the plaintext ssn and ccn, only field names are logged
+    logging.debug(f"Creating a customer with fields {sorted(customer)}")
     if "create_date" not in customer.keys():
         customer["create_date"] = datetime.now().isoformat()
     new_record = dbc.insert_customer_record(customer)
-    logging.debug(f"New Record: {new_record}")
+    logging.debug(f"Created customers {[r['customer_number'] for r in new_record]}")
     return json.dumps(new_record)
 
 
+# Finds customers by ?ssn= or ?ccn= through the blind index columns
+@app.route("/customers/lookup", methods=["GET"])
+def lookup_customers():
+    if dbc.blind_index is None:
+        return "Error: blind indexes are not enabled.", 404
+    fields = [f for f in BLIND_INDEX_COLUMNS if request.args.get(f)]
+    if len(fields) != 1:
+        return "Error: exactly one of ssn or ccn is required.", 400
+    return json.dumps(dbc.find_customers(fields[0], request.args[fields[0]]))
+
+
+# Accepts NDJSON or, with Content-Type text/csv, CSV with a header row
+@app.route("/customers/bulk", methods=["POST"])
+def bulk_create_customers():
+    fmt = "csv" if request.mimetype == "text/csv" else "ndjson"
+    stream = io.TextIOWrapper(request.stream, encoding="utf-8", newline="")
+    summary = import_customers(
+        dbc, read_records(stream, fmt), app.config["BULK_TRANSACTION_SIZE"]
+    )
+    return json.dumps(summary)
+
+
+# Streams all customers, or those of ?created_from= and ?created_before=, as
+# Parquet, Arrow IPC or CSV with ?format= in a chunked response. Chunks are
+# read, decrypted and sent one after another, see CustomerExport.
+@app.route("/customers/export", methods=["GET"])
+def export_customers():
+    try:
+        export = CustomerExport(
+            dbc,
+            fmt=request.args.get("format"),
+            fields=parse_fields(request.args.get("fields")),
+            chunk_size=app.config["EXPORT_CHUNK_SIZE"],
+            created_from=parse_date(request.args.get("created_from")),
+            created_before=parse_date(request.args.get("created_before")),
+        )
+    except ValueError as e:
+        return f"Error: {e}", 400
+    return Response(
+        stream_with_context(export.stream()),
+        mimetype=export.content_type,
+        headers={"Content-Disposition": f"attachment; filename=customers.{export.fmt}"},
+    )
+
+
 @app.route("/customers", methods=["PUT"])
 def update_customer():
-    logging.debug(f"Form Data: {dict(request.form)}")
     customer = dict(dict(request.form).items())
-    logging.debug(f"Customer: {customer}")
+    logging.debug(
+        f"Updating customer {customer.get('cust_no')} with fields {sorted(customer)}"
+    )
     new_record = dbc.update_customer_record(customer)
-    logging.debug(f"New Record: {new_record}")
+    logging.debug(f"Updated customers {[r['customer_number'] for r in new_record]}")
     return json.dumps(new_record)
 
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(REGISTRY.render(), mimetype=CONTENT_TYPE)
+
+
+@app.route("/cache", methods=["GET"])
+def cache_stats():
+    return json.dumps(dbc.cache_stats())
+
+
+@app.route("/cache/responses", methods=["GET"])
+def response_cache_stats():
+    return json.dumps(response_cache.stats() if response_cache else {})
+
+
+@app.route("/cache/flush", methods=["POST"])
+def cache_flush():
+    dbc.flush_cache()
+    if response_cache is not None:
+        response_cache.invalidate()
+    return json.dumps(dbc.cache_stats())
+
+
+# evicts the cached plaintexts of key versions below min_decryption_version,
+# for example after the Transit key was trimmed following a rewrap
+@app.route("/cache/retire", methods=["POST"])
+def cache_retire():
+    version = request.args.get("min_decryption_version", type=int)
+    if version is None:
+        return "Error: min_decryption_version is required.", 400
+    dbc.retire_key_versions(version)
+    return json.dumps(dbc.cache_stats())
+
+
+@app.route("/vault/stats", methods=["GET"])
+def vault_stats():
+    return json.dumps(dbc.vault_latency_stats())
+
+
 @app.route("/", methods=["GET"])
 def index():
     return render_template("index.html")
 
 
 @app.route("/records", methods=["GET"])
+@cached_response
 def get_records():
-    records = json.loads(get_customers())
-    return render_template("records.html", results=records)
+    records = dbc.get_customer_records()
+    return render_template(
+        "records.html",
+        results=records,
+        record_added=request.args.get("record_added"),
+        record_updated=request.args.get("record_updated"),
+    )
 
 
 @app.route("/dbview", methods=["GET"])
@@ -107,12 +380,16 @@ def add():
     return render_template("add.html")
 
 
+# Writes only return the written record, the full list is shown by
+# redirecting to /records unless ?show=record is requested.
 @app.route("/add", methods=["POST"])
 def add_submit():
     records = create_customer()
-    return render_template(
-        "records.html", results=json.loads(records), record_added=True
-    )
+    if request.args.get("show") == "record":
+        return render_template(
+            "records.html", results=json.loads(records), record_added=True
+        )
+    return redirect(url_for("get_records", record_added=1), code=303)
 
 
 @app.route("/update", methods=["GET"])
@@ -129,9 +406,11 @@ def update():
 @app.route("/update", methods=["POST"])
 def update_submit():
     records = update_customer()
-    return render_template(
-        "records.html", results=json.loads(records), record_updated=True
-    )
+    if request.args.get("show") == "record":
+        return render_template(
+            "records.html", results=json.loads(records), record_updated=True
+        )
+    return redirect(url_for("get_records", record_updated=1), code=303)
 
 
 def init_vault(conf) -> TransitClient:
@@ -158,6 +437,19 @@ def init_vault(conf) -> TransitClient:
         namespace=conf["VAULT"]["Namespace"],
         path=conf["VAULT"]["KeyPath"],
         key_name=conf["VAULT"]["KeyName"],
+        batch_size=conf.getint("VAULT", "BatchSize", fallback=TRANSIT_BATCH_SIZE),
+        timeout=conf.getint("VAULT", "Timeout", fallback=VAULT_TIMEOUT),
+        pool_size=conf.getint("VAULT", "PoolSize", fallback=VAULT_POOL_SIZE),
+        verify=conf.getboolean("VAULT", "TLSVerify", fallback=False),
+    )
+    client.init_workers(conf.getint("VAULT", "Workers", fallback=0))
+    if conf.getboolean("VAULT", "Envelope", fallback=False):
+        client.init_envelope(
+            ttl=conf.getint("VAULT", "DataKeyTTL", fallback=DATA_KEY_TTL)
+        )
+    client.init_cache(
+        max_size=conf.getint("VAULT", "CacheSize", fallback=0),
+        ttl=conf.getint("VAULT", "CacheTTL", fallback=300),
     )
 
     if (
@@ -170,6 +462,7 @@ def init_vault(conf) -> TransitClient:
             ssn_role=conf["VAULT"]["SSNRole"],
             transform_masking_path=conf["VAULT"]["TransformMaskingPath"],
             ccn_role=conf["VAULT"]["CCNRole"],
+            ccn_decode=conf.getboolean("VAULT", "CCNDecode", fallback=False),
         )
     if (
         conf.has_option("VAULT", "database_auth")
@@ -180,30 +473,136 @@ def init_vault(conf) -> TransitClient:
     return client
 
 
-if __name__ == "__main__":
-    logger.warning("In Main...")
-    app_config = read_config()
+def init_client(conf) -> TransitClient:
+    client = init_vault(conf)
+    client.init_reconnect(
+        attempts=conf.getint(
+            "DATABASE", "ReconnectAttempts", fallback=RECONNECT_ATTEMPTS
+        ),
+        base_delay=conf.getfloat(
+            "DATABASE", "ReconnectBaseDelay", fallback=RECONNECT_BASE_DELAY
+        ),
+        max_delay=conf.getfloat(
+            "DATABASE", "ReconnectMaxDelay", fallback=RECONNECT_MAX_DELAY
+        ),
+    )
+    if not client.is_initialized:
+        # credentials read from Vault by database_auth take precedence
+        if client.username is None:
+            logger.info("Using DB credentials from config.ini...")
+            client.username = conf["DATABASE"]["User"]
+            client.password = conf["DATABASE"]["Password"]
+        client.init_db(
+            uri=conf["DATABASE"]["Address"],
+            prt=conf["DATABASE"]["Port"],
+            uname=client.username,
+            pw=client.password,
+            db=conf["DATABASE"]["Database"],
+            pool_size=conf.getint("DATABASE", "PoolSize", fallback=0),
+            pool_max_lifetime=conf.getint("DATABASE", "PoolMaxLifetime", fallback=1800),
+            init_schema=conf.getboolean("DATABASE", "InitSchema", fallback=True),
+        )
+    client.init_replicas(
+        parse_replicas(
+            conf.get("DATABASE", "Replicas", fallback=""),
+            default_port=conf["DATABASE"]["Port"],
+        ),
+        pool_size=conf.getint(
+            "DATABASE", "ReplicaPoolSize", fallback=REPLICA_POOL_SIZE
+        ),
+        pool_max_lifetime=conf.getint("DATABASE", "PoolMaxLifetime", fallback=1800),
+        retry_after=conf.getint(
+            "DATABASE", "ReplicaRetryAfter", fallback=REPLICA_RETRY_AFTER
+        ),
+    )
+    if conf.getboolean("VAULT", "BlindIndex", fallback=False):
+        client.init_blind_index()
+    if conf.getboolean("DATABASE", "GroupCommit", fallback=False):
+        client.init_group_commit(
+            max_size=conf.getint(
+                "DATABASE", "GroupCommitSize", fallback=GROUP_COMMIT_SIZE
+            ),
+            max_delay=conf.getfloat(
+                "DATABASE", "GroupCommitDelay", fallback=GROUP_COMMIT_DELAY
+            ),
+            queue_size=conf.getint(
+                "DATABASE", "GroupCommitQueueSize", fallback=GROUP_COMMIT_QUEUE_SIZE
+            ),
+        )
+    if client.db_lease is not None and conf.getboolean(
+        "VAULT", "LeaseRenewal", fallback=True
+    ):
+        logger.info("Starting renewal of the database credential lease...")
+        LeaseManager.from_config(client, conf).start()
+    return client
 
+
+def init_logging(app_config):
     logging.basicConfig(
         level=log_level[app_config["DEFAULT"]["LogLevel"]],
         format="%(asctime)s - %(levelname)8s - %(name)9s - %(funcName)15s - %(message)s",
     )
 
+
+def init_response_cache(conf, client):
+    global response_cache  # pylint: disable=global-statement
+    max_size = conf.getint("DEFAULT", "ResponseCacheSize", fallback=0)
+    if max_size <= 0:
+        logger.info("Response cache is disabled")
+        return
+    response_cache = ResponseCache(
+        max_size,
+        ttl=conf.getint("DEFAULT", "ResponseCacheTTL", fallback=RESPONSE_CACHE_TTL),
+        shared_file=conf.get("DEFAULT", "ResponseCacheSharedFile", fallback=None)
+        or None,
+    )
+    client.add_write_listener(response_cache.invalidate)
+    logger.info(f"Caching up to {max_size} read responses")
+
+
+# Builds the client and applies the app settings. Servers with several
+# processes call this in every worker after the fork.
+def init_app(app_config) -> TransitClient:
+    global dbc  # pylint: disable=global-statement
+    dbc = init_client(app_config)
+    init_response_cache(app_config, dbc)
+    app.config["MAX_PAGE_SIZE"] = app_config.getint(
+        "DEFAULT", "MaxPageSize", fallback=app.config["MAX_PAGE_SIZE"]
+    )
+    app.config["BULK_TRANSACTION_SIZE"] = app_config.getint(
+        "DATABASE", "BulkTransactionSize", fallback=BULK_TRANSACTION_SIZE
+    )
+    app.config["EXPORT_CHUNK_SIZE"] = app_config.getint(
+        "DATABASE", "ExportChunkSize", fallback=EXPORT_CHUNK_SIZE
+    )
+    app.config["REPLICA_STICKINESS"] = app_config.getint(
+        "DATABASE", "ReplicaStickiness", fallback=REPLICA_STICKINESS
+    )
+    # every gunicorn worker starts the job, only the one which holds the
+    # job's named lock rewraps
+    if dbc.vault_client is not None and app_config.getboolean(
+        "VAULT", "RewrapBackground", fallback=False
+    ):
+        logger.info("Starting background rewrap of Transit ciphertexts...")
+        RewrapJob.from_config(dbc, app_config).start()
+    return dbc
+
+
+def main():
+    logger.warning("In Main...")
+    app_config = read_config()
+    init_logging(app_config)
+
     try:
-        dbc = init_vault(app_config)
-        if not dbc.is_initialized:
-            logger.info("Using DB credentials from config.ini...")
-            dbc.init_db(
-                uri=app_config["DATABASE"]["Address"],
-                prt=app_config["DATABASE"]["Port"],
-                uname=app_config["DATABASE"]["User"],
-                pw=app_config["DATABASE"]["Password"],
-                db=app_config["DATABASE"]["Database"],
-            )
-        APP_HOST = "0.0.0.0"
-        appPort = app_config["DEFAULT"]["port"]
-        logger.info(f"Starting Flask server on {APP_HOST} listening on port {appPort}")
-        app.run(host=APP_HOST, port=appPort)
+        init_app(app_config)
+        app_host = "0.0.0.0"
+        app_port = app_config["DEFAULT"]["port"]
+        logger.info(f"Starting Flask server on {app_host} listening on port {app_port}")
+        app.run(host=app_host, port=app_port)
 
     except Exception as e:
         logging.error(f"There was an error starting the server: {e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+import io
+import json
+import logging
+import time
+from datetime import datetime
+
+from quart import (
+    Quart,
+    Response,
+    g,
+    redirect,
+    request,
+    render_template,
+    url_for,
+)
+
+from app import init_logging, parse_date, parse_fields, read_config, read_vault_token
+from blind_index import BLIND_INDEX_COLUMNS
+from bulk_import import BULK_TRANSACTION_SIZE, import_customers_async, read_records
+from db_client import TRANSIT_BATCH_SIZE
+from db_client_async import DbClient as TransitClient
+from db_client_transform_async import DbClient as TransformClient
+from metrics import CONTENT_TYPE, HTTP_REQUEST_DURATION, HTTP_REQUESTS, REGISTRY
+from vault_http import VAULT_POOL_SIZE, VAULT_TIMEOUT
+
+# The routes and templates of app.py served by an ASGI server:
+#
+#   hypercorn app_async:app --bind 0.0.0.0:8080
+#
+# Requests waiting on MySQL or Vault do not block a thread, so one process
+# serves many concurrent requests.
+
+dbc: TransitClient = None
+
+logger = logging.getLogger("app")
+
+app = Quart(__name__)
+app.config["TEMPLATES_AUTO_RELOAD"] = True
+app.config["MAX_PAGE_SIZE"] = 1000
+app.config["BULK_TRANSACTION_SIZE"] = BULK_TRANSACTION_SIZE
+
+
+@app.before_request
+async def start_timer():
+    g.started = time.perf_counter()
+
+
+@app.after_request
+async def record_request(response):
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    HTTP_REQUESTS.inc(route, request.method, response.status_code)
+    HTTP_REQUEST_DURATION.observe(
+        time.perf_counter() - g.started, route, request.method
+    )
+    return response
+
+
+@app.route("/health", methods=["GET"])
+async def health():
+    if dbc is None or not dbc.is_initialized:
+        return "Unhealthy - no database", 500
+
+    return "Healthy", 200
+
+
+async def stream_json_array(items):
+    yield "["
+    first = True
+    async for item in items:
+        yield ("" if first else ",") + json.dumps(item)
+        first = False
+    yield "]"
+
+
+async def stream_ndjson(items):
+    async for item in items:
+        yield json.dumps(item) + "\n"
+
+
+@app.route("/customers", methods=["GET"])
+async def get_customers():
+    after = request.args.get("after", type=int)
+    limit = request.args.get("limit", default=50, type=int)
+    limit = max(0, min(limit, app.config["MAX_PAGE_SIZE"]))
+    try:
+        fields = parse_fields(request.args.get("fields"))
+        created_from = parse_date(request.args.get("created_from"))
+        created_before = parse_date(request.args.get("created_before"))
+    except ValueError as e:
+        return f"Error: {e}", 400
+    customers = dbc.iter_customer_records(
+        after=after,
+        limit=limit,
+        fields=fields,
+        created_from=created_from,
+        created_before=created_before,
+    )
+    if (
+        request.args.get("format") == "ndjson"
+        or request.accept_mimetypes.best == "application/x-ndjson"
+    ):
+        return Response(stream_ndjson(customers), mimetype="application/x-ndjson")
+    return Response(stream_json_array(customers), mimetype="application/json")
+
+
+@app.route("/customer", methods=["GET"])
+async def get_customer():
+    cust_no = request.args.get("cust_no")
+    if not cust_no:
+        return (
+            "<html><body>Error: cust_no is a required argument for the customer endpoint.</body></html>",
+            500,
+        )
+    try:
+        fields = parse_fields(request.args.get("fields"))
+    except ValueError as e:
+        return f"Error: {e}", 400
+    return json.dumps(await dbc.get_customer_record(cust_no, fields=fields))
+
+
+@app.route("/customers/lookup", methods=["GET"])
+async def lookup_customers():
+    if dbc.blind_index is None:
+        return "Error: blind indexes are not enabled.", 404
+    fields = [f for f in BLIND_INDEX_COLUMNS if request.args.get(f)]
+    if len(fields) != 1:
+        return "Error: exactly one of ssn or ccn is required.", 400
+    return json.dumps(await dbc.find_customers(fields[0], request.args[fields[0]]))
+
+
+@app.route("/customers", methods=["POST"])
+async def create_customer():
+    customer = dict((await request.form).items())
+    if "create_date" not in customer.keys():
+        customer["create_date"] = datetime.now().isoformat()
+    return json.dumps(await dbc.insert_customer_record(customer))
+
+
+# Accepts NDJSON or, with Content-Type text/csv, CSV with a header row
+@app.route("/customers/bulk", methods=["POST"])
+async def bulk_create_customers():
+    fmt = "csv" if request.mimetype == "text/csv" else "ndjson"
+    stream = io.StringIO(await request.get_data(as_text=True), newline="")
+    summary = await import_customers_async(
+        dbc, read_records(stream, fmt), app.config["BULK_TRANSACTION_SIZE"]
+    )
+    return json.dumps(summary)
+
+
+@app.route("/customers", methods=["PUT"])
+async def update_customer():
+    customer = dict((await request.form).items())
+    return json.dumps(await dbc.update_customer_record(customer))
+
+
+@app.route("/metrics", methods=["GET"])
+async def metrics():
+    return Response(REGISTRY.render(), mimetype=CONTENT_TYPE)
+
+
+@app.route("/cache", methods=["GET"])
+async def cache_stats():
+    return json.dumps(dbc.cache_stats())
+
+
+@app.route("/cache/flush", methods=["POST"])
+async def cache_flush():
+    dbc.flush_cache()
+    return json.dumps(dbc.cache_stats())
+
+
+@app.route("/cache/retire", methods=["POST"])
+async def cache_retire():
+    version = request.args.get("min_decryption_version", type=int)
+    if version is None:
+        return "Error: min_decryption_version is required.", 400
+    dbc.retire_key_versions(version)
+    return json.dumps(dbc.cache_stats())
+
+
+@app.route("/vault/stats", methods=["GET"])
+async def vault_stats():
+    return json.dumps(dbc.vault_latency_stats())
+
+
+@app.route("/", methods=["GET"])
+async def index():
+    return await render_template("index.html")
+
+
+@app.route("/records", methods=["GET"])
+async def get_records():
+    return await render_template(
+        "records.html",
+        results=await dbc.get_customer_records(),
+        record_added=request.args.get("record_added"),
+        record_updated=request.args.get("record_updated"),
+    )
+
+
+@app.route("/dbview", methods=["GET"])
+async def dbview():
+    records = await dbc.get_customer_records(raw=True)
+    return await render_template("dbview.html", results=records)
+
+
+@app.route("/add", methods=["GET"])
+async def add():
+    return await render_template("add.html")
+
+
+@app.route("/add", methods=["POST"])
+async def add_submit():
+    records = await create_customer()
+    if request.args.get("show") == "record":
+        return await render_template(
+            "records.html", results=json.loads(records), record_added=True
+        )
+    return redirect(url_for("get_records", record_added=1), code=303)
+
+
+@app.route("/update", methods=["GET"])
+async def update():
+    cust_no = request.args.get("cust_no")
+    customer = None
+    if cust_no:
+        records = await dbc.get_customer_record(cust_no)
+        if records:
+            customer = records[0]
+    return await render_template("update.html", customer=customer)
+
+
+@app.route("/update", methods=["POST"])
+async def update_submit():
+    records = await update_customer()
+    if request.args.get("show") == "record":
+        return await render_template(
+            "records.html", results=json.loads(records), record_updated=True
+        )
+    return redirect(url_for("get_records", record_updated=1), code=303)
+
+
+async def init_vault(conf) -> TransitClient:
+    client = TransitClient()
+    if not conf.has_section("VAULT") or conf["VAULT"]["Enabled"].lower() == "false":
+        return client
+
+    transform = conf.getboolean("VAULT", "Transform", fallback=False)
+    if transform:
+        client = TransformClient()
+
+    if conf["VAULT"]["InjectToken"].lower() == "true":
+        logger.info("Using Injected vault token")
+        vault_token = read_vault_token()
+    else:
+        vault_token = conf["VAULT"]["Token"]
+
+    await client.init_vault(
+        addr=conf["VAULT"]["Address"],
+        token=vault_token,
+        namespace=conf["VAULT"]["Namespace"],
+        path=conf["VAULT"]["KeyPath"],
+        key_name=conf["VAULT"]["KeyName"],
+        batch_size=conf.getint("VAULT", "BatchSize", fallback=TRANSIT_BATCH_SIZE),
+        timeout=conf.getint("VAULT", "Timeout", fallback=VAULT_TIMEOUT),
+        pool_size=conf.getint("VAULT", "PoolSize", fallback=VAULT_POOL_SIZE),
+        verify=conf.getboolean("VAULT", "TLSVerify", fallback=False),
+    )
+    if conf.getboolean("VAULT", "Envelope", fallback=False):
+        logger.warning("Envelope encryption is only supported by app.py")
+    client.init_cache(
+        max_size=conf.getint("VAULT", "CacheSize", fallback=0),
+        ttl=conf.getint("VAULT", "CacheTTL", fallback=300),
+    )
+
+    if transform:
+        logger.info("Using Transform database client...")
+        client.init_transform(
+            transform_path=conf["VAULT"]["TransformPath"],
+            ssn_role=conf["VAULT"]["SSNRole"],
+            transform_masking_path=conf["VAULT"]["TransformMaskingPath"],
+            ccn_role=conf["VAULT"]["CCNRole"],
+            ccn_decode=conf.getboolean("VAULT", "CCNDecode", fallback=False),
+        )
+    if (
+        conf.has_option("VAULT", "database_auth")
+        and conf["VAULT"]["database_auth"] != ""
+    ):
+        await client.vault_db_auth(conf["VAULT"]["database_auth"])
+
+    return client
+
+
+async def init_client(conf) -> TransitClient:
+    client = await init_vault(conf)
+    # credentials read from Vault by database_auth take precedence
+    if client.username is None:
+        logger.info("Using DB credentials from config.ini...")
+        client.username = conf["DATABASE"]["User"]
+        client.password = conf["DATABASE"]["Password"]
+    await client.init_db(
+        uri=conf["DATABASE"]["Address"],
+        prt=conf["DATABASE"]["Port"],
+        uname=client.username,
+        pw=client.password,
+        db=conf["DATABASE"]["Database"],
+        pool_size=conf.getint("DATABASE", "PoolSize", fallback=0),
+        pool_max_lifetime=conf.getint("DATABASE", "PoolMaxLifetime", fallback=1800),
+        init_schema=conf.getboolean("DATABASE", "InitSchema", fallback=True),
+    )
+    if conf.getboolean("VAULT", "BlindIndex", fallback=False):
+        await client.init_blind_index()
+    return client
+
+
+# runs in every worker process of the ASGI server before it accepts requests
+@app.before_serving
+async def startup():
+    global dbc  # pylint: disable=global-statement
+    app_config = read_config()
+    init_logging(app_config)
+    # httpx logs every request at INFO
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    dbc = await init_client(app_config)
+    app.config["MAX_PAGE_SIZE"] = app_config.getint(
+        "DEFAULT", "MaxPageSize", fallback=app.config["MAX_PAGE_SIZE"]
+    )
+    app.config["BULK_TRANSACTION_SIZE"] = app_config.getint(
+        "DATABASE", "BulkTransactionSize", fallback=BULK_TRANSACTION_SIZE
+    )
+
+
+@app.after_serving
+async def shutdown():
+    if dbc is not None:
+        await dbc.close()
+
+
+if __name__ == "__main__":
+    config = read_config()
+    logger.info(f"Starting ASGI server on port {config['DEFAULT']['port']}")
+    app.run(host="0.0.0.0", port=int(config["DEFAULT"]["port"]), use_reloader=False)
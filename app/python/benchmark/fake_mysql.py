@@ -0,0 +1,154 @@
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+
+import mysql.connector
+from mysql.connector import errorcode
+
+# MySQL dialect which the DbClient statements use, rewritten for SQLite
+REWRITES = (
+    (re.compile(r"ENGINE=InnoDB"), ""),
+    # strict mode rejects values which are too long instead of truncating them
+    (
+        re.compile(r"(`(\w+)` varchar\((\d+)\))"),
+        r"\1 CHECK (length(`\2`) <= \3)",
+    ),
+    (
+        re.compile(r"int\(11\) NOT NULL AUTO_INCREMENT"),
+        "INTEGER PRIMARY KEY AUTOINCREMENT",
+    ),
+    (re.compile(r",\s*PRIMARY KEY \(`cust_no`\)"), ""),
+    (re.compile(r"INSERT IGNORE", re.IGNORECASE), "INSERT OR IGNORE"),
+    (
+        re.compile(r"(?s)INSERT INTO(.*)ON DUPLICATE KEY UPDATE.*$"),
+        r"REPLACE INTO\1",
+    ),
+    (re.compile(r"%s"), "?"),
+    (re.compile(r"@@auto_increment_increment"), "1"),
+    (re.compile(r"(GET|RELEASE)_LOCK\("), "coalesce(1, "),
+    (re.compile(r",\s*LOCK=NONE"), ""),
+    (
+        re.compile(r"ALTER TABLE (`\w+`) ADD INDEX (`\w+`) (\([^)]*\))"),
+        r"CREATE INDEX \2 ON \1 \3",
+    ),
+)
+IGNORED = re.compile(r"^\s*(CREATE DATABASE|USE)\b", re.IGNORECASE)
+
+
+# SQLite messages of the MySQL errors which the clients handle by errno
+ERRNOS = (
+    (re.compile(r"duplicate column name"), errorcode.ER_DUP_FIELDNAME),
+    (re.compile(r"index \S+ already exists"), errorcode.ER_DUP_KEYNAME),
+)
+
+
+def translate(sql):
+    for pattern, replacement in REWRITES:
+        sql = pattern.sub(replacement, sql)
+    return sql
+
+
+# Raises a SQLite error as the mysql.connector error the clients catch
+def raise_mysql_error(err):
+    errno = next((e for pattern, e in ERRNOS if pattern.search(str(err))), None)
+    if isinstance(err, sqlite3.IntegrityError):
+        raise mysql.connector.errors.IntegrityError(msg=str(err), errno=errno) from err
+    raise mysql.connector.errors.DatabaseError(msg=str(err), errno=errno) from err
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self._conn = conn
+        self._cursor = conn.db.cursor()
+        self._rows = []
+        self.lastrowid = None
+        self.rowcount = -1
+
+    def execute(self, sql, params=None):
+        if IGNORED.match(sql):
+            self._rows = []
+            return
+        with self._conn.lock:
+            try:
+                self._cursor.execute(translate(sql), tuple(params or ()))
+            except sqlite3.Error as err:
+                raise_mysql_error(err)
+            self._rows = self._cursor.fetchall()
+        self.lastrowid = self._cursor.lastrowid
+        self.rowcount = self._cursor.rowcount
+
+    def executemany(self, sql, seq_params):
+        with self._conn.lock:
+            self._cursor.execute("BEGIN")
+            try:
+                self._cursor.executemany(translate(sql), [tuple(p) for p in seq_params])
+            except sqlite3.Error as err:
+                # like a single multi-row INSERT, no row is kept
+                self._cursor.execute("ROLLBACK")
+                raise_mysql_error(err)
+            self.rowcount = self._cursor.rowcount
+            # MySQL reports the id of the first row of a multi-row INSERT
+            self._cursor.execute("SELECT last_insert_rowid()")
+            self.lastrowid = self._cursor.fetchone()[0] - self.rowcount + 1
+            self._cursor.execute("COMMIT")
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        self._cursor.close()
+
+
+class FakeConnection:
+    def __init__(self, path, lock):
+        self.db = sqlite3.connect(
+            path, check_same_thread=False, timeout=30, isolation_level=None
+        )
+        self.lock = lock
+        self.in_transaction = False
+
+    def cursor(self, **_kwargs):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def ping(self, **_kwargs):
+        return True
+
+    def is_connected(self):
+        return True
+
+    def close(self):
+        self.db.close()
+
+
+# Injectable replacement for mysql.connector.connect which stores all tables in
+# one temporary SQLite file. Connections run in autocommit mode and every
+# statement holds a shared lock, so no connection keeps the SQLite write lock
+# between statements. commit and rollback are no-ops.
+class FakeMySQL:
+    def __init__(self):
+        handle, self.path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(handle)
+        self.lock = threading.RLock()
+        self.connections = 0
+
+    def connect(self, **_kwargs):
+        self.connections += 1
+        return FakeConnection(self.path, self.lock)
+
+    def close(self):
+        os.remove(self.path)
@@ -0,0 +1,151 @@
+import base64
+import json
+import os
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TRANSIT_PATH = re.compile(
+    r"^/v1/(?P<mount>.+)/(?P<op>encrypt|decrypt|rewrap)/(?P<name>[^/]+)$"
+)
+TRANSFORM_PATH = re.compile(
+    r"^/v1/(?P<mount>.+)/(?P<op>encode|decode)/(?P<name>[^/]+)$"
+)
+DATAKEY_PATH = re.compile(r"^/v1/(?P<mount>.+)/datakey/(?P<type>\w+)/(?P<name>[^/]+)$")
+KEY_PATH = re.compile(r"^/v1/(?P<mount>.+)/keys/(?P<name>[^/]+)$")
+CIPHERTEXT = re.compile(r"^vault:v(\d+):(.+)$")
+
+
+# Stand-in for the Vault Transit and Transform HTTP API. Ciphertexts are only
+# encoded, not encrypted, and every request is delayed by latency seconds to
+# model the round trip to a real Vault. Requests and batch items are counted
+# per operation.
+class FakeVault:
+    def __init__(self, latency=0.002, key_version=1):
+        self.latency = latency
+        self.key_version = key_version
+        self.requests = Counter()
+        self.items = Counter()
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def address(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def reset(self):
+        with self._lock:
+            self.requests.clear()
+            self.items.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": dict(self.requests),
+                "items": dict(self.items),
+                "total_requests": sum(self.requests.values()),
+            }
+
+    def _count(self, op, items):
+        with self._lock:
+            self.requests[op] += 1
+            self.items[op] += items
+
+    def _encrypt(self, item):
+        ciphertext = base64.b64encode(item["plaintext"].encode()).decode()
+        return {"ciphertext": f"vault:v{self.key_version}:{ciphertext}"}
+
+    def _decrypt(self, item):
+        match = CIPHERTEXT.match(item.get("ciphertext", ""))
+        if match is None:
+            return {"error": "invalid ciphertext"}
+        return {"plaintext": base64.b64decode(match.group(2)).decode()}
+
+    def _rewrap(self, item):
+        match = CIPHERTEXT.match(item.get("ciphertext", ""))
+        if match is None:
+            return {"error": "invalid ciphertext"}
+        return {"ciphertext": f"vault:v{self.key_version}:{match.group(2)}"}
+
+    @staticmethod
+    def _shift(value, offset):
+        return "".join(
+            str((int(c) + offset) % 10) if c.isdigit() else c for c in value
+        )
+
+    def _encode(self, item):
+        return {"encoded_value": self._shift(item["value"], 1)}
+
+    def _decode(self, item):
+        return {"decoded_value": self._shift(item["value"], -1)}
+
+    def handle(self, method, path, body):
+        time.sleep(self.latency)
+        if path == "/v1/auth/token/lookup-self":
+            self._count("lookup", 1)
+            return 200, {"data": {"policies": ["root"]}}
+        if method == "GET" and (match := KEY_PATH.match(path)):
+            self._count("read_key", 1)
+            return 200, {"data": {"latest_version": self.key_version}}
+        if match := DATAKEY_PATH.match(path):
+            self._count("datakey", 1)
+            key = base64.b64encode(os.urandom(32)).decode()
+            wrapped = self._encrypt({"plaintext": key})
+            return 200, {"data": {"plaintext": key, **wrapped}}
+
+        match = TRANSIT_PATH.match(path) or TRANSFORM_PATH.match(path)
+        if match is None:
+            return 404, {"errors": [f"no handler for {path}"]}
+        op = match.group("op")
+        handler = getattr(self, f"_{op}")
+        batch = body.get("batch_input")
+        self._count(op, len(batch) if batch else 1)
+        if batch:
+            return 200, {"data": {"batch_results": [handler(i) for i in batch]}}
+        result = handler(body)
+        if "error" in result:
+            return 400, {"errors": [result["error"]]}
+        return 200, {"data": result}
+
+    def start(self):
+        vault = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _respond(self, method):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length) or b"{}")
+                status, payload = vault.handle(method, self.path, body)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._respond("GET")
+
+            def do_POST(self):
+                self._respond("POST")
+
+            def do_PUT(self):
+                self._respond("PUT")
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
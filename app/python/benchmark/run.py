@@ -0,0 +1,211 @@
+import argparse
+import configparser
+import json
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from werkzeug.serving import make_server
+
+import app
+from bulk_import import import_customers
+from db_client import DbClient
+from benchmark.fake_mysql import FakeMySQL
+from benchmark.fake_vault import FakeVault
+
+logger = logging.getLogger(__name__)
+
+SCENARIOS = ("list", "get", "create", "update", "bulk")
+
+
+def customer(i):
+    return {
+        "first_name": f"First{i}",
+        "last_name": f"Last{i}",
+        "birth_date": f"{i % 12 + 1}/{i % 28 + 1}/7{i % 10}",
+        "ssn": f"{i % 900 + 100}-{i % 90 + 10}-{i % 9000 + 1000}",
+        "ccn": f"{i % 9000 + 1000}-5600-6750-{i % 9000 + 1000}",
+        "address": f"{i} Main Street, Springfield",
+        "salary": str(50000 + i),
+        "create_date": "2024-01-01T00:00:00",
+    }
+
+
+def build_config(args, vault):
+    conf = configparser.ConfigParser()
+    conf["DEFAULT"] = {"LogLevel": "WARN", "Port": "0"}
+    conf["DATABASE"] = {
+        "Address": "localhost",
+        "Port": "3306",
+        "Database": "benchmark",
+        "User": "bench",
+        "Password": "bench",
+        "PoolSize": str(args.db_pool_size),
+        "GroupCommit": str(args.group_commit),
+    }
+    conf["VAULT"] = {
+        "Enabled": "True",
+        "InjectToken": "False",
+        "Address": vault.address,
+        "Token": "root",
+        "Namespace": "",
+        "KeyPath": "transit",
+        "KeyName": "app",
+        "BatchSize": str(args.batch_size),
+        "Workers": str(args.workers),
+        "CacheSize": str(args.cache_size),
+        "PoolSize": str(max(args.concurrency, args.workers, 1)),
+        "Envelope": str(args.envelope),
+        "Transform": str(args.transform),
+        "TransformPath": "transform",
+        "TransformMaskingPath": "masking",
+        "SSNRole": "ssn",
+        "CCNRole": "ccn",
+    }
+    return conf
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+# Returns the request of the i-th iteration of a scenario and the number of
+# customers it covers.
+def make_request(scenario, i, base, cust_nos, bulk_size):
+    if scenario == "list":
+        return "GET", f"{base}/customers?limit=50", {}, 50
+    if scenario == "get":
+        return "GET", f"{base}/customer?cust_no={random.choice(cust_nos)}", {}, 1
+    if scenario == "create":
+        return "POST", f"{base}/customers", {"data": customer(i)}, 1
+    if scenario == "update":
+        record = {**customer(i), "cust_no": random.choice(cust_nos)}
+        return "PUT", f"{base}/customers", {"data": record}, 1
+    body = "\n".join(json.dumps(customer(i * bulk_size + n)) for n in range(bulk_size))
+    headers = {"Content-Type": "application/x-ndjson"}
+    request = {"data": body, "headers": headers}
+    return "POST", f"{base}/customers/bulk", request, bulk_size
+
+
+def run_scenario(scenario, args, base, cust_nos, vault):
+    local = threading.local()
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def one(i):
+        nonlocal errors
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        method, url, kwargs, _ = make_request(
+            scenario, i, base, cust_nos, args.bulk_size
+        )
+        started = time.perf_counter()
+        try:
+            response = local.session.request(method, url, timeout=60, **kwargs)
+            response.content  # pylint: disable=pointless-statement
+            failed = response.status_code >= 400
+        except requests.RequestException:
+            failed = True
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            errors += failed
+
+    vault.reset()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(one, range(args.requests)))
+    elapsed = time.perf_counter() - started
+    rows = args.requests * make_request(scenario, 0, base, cust_nos, args.bulk_size)[3]
+    vault_stats = vault.stats()
+    return {
+        "requests": args.requests,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(args.requests / elapsed, 1),
+        "rows_per_second": round(rows / elapsed, 1),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 3),
+            "p95": round(percentile(latencies, 95) * 1000, 3),
+            "p99": round(percentile(latencies, 99) * 1000, 3),
+            "max": round(max(latencies) * 1000, 3),
+        },
+        "vault_requests": vault_stats["total_requests"],
+        "vault_requests_per_request": round(
+            vault_stats["total_requests"] / args.requests, 2
+        ),
+        "vault": vault_stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the app against in-process Vault and MySQL stand-ins"
+    )
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--seed-rows", type=int, default=1000)
+    parser.add_argument("--bulk-size", type=int, default=100)
+    parser.add_argument("--vault-latency", type=float, default=0.002)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--cache-size", type=int, default=0)
+    parser.add_argument("--db-pool-size", type=int, default=8)
+    parser.add_argument("--transform", action="store_true")
+    parser.add_argument("--envelope", action="store_true")
+    parser.add_argument("--group-commit", action="store_true")
+    parser.add_argument("--output", default="benchmark.json")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    vault = FakeVault(latency=args.vault_latency).start()
+    mysql = FakeMySQL()
+    DbClient.connection_factory = staticmethod(mysql.connect)
+    conf = build_config(args, vault)
+    app.dbc = app.init_client(conf)
+
+    seeded = import_customers(
+        app.dbc, ((i, customer(i)) for i in range(args.seed_rows)), 1000
+    )
+    cust_nos = [c["customer_number"] for c in app.dbc.iter_customer_records(raw=True)]
+    logger.warning(f"Seeded {seeded['inserted']} customers")
+
+    server = make_server("127.0.0.1", 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+
+    results = {}
+    try:
+        for scenario in args.scenarios:
+            results[scenario] = run_scenario(scenario, args, base, cust_nos, vault)
+            r = results[scenario]
+            print(
+                f"{scenario:>8}: {r['requests_per_second']:>9} req/s "
+                f"p50 {r['latency_ms']['p50']:>8} ms "
+                f"p95 {r['latency_ms']['p95']:>8} ms "
+                f"p99 {r['latency_ms']['p99']:>8} ms "
+                f"vault {r['vault_requests_per_request']:>6}/req "
+                f"errors {r['errors']}"
+            )
+    finally:
+        server.shutdown()
+        vault.stop()
+        mysql.close()
+
+    settings = {k: v for k, v in vars(args).items() if k != "output"}
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"settings": settings, "results": results}, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
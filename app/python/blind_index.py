@@ -0,0 +1,161 @@
+import argparse
+import hashlib
+import hmac
+import json
+import logging
+import re
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# data_keys id of the Transit wrapped blind index key
+BLIND_INDEX_KEY_ID = "blind_index"
+
+# record fields with a blind index and their index column
+BLIND_INDEX_COLUMNS = {"ssn": "ssn_bidx", "ccn": "ccn_bidx"}
+
+BACKFILL_CHUNK_SIZE = 500
+BACKFILL_ROWS_PER_SECOND = 1000
+
+SEPARATORS = re.compile(r"[\s-]")
+
+
+# Keyed HMAC-SHA256 of a field value, stored next to the randomized ciphertext
+# so that equality lookups are an index probe. Every field uses its own key
+# derived from the Vault managed key, and separators are removed so that
+# 360-56-6750 and 360566750 match.
+class BlindIndex:
+    def __init__(self, key):
+        self._keys = {
+            field: hmac.new(key, field.encode(), hashlib.sha256).digest()
+            for field in BLIND_INDEX_COLUMNS
+        }
+
+    @staticmethod
+    def normalize(value):
+        return SEPARATORS.sub("", value)
+
+    def compute(self, field, value):
+        return hmac.new(
+            self._keys[field], self.normalize(value).encode(), hashlib.sha256
+        ).hexdigest()
+
+
+# Fills the blind index columns of rows written before the index was enabled.
+# Rows are read in primary key chunks, decrypted with batched Vault calls and
+# updated in one transaction per chunk, the last finished cust_no is
+# checkpointed like the rewrap job does.
+class BlindIndexBackfill:
+    name = "blind_index_backfill"
+
+    def __init__(
+        self,
+        dbc,
+        chunk_size=BACKFILL_CHUNK_SIZE,
+        rows_per_second=BACKFILL_ROWS_PER_SECOND,
+    ):
+        self.dbc = dbc
+        self.chunk_size = chunk_size
+        self.rows_per_second = rows_per_second
+        self._stop = threading.Event()
+
+    @classmethod
+    def from_config(cls, dbc, conf):
+        return cls(
+            dbc,
+            chunk_size=conf.getint(
+                "VAULT", "BlindIndexChunkSize", fallback=BACKFILL_CHUNK_SIZE
+            ),
+            rows_per_second=conf.getint(
+                "VAULT", "BlindIndexRowsPerSecond", fallback=BACKFILL_ROWS_PER_SECOND
+            ),
+        )
+
+    def _index_rows(self, rows):
+        stored = {row[0]: (row[5], row[6]) for row in rows}
+        fields = self.dbc.recoverable_fields()
+        updates = [
+            (
+                customer["customer_number"],
+                stored[customer["customer_number"]],
+                self.dbc.blind_index_values(customer, fields),
+            )
+            for customer in self.dbc.process_customers(rows)
+        ]
+        return self.dbc.update_blind_indexes(updates), len(rows) - len(updates)
+
+    def _throttle(self, rows, started):
+        if self.rows_per_second <= 0:
+            return
+        delay = rows / self.rows_per_second - (time.monotonic() - started)
+        if delay > 0:
+            self._stop.wait(delay)
+
+    def run(self, restart=False):
+        started = time.monotonic()
+        after = 0 if restart else self.dbc.get_checkpoint(self.name)
+        logger.info(f"Backfilling blind indexes after cust_no {after}")
+        rows_seen = indexed = failed = 0
+        while not self._stop.is_set():
+            chunk_started = time.monotonic()
+            rows = self.dbc.get_unindexed_rows(after, self.chunk_size)
+            if not rows:
+                self.dbc.save_checkpoint(self.name, 0)
+                break
+            done, errors = self._index_rows(rows)
+            rows_seen += len(rows)
+            indexed += done
+            failed += errors
+            after = rows[-1][0]
+            self.dbc.save_checkpoint(self.name, after)
+            logger.info(f"Indexed {indexed} customers up to cust_no {after}")
+            self._throttle(len(rows), chunk_started)
+
+        return {
+            "rows": rows_seen,
+            "indexed": indexed,
+            "failed": failed,
+            "completed": not self._stop.is_set(),
+            "seconds": round(time.monotonic() - started, 3),
+        }
+
+    def stop(self):
+        self._stop.set()
+
+
+def main():
+    # app is only needed to set up the client from config.ini
+    import app  # pylint: disable=import-outside-toplevel
+
+    parser = argparse.ArgumentParser(
+        description="Fill the SSN and CCN blind indexes of existing customers"
+    )
+    parser.add_argument("--chunk-size", type=int)
+    parser.add_argument("--rows-per-second", type=int)
+    parser.add_argument(
+        "--restart", action="store_true", help="ignore the saved checkpoint"
+    )
+    args = parser.parse_args()
+
+    app_config = app.read_config()
+    logging.basicConfig(level=app.log_level[app_config["DEFAULT"]["LogLevel"]])
+    dbc = app.init_client(app_config)
+    if dbc.blind_index is None:
+        dbc.init_blind_index()
+    if dbc.blind_index is None:
+        logger.error("Blind indexes need an enabled Vault")
+        return 1
+    job = BlindIndexBackfill.from_config(dbc, app_config)
+    if args.chunk_size:
+        job.chunk_size = args.chunk_size
+    if args.rows_per_second is not None:
+        job.rows_per_second = args.rows_per_second
+    summary = job.run(restart=args.restart)
+    print(json.dumps(summary, indent=2))
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
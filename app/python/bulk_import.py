@@ -0,0 +1,158 @@
+import argparse
+import csv
+import io
+import json
+import logging
+import sys
+import time
+from datetime import datetime
+from itertools import islice
+
+logger = logging.getLogger(__name__)
+
+BULK_TRANSACTION_SIZE = 1000
+
+REQUIRED_FIELDS = (
+    "birth_date",
+    "first_name",
+    "last_name",
+    "ssn",
+    "ccn",
+    "address",
+    "salary",
+)
+
+
+# Readers yield (line, record) pairs, records which cannot be parsed are
+# passed on as the exception so they are reported with the other errors.
+def read_ndjson(lines):
+    for line_no, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield line_no, json.loads(line)
+        except ValueError as e:
+            yield line_no, e
+
+
+def read_csv(lines):
+    reader = csv.DictReader(lines)
+    # line 1 is the header
+    for line_no, row in enumerate(reader, 2):
+        yield line_no, row
+
+
+def read_records(stream, fmt):
+    if fmt == "csv":
+        return read_csv(stream)
+    return read_ndjson(stream)
+
+
+def normalize_record(record):
+    if not isinstance(record, dict):
+        raise ValueError("record must be an object")
+    missing = [f for f in REQUIRED_FIELDS if not record.get(f)]
+    if missing:
+        raise ValueError(f"missing fields: {', '.join(missing)}")
+    customer = {f: str(record[f]) for f in REQUIRED_FIELDS}
+    customer["create_date"] = str(
+        record.get("create_date") or datetime.now().isoformat()
+    )
+    return customer
+
+
+# Splits records into transactions of transaction_size valid customers.
+# Records which fail validation are added to errors right away.
+def transactions(records, errors, transaction_size=BULK_TRANSACTION_SIZE):
+    records = iter(records)
+    while chunk := list(islice(records, transaction_size)):
+        lines = []
+        customers = []
+        for line_no, record in chunk:
+            try:
+                if isinstance(record, Exception):
+                    raise record
+                customers.append(normalize_record(record))
+                lines.append(line_no)
+            except ValueError as e:
+                errors.append({"line": line_no, "error": str(e)})
+        if customers:
+            yield lines, customers
+
+
+# Adds the insert errors of one transaction and returns the inserted count.
+def record_failures(lines, customers, failed, errors):
+    errors.extend(
+        {"line": lines[i], "error": error} for i, error in sorted(failed.items())
+    )
+    return len(customers) - len(failed)
+
+
+def import_summary(inserted, errors, started):
+    seconds = time.monotonic() - started
+    return {
+        "inserted": inserted,
+        "failed": len(errors),
+        "errors": errors,
+        "seconds": round(seconds, 3),
+        "rows_per_second": round(inserted / seconds, 1) if seconds else 0.0,
+    }
+
+
+# Imports records in transactions of transaction_size rows. Every transaction
+# protects its rows with batched Vault calls and writes them with one
+# multi-row INSERT.
+def import_customers(dbc, records, transaction_size=BULK_TRANSACTION_SIZE):
+    started = time.monotonic()
+    inserted = 0
+    errors = []
+    for lines, customers in transactions(records, errors, transaction_size):
+        failed = dbc.insert_customer_records(customers)
+        inserted += record_failures(lines, customers, failed, errors)
+        logger.info(f"Imported {inserted} customers, {len(errors)} errors")
+    return import_summary(inserted, errors, started)
+
+
+# import_customers for the async client
+async def import_customers_async(dbc, records, transaction_size=BULK_TRANSACTION_SIZE):
+    started = time.monotonic()
+    inserted = 0
+    errors = []
+    for lines, customers in transactions(records, errors, transaction_size):
+        failed = await dbc.insert_customer_records(customers)
+        inserted += record_failures(lines, customers, failed, errors)
+        logger.info(f"Imported {inserted} customers, {len(errors)} errors")
+    return import_summary(inserted, errors, started)
+
+
+def main():
+    # app is only needed to set up the client from config.ini
+    import app  # pylint: disable=import-outside-toplevel
+
+    parser = argparse.ArgumentParser(description="Bulk import customers")
+    parser.add_argument("file", help="NDJSON or CSV file, - reads stdin")
+    parser.add_argument("--format", choices=["ndjson", "csv"])
+    parser.add_argument("--transaction-size", type=int)
+    args = parser.parse_args()
+
+    app_config = app.read_config()
+    logging.basicConfig(level=app.log_level[app_config["DEFAULT"]["LogLevel"]])
+    fmt = args.format or ("csv" if args.file.endswith(".csv") else "ndjson")
+    transaction_size = args.transaction_size or app_config.getint(
+        "DATABASE", "BulkTransactionSize", fallback=BULK_TRANSACTION_SIZE
+    )
+
+    dbc = app.init_client(app_config)
+    if args.file == "-":
+        stream = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8", newline="")
+    else:
+        stream = open(args.file, encoding="utf-8", newline="")
+    with stream:
+        summary = import_customers(dbc, read_records(stream, fmt), transaction_size)
+    print(json.dumps(summary, indent=2))
+    return 1 if summary["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,79 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+TRANSIT_VERSION = re.compile(r"^vault:v(\d+):")
+
+
+# LRU cache of decrypted values keyed by their stored ciphertext. Entries
+# expire after ttl seconds and the least recently used entry is dropped once
+# max_size entries are stored.
+class PlaintextCache:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if value is None:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    # drops every Transit ciphertext of the given key version
+    def evict_key_version(self, version):
+        with self._lock:
+            stale = [
+                k
+                for k in self._entries
+                if (m := TRANSIT_VERSION.match(k)) and int(m.group(1)) == version
+            ]
+            for k in stale:
+                del self._entries[k]
+            self.evictions += len(stale)
+        return len(stale)
+
+    def flush(self):
+        with self._lock:
+            self.evictions += len(self._entries)
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
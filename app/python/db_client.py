@@ -1,37 +1,288 @@
 import base64
 import logging
+import threading
 import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache
 
 import hvac
+import hvac.exceptions
 import mysql.connector
 from mysql.connector import errorcode
 
-CUSTOMER_TABLE = """
-CREATE TABLE IF NOT EXISTS `customers` (
-    `cust_no` int(11) NOT NULL AUTO_INCREMENT,
-    `birth_date` varchar(255) NOT NULL,
-    `first_name` varchar(255) NOT NULL,
-    `last_name` varchar(255) NOT NULL,
-    `create_date` varchar(255) NOT NULL,
-    `social_security_number` varchar(255) NOT NULL,
-    `credit_card_number` varchar(255) NOT NULL,
-    `address` varchar(255) NOT NULL,
-    `salary` varchar(255) NOT NULL,
-    PRIMARY KEY (`cust_no`)
-) ENGINE=InnoDB;"""
-
-SEED_CUSTOMERS = """
-INSERT IGNORE into customers VALUES
-  (2, "3/14/69", "Larry", "Johnson", "2020-01-01T14:49:12.301977", "360-56-6750", "3600-5600-6750-0000", "Tyler, Texas", "7000000"),
-  (40, "11/26/69", "Shawn", "Kemp", "2020-02-21T10:24:55.985726", "235-32-8091", "2350-3200-8091-0001", "Elkhart, Indiana", "15000000"),
-  (34, "2/20/63", "Charles", "Barkley", "2019-04-09T01:10:20.548144", "531-72-1553", "5310-7200-1553-0002", "Leeds, Alabama", "9000000");
-"""
+from blind_index import BLIND_INDEX_COLUMNS, BLIND_INDEX_KEY_ID, BlindIndex
+from cache import PlaintextCache
+from db_pool import ConnectionPool
+from db_retry import (
+    CONNECT_ATTEMPTS,
+    CONNECT_MAX_DELAY,
+    RECONNECT_ATTEMPTS,
+    RECONNECT_BASE_DELAY,
+    RECONNECT_MAX_DELAY,
+    backoff_delays,
+    is_connection_lost,
+)
+from envelope import DATA_KEY_TTL, EnvelopeCipher
+from group_commit import (
+    GROUP_COMMIT_DELAY,
+    GROUP_COMMIT_QUEUE_SIZE,
+    GROUP_COMMIT_SIZE,
+    GroupCommitter,
+)
+from metrics import (
+    DB_CONNECT_RETRIES,
+    DB_QUERY_DURATION,
+    DB_READS,
+    DB_RECONNECTS,
+    VAULT_OPERATION_DURATION,
+    statement_type,
+)
+from migrations import (
+    MIGRATION_CHUNK_SIZE,
+    MIGRATION_ROWS_PER_SECOND,
+    migrate_database,
+    parse_create_date,
+)
+from replicas import (
+    READ_PRIMARY,
+    REPLICA_POOL_SIZE,
+    REPLICA_RETRY_AFTER,
+    NoReplicaAvailable,
+    ReplicaSet,
+)
+from vault_http import VAULT_POOL_SIZE, VAULT_TIMEOUT, LatencyStats, create_session
+
+# Transit accepts arbitrarily large batch_input lists, but very large requests
+# hit Vault's max_request_size and hold a single request open for too long.
+TRANSIT_BATCH_SIZE = 100
+
+# rows fetched per query when streaming customers by primary key
+STREAM_CHUNK_SIZE = 100
+
+# record fields in the column order of INSERT_SQL
+CUSTOMER_FIELDS = (
+    "birth_date",
+    "first_name",
+    "last_name",
+    "create_date",
+    "ssn",
+    "ccn",
+    "address",
+    "salary",
+)
+
+# insert parameters of a record, created_at is derived from create_date
+INSERT_FIELDS = CUSTOMER_FIELDS + ("created_at",)
+
+# table column of every protected record field
+FIELD_COLUMNS = {
+    "birth_date": "birth_date",
+    "ssn": "social_security_number",
+    "ccn": "credit_card_number",
+    "address": "address",
+    "salary": "salary",
+}
+
+# record fields in the column order of UPDATE_SQL
+UPDATE_FIELDS = (
+    "birth_date",
+    "first_name",
+    "last_name",
+    "ssn",
+    "ccn",
+    "address",
+    "salary",
+)
+
+# customer record fields and their table columns in the order of SELECT *
+RECORD_COLUMNS = {
+    "customer_number": "cust_no",
+    "birth_date": "birth_date",
+    "first_name": "first_name",
+    "last_name": "last_name",
+    "create_date": "create_date",
+    "ssn": "social_security_number",
+    "ccn": "credit_card_number",
+    "address": "address",
+    "salary": "salary",
+}
+
+RECORD_FIELDS = tuple(RECORD_COLUMNS)
+
+# {columns} is filled by select_sql with the columns of the requested fields
+SELECT_CUSTOMERS_SQL = "SELECT {columns} FROM `customers` LIMIT %s"
+
+SELECT_CUSTOMERS_AFTER_SQL = (
+    "SELECT {columns} FROM `customers` WHERE cust_no > %s ORDER BY cust_no LIMIT %s"
+)
+
+# Pages through a created_at range on its index in (created_at, cust_no)
+# order. created_at is selected last to continue after the previous chunk.
+# MySQL does not scan a range for a row comparison such as
+# (created_at, cust_no) > (%s, %s), so the created_at of the last row is
+# also a plain lower bound and every chunk starts at its position.
+SELECT_CUSTOMERS_CREATED_SQL = """
+SELECT {columns}, created_at FROM `customers`
+WHERE created_at >= %s AND created_at < %s AND created_at >= %s
+    AND (created_at > %s OR (created_at = %s AND cust_no > %s))
+ORDER BY created_at, cust_no LIMIT %s"""
+
+SELECT_CUSTOMER_SQL = "SELECT {columns} FROM `customers` WHERE cust_no = %s"
+
+SELECT_CREATED_AT_SQL = "SELECT created_at FROM `customers` WHERE cust_no = %s"
+
+# bounds of open date ranges within the DATETIME range of MySQL
+CREATED_AT_MIN = datetime(1000, 1, 1)
+CREATED_AT_MAX = datetime(9999, 12, 31, 23, 59, 59, 999999)
+
+AUTO_INCREMENT_INCREMENT_SQL = "SELECT @@auto_increment_increment"
+
+SELECT_CREATE_DATE_SQL = "SELECT create_date FROM `customers` WHERE cust_no = %s"
+
+SELECT_DATA_KEY_SQL = "SELECT wrapped_key FROM `data_keys` WHERE key_id = %s"
+
+INSERT_DATA_KEY_SQL = (
+    "INSERT IGNORE INTO `data_keys` (`key_id`, `wrapped_key`) VALUES (%s, %s)"
+)
+
+GET_LOCK_SQL = "SELECT GET_LOCK(%s, 0)"
+
+RELEASE_LOCK_SQL = "SELECT RELEASE_LOCK(%s)"
+
+SELECT_CHECKPOINT_SQL = "SELECT position FROM `job_checkpoints` WHERE job = %s"
+
+SAVE_CHECKPOINT_SQL = """
+INSERT INTO `job_checkpoints` (`job`, `position`) VALUES (%s, %s)
+ON DUPLICATE KEY UPDATE position = VALUES(position)"""
+
+INSERT_SQL = """
+INSERT INTO `customers` (`birth_date`, `first_name`, `last_name`, `create_date`,
+    `social_security_number`, `credit_card_number`, `address`, `salary`,
+    `created_at`)
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)"""
+
+UPDATE_SQL = """
+UPDATE `customers`
+SET birth_date = %s, first_name = %s, last_name = %s,
+    social_security_number = %s, credit_card_number = %s,
+    address = %s, salary = %s
+WHERE cust_no = %s"""
+
+# INSERT_SQL and UPDATE_SQL followed by the BLIND_INDEX_COLUMNS
+INSERT_BLIND_INDEX_SQL = """
+INSERT INTO `customers` (`birth_date`, `first_name`, `last_name`, `create_date`,
+    `social_security_number`, `credit_card_number`, `address`, `salary`,
+    `created_at`, `ssn_bidx`, `ccn_bidx`)
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
+
+UPDATE_BLIND_INDEX_SQL = """
+UPDATE `customers`
+SET birth_date = %s, first_name = %s, last_name = %s,
+    social_security_number = %s, credit_card_number = %s,
+    address = %s, salary = %s, ssn_bidx = %s, ccn_bidx = %s
+WHERE cust_no = %s"""
+
+SELECT_BY_BLIND_INDEX_SQL = {
+    field: f"SELECT * FROM `customers` WHERE `{column}` = %s"
+    for field, column in BLIND_INDEX_COLUMNS.items()
+}
+
+SELECT_UNINDEXED_SQL = """
+SELECT * FROM `customers`
+WHERE cust_no > %s AND (ssn_bidx IS NULL OR ccn_bidx IS NULL)
+ORDER BY cust_no LIMIT %s"""
+
+# only fills indexes which could be computed and only while the row still
+# holds the values the indexes were computed from
+UPDATE_BLIND_INDEXES_SQL = """
+UPDATE `customers`
+SET ssn_bidx = COALESCE(%s, ssn_bidx), ccn_bidx = COALESCE(%s, ccn_bidx)
+WHERE cust_no = %s AND social_security_number = %s AND credit_card_number = %s"""
 
 logger = logging.getLogger(__name__)
 
 
+# Returns the record fields to read for the requested ones in column order.
+# customer_number is always read, pagination and errors refer to it.
+def select_fields(fields=None):
+    if fields is None:
+        return RECORD_FIELDS
+    unknown = set(fields) - set(RECORD_COLUMNS)
+    if unknown:
+        raise ValueError(f"unknown fields: {', '.join(sorted(unknown))}")
+    return tuple(f for f in RECORD_FIELDS if f == "customer_number" or f in fields)
+
+
+@lru_cache(maxsize=None)
+def select_sql(sql, fields):
+    return sql.format(columns=", ".join(f"`{RECORD_COLUMNS[f]}`" for f in fields))
+
+
+# Returns the query, its fixed parameters and the start position to stream
+# the customers after cust_no after. With created_from or created_before
+# only customers created in that range are read, ordered by created_at on
+# its index, and after_created_at is the created_at of after. Nothing
+# follows a customer without one.
+def stream_query(
+    fields, after, created_from=None, created_before=None, after_created_at=None
+):
+    if created_from is None and created_before is None:
+        return select_sql(SELECT_CUSTOMERS_AFTER_SQL, fields), (), (after or 0,)
+    bounds = (created_from or CREATED_AT_MIN, created_before or CREATED_AT_MAX)
+    position = (CREATED_AT_MIN, 0)
+    if after is not None:
+        position = (after_created_at or CREATED_AT_MAX, after)
+    return select_sql(SELECT_CUSTOMERS_CREATED_SQL, fields), bounds, position
+
+
+# the position of the next chunk after the last row of a stream_query chunk
+def stream_position(row, position):
+    return (row[0],) if len(position) == 1 else (row[-1], row[0])
+
+
+# the parameters of the stream_query chunk of size rows after position
+def stream_params(bounds, position, size):
+    if len(position) == 2:
+        created_at, cust_no = position
+        position = (created_at, created_at, created_at, cust_no)
+    return bounds + position + (size,)
+
+
+# rows hold the columns of fields, further columns are ignored
+def row_to_customer(row, fields=RECORD_FIELDS):
+    return dict(zip(fields, row))
+
+
+# Builds the customer of a write from the plaintext we already hold
+# instead of reading and decrypting it again.
+def written_customer(cust_no, record, create_date):
+    return {
+        "customer_number": int(cust_no),
+        "birth_date": record["birth_date"],
+        "first_name": record["first_name"],
+        "last_name": record["last_name"],
+        "create_date": create_date,
+        "ssn": record["ssn"],
+        "ccn": record["ccn"],
+        "address": record["address"],
+        "salary": record["salary"],
+    }
+
+
 class DbClient:
+    # replaceable so that benchmarks can run against a MySQL stand-in
+    connection_factory = staticmethod(mysql.connector.connect)
     conn: mysql.connector.MySQLConnection = None
+    pool: ConnectionPool = None
+    _statements: weakref.WeakKeyDictionary = None
+    _conn_lock: threading.RLock = None
+    _credentials_lock: threading.Lock = None
+    reconnect_attempts: int = RECONNECT_ATTEMPTS
+    reconnect_base_delay: float = RECONNECT_BASE_DELAY
+    reconnect_max_delay: float = RECONNECT_MAX_DELAY
     uri: str = None
     port: int = None
     username: str = None
@@ -39,23 +290,269 @@ class DbClient:
     db: str = None
 
     vault_client: hvac.Client = None
+    vault_stats: LatencyStats = None
+    vault_timeout: int = VAULT_TIMEOUT
     key_name: str = None
     mount_point: str = None
     namespace: str = None
+    batch_size: int = TRANSIT_BATCH_SIZE
+    cache: PlaintextCache = None
+    envelope: EnvelopeCipher = None
+    blind_index: BlindIndex = None
+    executor: ThreadPoolExecutor = None
+    db_lease: dict = None
+    replicas: ReplicaSet = None
+    group_commit: GroupCommitter = None
+    auto_increment_increment: int = 1
+    write_listeners: tuple = ()
+    db_creds_path: str = None
     is_initialized: bool = False
 
-    def init_db(self, uri, prt, uname, pw, db):
+    # customer fields which are protected with Transit
+    TRANSIT_FIELDS = ("birth_date", "ssn", "ccn", "address", "salary")
+
+    # Schema setup runs once per deployment, with init_schema False the app
+    # connects straight to an existing database.
+    def init_db(
+        self,
+        uri,
+        prt,
+        uname,
+        pw,
+        db,
+        pool_size=0,
+        pool_max_lifetime=1800,
+        init_schema=True,
+    ):
+        if self._statements is None:
+            self._statements = weakref.WeakKeyDictionary()
+            self._conn_lock = threading.RLock()
+            self._credentials_lock = threading.Lock()
         self.connect_db(uri, prt, uname, pw)
-        self._init_database(db)
+        if init_schema:
+            self.init_schema(db)
+        else:
+            self.conn.database = db
+        self.db = db
+        self.is_initialized = True
+        if pool_size > 0 and self.pool is None:
+            logger.info(f"Using a pool of {pool_size} database connections")
+            self.pool = ConnectionPool(
+                self._connect, pool_size, max_lifetime=pool_max_lifetime
+            )
         logger.info("database is initialized")
 
-    def connect_db(self, uri, prt, uname, pw):
-        for i in range(0, 10):
+    # Returns a server-side prepared cursor for sql. Cursors are cached per
+    # connection, so MySQL parses every statement only once per connection.
+    def _prepared_cursor(self, conn, sql):
+        statements = self._statements.get(conn)
+        if statements is None:
+            statements = self._statements[conn] = {}
+        cursor = statements.get(sql)
+        if cursor is None:
+            cursor = statements[sql] = conn.cursor(prepared=True)
+        return cursor
+
+    # Connects to the primary, or to the given replica. Credentials are read
+    # on every connect, so new connections use rotated credentials.
+    def _connect(self, host=None, port=None):
+        with self._credentials_lock:
+            user, password = self.username, self.password
+        return self.connection_factory(
+            user=user,
+            password=password,
+            host=host or self.uri,
+            port=port or self.port,
+            database=self.db,
+        )
+
+    def init_replicas(
+        self,
+        addresses,
+        pool_size=REPLICA_POOL_SIZE,
+        pool_max_lifetime=1800,
+        retry_after=REPLICA_RETRY_AFTER,
+    ):
+        if not addresses:
+            return
+        self.replicas = ReplicaSet(
+            addresses,
+            self._connect,
+            pool_size=pool_size,
+            max_lifetime=pool_max_lifetime,
+            retry_after=retry_after,
+        )
+        logger.info(f"Reading customers from {len(addresses)} replicas")
+
+    def init_reconnect(self, attempts, base_delay, max_delay):
+        self.reconnect_attempts = attempts
+        self.reconnect_base_delay = base_delay
+        self.reconnect_max_delay = max_delay
+
+    # Without a pool all callers share one connection, which is not
+    # thread-safe, so _connection holds _conn_lock for a whole unit of work.
+    # A lost one is dropped and the next caller opens a new connection.
+    def _shared_connection(self):
+        with self._conn_lock:
+            if self.conn is None:
+                self.conn = self._connect()
+            return self.conn
+
+    def _drop_shared_connection(self, conn):
+        with self._conn_lock:
+            if self.conn is conn:
+                self.conn = None
+        try:
+            conn.close()
+        except mysql.connector.Error as e:
+            logger.debug(f"Error closing the lost connection: {e}")
+
+    # Checks out a connection for a single unit of work.
+    @contextmanager
+    def _connection(self):
+        if self.pool is None:
+            # another thread's statement must not run between an execute and
+            # its commit, nor be rolled back by the release below
+            with self._conn_lock:
+                conn = self._shared_connection()
+                try:
+                    yield conn
+                except mysql.connector.Error as err:
+                    if is_connection_lost(err):
+                        self._drop_shared_connection(conn)
+                    raise
+                finally:
+                    # like a pool release, ends the read snapshot so that the
+                    # next statement sees the rows committed by other connections
+                    if conn is self.conn and conn.in_transaction:
+                        conn.rollback()
+            return
+        with self.pool.connection() as conn:
+            yield conn
+
+    # Checks out a connection for a customer read. Reads go to a replica
+    # unless the caller must see its own writes or no replica is up.
+    # Errors of the read itself propagate, only the choice of the replica
+    # falls back to the primary.
+    @contextmanager
+    def _read_connection(self):
+        replica = None
+        if self.replicas is not None and not READ_PRIMARY.get():
+            try:
+                replica = self.replicas.choose()
+            except NoReplicaAvailable:
+                pass
+        if replica is None:
+            DB_READS.inc("primary")
+            context = self._connection()
+        else:
+            context = self.replicas.connection(replica)
+        with context as conn:
+            yield conn
+
+    # Holds the MySQL named lock name on a dedicated connection and yields
+    # whether it was acquired. The lock is held by one session at a time
+    # across all processes and released on exit, or when the connection is lost.
+    @contextmanager
+    def named_lock(self, name):
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(GET_LOCK_SQL, (name,))
+            acquired = cursor.fetchone()[0] == 1
+            try:
+                yield acquired
+            finally:
+                if acquired:
+                    cursor.execute(RELEASE_LOCK_SQL, (name,))
+                    cursor.fetchone()
+        finally:
+            conn.close()
+
+    # Runs work(conn) on a checked out connection. When the connection is
+    # lost it is replaced, idempotent work is retried with jittered backoff
+    # and any other work fails, since it may already have been applied.
+    def _run(self, work, idempotent, replica=False):
+        delays = backoff_delays(
+            self.reconnect_attempts,
+            self.reconnect_base_delay,
+            self.reconnect_max_delay,
+        )
+        while True:
             try:
-                logger.debug(
-                    f"Connecting to {uri}:{prt} with username {uname} and password {pw}"
+                connection = self._read_connection if replica else self._connection
+                with connection() as conn:
+                    return work(conn)
+            except mysql.connector.Error as err:
+                if not is_connection_lost(err):
+                    raise
+                DB_RECONNECTS.inc()
+                delay = next(delays, None) if idempotent else None
+                if delay is None:
+                    logger.error(f"Lost the database connection: {err}")
+                    raise
+                logger.warning(
+                    f"Lost the database connection, retrying in {delay:.3f}s: {err}"
                 )
-                self.conn = mysql.connector.connect(
+                time.sleep(delay)
+
+    # Runs a query and returns all rows, queries are always retried. With
+    # replica the query may be answered by a read replica, after a lost
+    # replica connection the retry goes to the next one.
+    def _query(self, sql, params=None, replica=False):
+        def work(conn):
+            cursor = self._prepared_cursor(conn, sql)
+            self._execute_sql(sql, cursor, params)
+            return cursor.fetchall()
+
+        return self._run(work, idempotent=True, replica=replica)
+
+    # Runs and commits a write and returns the id of the inserted row. Writes
+    # are retried after a lost connection only when they are idempotent.
+    def _write(self, sql, params=None, idempotent=False):
+        def work(conn):
+            cursor = self._prepared_cursor(conn, sql)
+            self._execute_sql(sql, cursor, params)
+            conn.commit()
+            return cursor.lastrowid
+
+        return self._run(work, idempotent)
+
+    # Runs one statement for many parameter rows in a single transaction on
+    # a client-side cursor and returns the cursor.
+    def _executemany(self, sql, rows, idempotent=False):
+        def work(conn):
+            cursor = conn.cursor()
+            try:
+                with DB_QUERY_DURATION.time(statement_type(sql)):
+                    cursor.executemany(sql, rows)
+                conn.commit()
+            except mysql.connector.Error as err:
+                if not is_connection_lost(err):
+                    conn.rollback()
+                raise
+            return cursor
+
+        return self._run(work, idempotent)
+
+    # returns the affected row count
+    def _write_many(self, sql, rows, idempotent=False):
+        return self._executemany(sql, rows, idempotent).rowcount
+
+    # Inserts rows with one multi-row INSERT and returns the id of the first.
+    # InnoDB assigns the rows of a single INSERT consecutive ids spaced by
+    # auto_increment_increment, also with interleaved autoinc locking.
+    def _insert_many(self, sql, rows):
+        return self._executemany(sql, rows).lastrowid
+
+    def connect_db(self, uri, prt, uname, pw):
+        delays = backoff_delays(
+            CONNECT_ATTEMPTS, self.reconnect_base_delay, CONNECT_MAX_DELAY
+        )
+        for delay in delays:
+            try:
+                logger.debug(f"Connecting to {uri}:{prt} with username {uname}")
+                self.conn = self.connection_factory(
                     user=uname, password=pw, host=uri, port=prt
                 )
 
@@ -72,35 +569,53 @@ class DbClient:
                     logger.error("Database does not exist")
                 else:
                     logger.error(err)
-                logger.debug("Sleeping 5 seconds before retry")
-                time.sleep(3)
+                DB_CONNECT_RETRIES.inc()
+                logger.debug(f"Sleeping {delay:.3f} seconds before retry")
+                time.sleep(delay)
 
         raise ConnectionError(f"Could not connect {uri}:{prt} with user {uname}")
 
-    def _init_database(self, db):
-        cursor = self.conn.cursor()
-        logger.info(f"Preparing database {db}...")
-        cursor.execute(f"CREATE DATABASE IF NOT EXISTS `{db}`")
-        cursor.execute(f"USE `{db}`")
-        logger.info("Preparing customer table...")
-        cursor.execute(CUSTOMER_TABLE)
-        cursor.execute(SEED_CUSTOMERS)
-        self.conn.commit()
-        cursor.close()
-        self.db = db
-        self.is_initialized = True
+    # Creates the database and applies the pending schema migrations, see
+    # migrations.py. The step can be skipped once the schema is current.
+    def init_schema(
+        self,
+        db,
+        chunk_size=MIGRATION_CHUNK_SIZE,
+        rows_per_second=MIGRATION_ROWS_PER_SECOND,
+    ):
+        return migrate_database(
+            self.conn, db, chunk_size=chunk_size, rows_per_second=rows_per_second
+        )
 
     def get_namespace(self):
         return self.namespace
 
     # Later we will check to see if this is None to see whether to use Vault or not
-    def init_vault(self, addr, token, namespace, path, key_name):
+    def init_vault(
+        self,
+        addr,
+        token,
+        namespace,
+        path,
+        key_name,
+        batch_size=TRANSIT_BATCH_SIZE,
+        timeout=VAULT_TIMEOUT,
+        pool_size=VAULT_POOL_SIZE,
+        verify=False,
+    ):
         if not addr or not token:
             logger.warning("Skipping initialization...")
             return
         logger.warning(f"Connecting to vault server: {addr}")
+        self.vault_stats = LatencyStats()
+        self.vault_timeout = timeout
         self.vault_client = hvac.Client(
-            url=addr, token=token, namespace=namespace, verify=False
+            url=addr,
+            token=token,
+            namespace=namespace,
+            verify=verify,
+            timeout=timeout,
+            session=create_session(pool_size, verify, self.vault_stats),
         )
         self.namespace = namespace
         if not self.vault_client.is_authenticated():
@@ -111,172 +626,722 @@ class DbClient:
             key_name = None
         self.key_name = key_name
         self.mount_point = path
+        self.batch_size = batch_size
         logger.debug(f"Initialized vault_client: {self.vault_client}")
 
+    def init_cache(self, max_size, ttl):
+        if max_size <= 0:
+            logger.info("Plaintext cache is disabled")
+            return
+        self.cache = PlaintextCache(max_size, ttl)
+        logger.info(f"Caching up to {max_size} plaintext values for {ttl}s")
+
+    # Encrypts fields locally with Transit data keys instead of a Transit call
+    # per field. Values written before stay readable in either mode.
+    def init_envelope(self, ttl=DATA_KEY_TTL):
+        if self.vault_client is None:
+            return
+        self.envelope = EnvelopeCipher(
+            generate_key=self._generate_data_key,
+            unwrap_key=self._unwrap_data_key,
+            store_key=self._store_data_key,
+            load_key=self._load_data_key,
+            ttl=ttl,
+        )
+        logger.info(f"Using envelope encryption with data keys rotated every {ttl}s")
+
+    def _generate_data_key(self):
+        with VAULT_OPERATION_DURATION.time("datakey"):
+            response = self.vault_client.secrets.transit.generate_data_key(
+                mount_point=self.mount_point, name=self.key_name, key_type="plaintext"
+            )
+        return (
+            base64.b64decode(response["data"]["plaintext"]),
+            response["data"]["ciphertext"],
+        )
+
+    def _unwrap_data_key(self, wrapped_key):
+        with VAULT_OPERATION_DURATION.time("decrypt"):
+            response = self.vault_client.secrets.transit.decrypt_data(
+                mount_point=self.mount_point,
+                name=self.key_name,
+                ciphertext=wrapped_key,
+            )
+        return base64.b64decode(response["data"]["plaintext"])
+
+    def _store_data_key(self, key_id, wrapped_key):
+        # INSERT IGNORE of the same key can run twice
+        self._write(INSERT_DATA_KEY_SQL, (key_id, wrapped_key), idempotent=True)
+
+    def _load_data_key(self, key_id):
+        rows = self._query(SELECT_DATA_KEY_SQL, (key_id,))
+        return rows[0][0] if rows else None
+
+    # Loads the blind index key, which is a Transit data key stored wrapped in
+    # data_keys. The first instance generates it, all others unwrap the stored
+    # key. The ssn_bidx and ccn_bidx columns are added by migration 3.
+    def init_blind_index(self):
+        if self.vault_client is None:
+            return
+        wrapped_key = self._load_data_key(BLIND_INDEX_KEY_ID)
+        if wrapped_key is None:
+            _, wrapped_key = self._generate_data_key()
+            self._store_data_key(BLIND_INDEX_KEY_ID, wrapped_key)
+            # another instance may have stored its key first
+            wrapped_key = self._load_data_key(BLIND_INDEX_KEY_ID)
+        self.blind_index = BlindIndex(self._unwrap_data_key(wrapped_key))
+        logger.info("Blind indexes for ssn and ccn are enabled")
+
+    def init_workers(self, workers):
+        if workers <= 0:
+            return
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="vault"
+        )
+        logger.info(f"Running Vault calls on {workers} worker threads")
+
+    def flush_cache(self):
+        if self.cache is not None:
+            self.cache.flush()
+
+    # call after raising min_decryption_version, ciphertexts of older key
+    # versions can no longer be decrypted and must not be served from cache
+    def retire_key_versions(self, min_decryption_version):
+        if self.cache is None:
+            return 0
+        return sum(
+            self.cache.evict_key_version(version)
+            for version in range(1, min_decryption_version)
+        )
+
+    def vault_latency_stats(self):
+        if self.vault_stats is None:
+            return {}
+        return self.vault_stats.stats()
+
+    def cache_stats(self):
+        if self.cache is None:
+            return {}
+        return self.cache.stats()
+
+    def cache_get(self, key):
+        if self.cache is None:
+            return None
+        return self.cache.get(key)
+
+    def cache_put(self, key, value):
+        if self.cache is not None:
+            self.cache.put(key, value)
+
     def vault_db_auth(self, path):
         try:
-            resp = self.vault_client.read(path)
-            self.username = resp["data"]["username"]
-            self.password = resp["data"]["password"]
-            logger.debug(
-                f"Retrieved username {self.username} and password {self.password} from Vault."
-            )
+            secret = self.read_db_credentials(path)
+            self.username = secret["data"]["username"]
+            self.password = secret["data"]["password"]
+            self.db_lease = secret
+            self.db_creds_path = path
+            logger.debug(f"Retrieved username {self.username} from Vault.")
         except Exception as e:
             logger.error(
                 f"An error occurred reading DB creds from path {path}.  Error: {e}"
             )
 
+    # Returns the secret with the credentials and their lease_id,
+    # lease_duration and renewable flag.
+    def read_db_credentials(self, path):
+        with VAULT_OPERATION_DURATION.time("creds_read"):
+            return self.vault_client.read(path)
+
+    # Extends the lease by increment seconds and returns the new lease. Vault
+    # caps the lease_duration at the max TTL of the role.
+    def renew_db_lease(self, lease_id, increment):
+        with VAULT_OPERATION_DURATION.time("lease_renew"):
+            return self.vault_client.sys.renew_lease(
+                lease_id=lease_id, increment=increment
+            )
+
+    # Switches to new database credentials without closing connections in
+    # use. New connections log in with them right away, pooled connections
+    # of the old user are replaced one by one as they are released.
+    def rotate_credentials(self, secret):
+        # a concurrent connect must not see the new user with the old password
+        with self._credentials_lock:
+            self.username = secret["data"]["username"]
+            self.password = secret["data"]["password"]
+        self.db_lease = secret
+        if self.replicas is not None:
+            self.replicas.rotate()
+        if self.pool is not None:
+            self.pool.rotate()
+            return
+        # waits for the unit of work on the shared connection, if any
+        with self._conn_lock:
+            if self.conn is not None:
+                self._drop_shared_connection(self.conn)
+
     # the data must be base64ed before being passed to encrypt
     def encrypt(self, value):
+        if self.envelope is not None:
+            return self.envelope.encrypt(value)
         try:
-            response = self.vault_client.secrets.transit.encrypt_data(
-                mount_point=self.mount_point,
-                name=self.key_name,
-                plaintext=base64.b64encode(value.encode()).decode("ascii"),
-            )
+            with VAULT_OPERATION_DURATION.time("encrypt"):
+                response = self.vault_client.secrets.transit.encrypt_data(
+                    mount_point=self.mount_point,
+                    name=self.key_name,
+                    plaintext=base64.b64encode(value.encode()).decode("ascii"),
+                )
             logger.debug(f"Response: {response}")
-            return response["data"]["ciphertext"]
+            ciphertext = response["data"]["ciphertext"]
+            self.cache_put(ciphertext, value)
+            return ciphertext
         except Exception as e:
             logger.error(f"There was an error encrypting the data: {e}")
             raise e
 
+    def _encrypt_chunk(self, plaintexts):
+        try:
+            with VAULT_OPERATION_DURATION.time("encrypt"):
+                response = self.vault_client.secrets.transit.encrypt_data(
+                    mount_point=self.mount_point,
+                    name=self.key_name,
+                    batch_input=[
+                        {"plaintext": base64.b64encode(p.encode()).decode("ascii")}
+                        for p in plaintexts
+                    ],
+                )
+            batch_results = response["data"]["batch_results"]
+        except Exception as e:
+            logger.error(f"There was an error encrypting the data: {e}")
+            return [None] * len(plaintexts)
+
+        results = []
+        for plaintext, item in zip(plaintexts, batch_results):
+            if item.get("error"):
+                logger.error(f"There was an error encrypting the data: {item['error']}")
+                results.append(None)
+                continue
+            self.cache_put(item["ciphertext"], plaintext)
+            results.append(item["ciphertext"])
+        return results
+
+    def _envelope_encrypt(self, value):
+        try:
+            return self.envelope.encrypt(value)
+        except Exception as e:
+            logger.error(f"There was an error encrypting the data: {e}")
+            return None
+
+    def _envelope_decrypt(self, value):
+        try:
+            if self.envelope is None:
+                raise ValueError("envelope encryption is not enabled")
+            return self.envelope.decrypt(value)
+        except Exception as e:
+            logger.error(f"There was an error decrypting the data: {e}")
+            return None
+
+    # Encrypts many values with Transit batch_input, failed items are None.
+    def encrypt_batch(self, values):
+        if self.envelope is not None:
+            return [self._envelope_encrypt(v) for v in values]
+        size = max(self.batch_size, 1)
+        chunks = [values[i : i + size] for i in range(0, len(values), size)]
+        results = []
+        for ciphertexts in self._map(self._encrypt_chunk, chunks):
+            results.extend(ciphertexts)
+        return results
+
+    def latest_key_version(self):
+        with VAULT_OPERATION_DURATION.time("read_key"):
+            response = self.vault_client.secrets.transit.read_key(
+                mount_point=self.mount_point, name=self.key_name
+            )
+        return response["data"]["latest_version"]
+
+    def _rewrap_chunk(self, ciphertexts):
+        try:
+            with VAULT_OPERATION_DURATION.time("rewrap"):
+                # ciphertext is required by hvac and ignored with batch_input
+                response = self.vault_client.secrets.transit.rewrap_data(
+                    mount_point=self.mount_point,
+                    name=self.key_name,
+                    ciphertext=None,
+                    batch_input=[{"ciphertext": c} for c in ciphertexts],
+                )
+            batch_results = response["data"]["batch_results"]
+        except Exception as e:
+            logger.error(f"There was an error rewrapping the data: {e}")
+            return [None] * len(ciphertexts)
+
+        results = []
+        for item in batch_results:
+            if item.get("error"):
+                logger.error(f"There was an error rewrapping the data: {item['error']}")
+                results.append(None)
+                continue
+            results.append(item["ciphertext"])
+        return results
+
+    # Rewraps Transit ciphertexts to the latest key version without exposing
+    # the plaintext, failed items are None.
+    def rewrap_batch(self, values):
+        size = max(self.batch_size, 1)
+        chunks = [values[i : i + size] for i in range(0, len(values), size)]
+        results = []
+        for ciphertexts in self._map(self._rewrap_chunk, chunks):
+            results.extend(ciphertexts)
+        return results
+
     # The data returned from Transit is base64 encoded so we decode it before returning
     def decrypt(self, value):
         # support unencrypted messages on first read
         logger.debug(f"Decrypting {value}")
+        if EnvelopeCipher.is_envelope(value):
+            if self.envelope is None:
+                raise ValueError("envelope encryption is not enabled")
+            return self.envelope.decrypt(value)
         if not value.startswith("vault:v"):
             return value
+        cached = self.cache_get(value)
+        if cached is not None:
+            return cached
         try:
-            response = self.vault_client.secrets.transit.decrypt_data(
-                mount_point=self.mount_point, name=self.key_name, ciphertext=value
-            )
-            logger.debug(f"Response: {response}")
+            with VAULT_OPERATION_DURATION.time("decrypt"):
+                response = self.vault_client.secrets.transit.decrypt_data(
+                    mount_point=self.mount_point, name=self.key_name, ciphertext=value
+                )
             plaintext = response["data"]["plaintext"]
-            logger.debug(f"Plaintext (base64 encoded): {plaintext}")
             decoded = base64.b64decode(plaintext).decode()
-            logger.debug(f"Decoded: {decoded}")
+            self.cache_put(value, decoded)
             return decoded
         except Exception as e:
             logger.error(f"There was an error encrypting the data: {e}")
             raise e
 
-    # Long running apps may expire the DB connection
-    def _execute_sql(self, sql, cursor):
+    def _execute_sql(self, sql, cursor, params=None):
+        with DB_QUERY_DURATION.time(statement_type(sql)):
+            cursor.execute(sql, params)
+
+    # Runs fn over items on the worker pool when one is configured, results
+    # keep the order of items.
+    def _map(self, fn, items):
+        if self.executor is None or len(items) < 2:
+            return list(map(fn, items))
+        return list(self.executor.map(fn, items))
+
+    def _decrypt_one(self, value):
+        try:
+            return self.decrypt(value)
+        except Exception:
+            return None
+
+    def _decrypt_chunk(self, ciphertexts):
+        if len(ciphertexts) == 1:
+            return [self._decrypt_one(ciphertexts[0])]
         try:
-            cursor.execute(sql)
-        except mysql.connector.errors.OperationalError as error:
-            if error[0] == 2006:
-                logger.error(f"Error encountered: {error}.  Reconnecting db...")
-                self.init_db(self.uri, self.port, self.username, self.password, self.db)
-                cursor = self.conn.cursor()
-                cursor.execute(sql)
-                return 0
-        return 1
+            with VAULT_OPERATION_DURATION.time("decrypt"):
+                response = self.vault_client.secrets.transit.decrypt_data(
+                    mount_point=self.mount_point,
+                    name=self.key_name,
+                    batch_input=[{"ciphertext": c} for c in ciphertexts],
+                )
+            batch_results = response["data"]["batch_results"]
+        except hvac.exceptions.InvalidRequest as e:
+            # Vault rejects the whole batch if a single item is invalid,
+            # retry item by item so that only the broken values fail
+            logger.warning(f"Batch decryption failed, retrying per item: {e}")
+            return [self._decrypt_one(c) for c in ciphertexts]
+        except Exception as e:
+            logger.error(f"There was an error decrypting the data: {e}")
+            return [None] * len(ciphertexts)
+
+        results = []
+        for ciphertext, item in zip(ciphertexts, batch_results):
+            if item.get("error"):
+                logger.error(f"There was an error decrypting the data: {item['error']}")
+                results.append(None)
+                continue
+            plaintext = base64.b64decode(item["plaintext"]).decode()
+            self.cache_put(ciphertext, plaintext)
+            results.append(plaintext)
+        return results
+
+    # Decrypts a list of values with as few Transit round trips as possible.
+    # Failed items are returned as None so that callers can skip just those.
+    # Without batching every value is its own request, with a worker pool
+    # the requests run concurrently.
+    def decrypt_batch(self, values):
+        results = [None] * len(values)
+        pending = []
+        for i, value in enumerate(values):
+            if EnvelopeCipher.is_envelope(value):
+                results[i] = self._envelope_decrypt(value)
+            elif not value.startswith("vault:v"):
+                results[i] = value
+            elif (cached := self.cache_get(value)) is not None:
+                results[i] = cached
+            else:
+                pending.append(i)
+
+        size = max(self.batch_size, 1)
+        chunks = [pending[i : i + size] for i in range(0, len(pending), size)]
+        decrypted = self._map(
+            self._decrypt_chunk, [[values[i] for i in chunk] for chunk in chunks]
+        )
+        for chunk, plaintexts in zip(chunks, decrypted):
+            for i, plaintext in zip(chunk, plaintexts):
+                results[i] = plaintext
+        return results
+
+    # Replaces the protected fields of all customers in place and returns the
+    # indexes of the customers which could not be fully decrypted. Fields
+    # which were not read are skipped.
+    def _decrypt_customers(self, customers):
+        slots = [
+            (i, field)
+            for i in range(len(customers))
+            for field in self.TRANSIT_FIELDS
+            if field in customers[i]
+        ]
+        plaintexts = self.decrypt_batch([customers[i][f] for i, f in slots])
+        failed = set()
+        for (i, field), plaintext in zip(slots, plaintexts):
+            if plaintext is None:
+                failed.add(i)
+            else:
+                customers[i][field] = plaintext
+        return failed
 
     def process_customer(self, row, raw=None):
-        r = {}
-        r["customer_number"] = row[0]
-        r["birth_date"] = row[1]
-        r["first_name"] = row[2]
-        r["last_name"] = row[3]
-        r["create_date"] = row[4]
-        r["ssn"] = row[5]
-        r["ccn"] = row[6]
-        r["address"] = row[7]
-        r["salary"] = row[8]
+        r = row_to_customer(row)
         if self.vault_client is not None and not raw:
-            r["birth_date"] = self.decrypt(r["birth_date"])
-            r["ssn"] = self.decrypt(r["ssn"])
-            r["ccn"] = self.decrypt(r["ccn"])
-            r["address"] = self.decrypt(r["address"])
-            r["salary"] = self.decrypt(r["salary"])
+            if self._decrypt_customers([r]):
+                raise ValueError(f"could not decrypt customer {r['customer_number']}")
         return r
 
-    def get_customer_records(self, num=None, raw=None):
-        if num is None:
-            num = 50
-        statement = f"SELECT * FROM `customers` LIMIT {num}"
-        cursor = self.conn.cursor()
-        self._execute_sql(statement, cursor)
+    def process_customers(self, rows, raw=None, fields=RECORD_FIELDS):
+        customers = [row_to_customer(row, fields) for row in rows]
+        if self.vault_client is None or raw:
+            return customers
+        failed = self._decrypt_customers(customers)
         results = []
-        for row in cursor:
-            try:
-                r = self.process_customer(row, raw)
-                results.append(r)
-            except Exception as e:
-                logger.error(f"There was an error retrieving the record: {e}")
+        for i, r in enumerate(customers):
+            if i in failed:
+                logger.error(
+                    f"There was an error retrieving the record {r['customer_number']}"
+                )
+                continue
+            results.append(r)
         return results
 
-    def get_customer_record(self, cid):
-        statement = f"SELECT * FROM `customers` WHERE cust_no = {cid}"
-        cursor = self.conn.cursor()
-        self._execute_sql(statement, cursor)
-        results = []
-        for row in cursor:
-            try:
-                r = self.process_customer(row)
-                results.append(r)
-            except Exception as e:
-                logger.error(f"There was an error retrieving the record: {e}")
+    # With fields only those columns are read and only the protected ones
+    # among them are decrypted.
+    def get_customer_records(self, num=None, raw=None, fields=None):
+        if num is None:
+            num = 50
+        fields = select_fields(fields)
+        rows = self._query(
+            select_sql(SELECT_CUSTOMERS_SQL, fields), (int(num),), replica=True
+        )
+        return self.process_customers(rows, raw, fields)
 
-        return results
+    # Streams customers ordered by cust_no, starting after the given cust_no,
+    # or the customers created in a date range, see stream_query. Rows are
+    # fetched by keyset pagination in chunks of chunk_size rows and every
+    # chunk is decrypted with batched Vault calls and yielded as a list, so
+    # memory does not grow with the number of rows.
+    def iter_customer_chunks(
+        self,
+        after=None,
+        limit=None,
+        raw=None,
+        fields=None,
+        created_from=None,
+        created_before=None,
+        chunk_size=STREAM_CHUNK_SIZE,
+    ):
+        fields = select_fields(fields)
+        after_created_at = None
+        if after is not None and (created_from or created_before):
+            rows = self._query(SELECT_CREATED_AT_SQL, (after,), replica=True)
+            after_created_at = rows[0][0] if rows else None
+        sql, bounds, last = stream_query(
+            fields, after, created_from, created_before, after_created_at
+        )
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = chunk_size
+            if remaining is not None:
+                size = min(size, remaining)
+            rows = self._query(sql, stream_params(bounds, last, size), replica=True)
+            if not rows:
+                return
+            last = stream_position(rows[-1], last)
+            if remaining is not None:
+                remaining -= len(rows)
+            yield self.process_customers(rows, raw, fields)
+            if len(rows) < size:
+                return
 
-    def get_insert_sql(self, record) -> str:
-        if self.vault_client is None and self.key_name is None:
-            return f"""INSERT INTO `customers` (`birth_date`, `first_name`, `last_name`, `create_date`, `social_security_number`, `credit_card_number`, `address`, `salary`)
-                            VALUES  ("{record["birth_date"]}",
-                            "{record["first_name"]}",
-                            "{record["last_name"]}",
-                            "{record["create_date"]}",
-                            "{record["ssn"]}",
-                            "{record["ccn"]}",
-                            "{record["address"]}",
-                            "{record["salary"]}");"""
-
-        return f"""INSERT INTO `customers` (`birth_date`, `first_name`, `last_name`, `create_date`, `social_security_number`, `credit_card_number`, `address`, `salary`)
-                        VALUES  ("{self.encrypt(record["birth_date"])}",
-                        "{record["first_name"]}",
-                        "{record["last_name"]}",
-                        "{record["create_date"]}",
-                        "{self.encrypt(record["ssn"])}",
-                        "{self.encrypt(record["ccn"])}",
-                        "{self.encrypt(record["address"])}",
-                        "{self.encrypt(record["salary"])}");"""
+    # iter_customer_chunks one customer at a time
+    def iter_customer_records(
+        self,
+        after=None,
+        limit=None,
+        raw=None,
+        fields=None,
+        created_from=None,
+        created_before=None,
+    ):
+        for customers in self.iter_customer_chunks(
+            after, limit, raw, fields, created_from, created_before
+        ):
+            yield from customers
 
-    def insert_customer_record(self, record):
-        statement = self.get_insert_sql(record)
-        logger.debug(f"SQL Statement: {statement}")
-        cursor = self.conn.cursor()
-        self._execute_sql(statement, cursor)
-        self.conn.commit()
-        return self.get_customer_records()
-
-    def get_update_sql(self, record) -> str:
+    def get_customer_record(self, cid, fields=None):
+        fields = select_fields(fields)
+        rows = self._query(
+            select_sql(SELECT_CUSTOMER_SQL, fields), (int(cid),), replica=True
+        )
+        return self.process_customers(rows, fields=fields)
+
+    # Protects one field of all records with batched calls, records which
+    # could not be protected are recorded in errors by their index.
+    def _protect_field(self, records, rows, errors, field, protect):
+        column = CUSTOMER_FIELDS.index(field)
+        protected = protect([r[field] for r in records])
+        for i, value in enumerate(protected):
+            if value is None:
+                errors[i] = f"could not protect {field}"
+            else:
+                rows[i][column] = value
+
+    # Returns the insert parameters of all records with their protected fields
+    # encrypted and the errors of records which could not be protected.
+    def protect_records(self, records):
+        rows = [
+            [r[f] for f in CUSTOMER_FIELDS] + [parse_create_date(r["create_date"])]
+            for r in records
+        ]
+        errors = {}
         if self.vault_client is None:
-            return f"""UPDATE `customers`
-                       SET birth_date = "{record["birth_date"]}",
-                       first_name = "{record["first_name"]}",
-                       last_name = "{record["last_name"]}",
-                       social_security_number = "{record["ssn"]}",
-                       credit_card_number = "{record["ccn"]}",
-                       address = "{record["address"]}",
-                       salary = "{record["salary"]}"
-                       WHERE cust_no = {record["cust_no"]};"""
-
-        return f"""UPDATE `customers`
-                       SET birth_date = "{self.encrypt(record["birth_date"])}",
-                       first_name = "{record["first_name"]}",
-                       last_name = "{record["last_name"]}",
-                       social_security_number = "{self.encrypt(record["ssn"])}",
-                       credit_card_number = "{self.encrypt(record["ccn"])}",
-                       address = "{self.encrypt(record["address"])}",
-                       salary = "{self.encrypt(record["salary"])}"
-                       WHERE cust_no = {record["cust_no"]};"""
+            return rows, errors
+        # all fields of all records share the same batched Transit calls
+        slots = [
+            (i, field) for i in range(len(records)) for field in self.TRANSIT_FIELDS
+        ]
+        ciphertexts = self.encrypt_batch([records[i][f] for i, f in slots])
+        for (i, field), ciphertext in zip(slots, ciphertexts):
+            if ciphertext is None:
+                errors[i] = f"could not protect {field}"
+            else:
+                rows[i][CUSTOMER_FIELDS.index(field)] = ciphertext
+        return rows, errors
+
+    # Returns the protected column values of a single record by field name.
+    def _protect_record(self, record):
+        rows, errors = self.protect_records([{"create_date": "", **record}])
+        if errors:
+            raise ValueError(errors[0])
+        return dict(zip(INSERT_FIELDS, rows[0]))
+
+    # stored fields which decrypt to their plaintext, the blind indexes of
+    # other fields can only be computed on write
+    def recoverable_fields(self):
+        return tuple(BLIND_INDEX_COLUMNS)
+
+    # Returns the blind index values of a record in BLIND_INDEX_COLUMNS order,
+    # None for fields which are not given, or nothing while disabled.
+    def blind_index_values(self, record, fields=tuple(BLIND_INDEX_COLUMNS)):
+        if self.blind_index is None:
+            return ()
+        return tuple(
+            self.blind_index.compute(field, record[field])
+            if field in fields and record.get(field) is not None
+            else None
+            for field in BLIND_INDEX_COLUMNS
+        )
+
+    # Registers fn to be called after customers were inserted or updated,
+    # for example to invalidate cached responses.
+    def add_write_listener(self, fn):
+        self.write_listeners = self.write_listeners + (fn,)
+
+    def _customers_changed(self):
+        for fn in self.write_listeners:
+            fn()
+
+    # Coalesces concurrent insert_customer_record calls into multi-row
+    # INSERTs committed together, see GroupCommitter.
+    def init_group_commit(
+        self,
+        max_size=GROUP_COMMIT_SIZE,
+        max_delay=GROUP_COMMIT_DELAY,
+        queue_size=GROUP_COMMIT_QUEUE_SIZE,
+    ):
+        self.auto_increment_increment = self._query(AUTO_INCREMENT_INCREMENT_SQL)[0][0]
+        self.group_commit = GroupCommitter(
+            self.insert_customer_batch,
+            max_size=max_size,
+            max_delay=max_delay,
+            queue_size=queue_size,
+        )
+        self.group_commit.start()
+        logger.info(
+            f"Group commit of up to {max_size} inserts after at most {max_delay}s"
+        )
+
+    def insert_customer_record(self, record):
+        if self.group_commit is not None:
+            return self.group_commit.submit(record)
+        values = self._protect_record(record)
+        statement = INSERT_SQL if self.blind_index is None else INSERT_BLIND_INDEX_SQL
+        # not retried, the row may have been inserted before the connection
+        # was lost
+        cust_no = self._write(
+            statement,
+            tuple(values[f] for f in INSERT_FIELDS) + self.blind_index_values(record),
+        )
+        self._customers_changed()
+        return [written_customer(cust_no, record, record["create_date"])]
+
+    # Inserts records with one multi-row INSERT in a single transaction and
+    # returns for every record its written customer, like
+    # insert_customer_record, or the exception which prevented the insert.
+    # The protected fields of all records share batched Vault calls.
+    def insert_customer_batch(self, records):
+        results = [None] * len(records)
+        valid = []
+        for i, record in enumerate(records):
+            missing = [f for f in CUSTOMER_FIELDS if f not in record]
+            if missing:
+                results[i] = KeyError(missing[0])
+            else:
+                valid.append(i)
+        rows, errors = self.protect_records([records[i] for i in valid])
+        pending = []
+        for n, i in enumerate(valid):
+            if n in errors:
+                results[i] = ValueError(errors[n])
+            else:
+                pending.append((i, rows[n] + list(self.blind_index_values(records[i]))))
+        if not pending:
+            return results
+        statement = INSERT_SQL if self.blind_index is None else INSERT_BLIND_INDEX_SQL
+        try:
+            first = self._insert_many(statement, [row for _, row in pending])
+            cust_nos = [
+                first + n * self.auto_increment_increment for n in range(len(pending))
+            ]
+        except mysql.connector.Error as e:
+            if is_connection_lost(e) or len(pending) == 1:
+                for i, _ in pending:
+                    results[i] = e
+                return results
+            # a single bad row fails the whole INSERT, insert the rows one by
+            # one so that only that record fails
+            logger.warning(f"Batch insert failed, inserting row by row: {e}")
+            cust_nos = []
+            for i, row in pending:
+                try:
+                    cust_nos.append(self._write(statement, tuple(row)))
+                except mysql.connector.Error as err:
+                    results[i] = err
+                    cust_nos.append(None)
+        for (i, _), cust_no in zip(pending, cust_nos):
+            if cust_no is not None:
+                results[i] = [
+                    written_customer(cust_no, records[i], records[i]["create_date"])
+                ]
+        self._customers_changed()
+        return results
+
+    # Inserts all records in a single transaction with one multi-row INSERT
+    # and returns an error message per record index which was not inserted.
+    # Like a group commit, a failed INSERT is retried row by row, so that only
+    # the bad rows fail.
+    def insert_customer_records(self, records):
+        return {
+            i: str(result)
+            for i, result in enumerate(self.insert_customer_batch(records))
+            if isinstance(result, Exception)
+        }
 
     def update_customer_record(self, record):
-        statement = self.get_update_sql(record)
-        logger.debug(f"Sql Statement: {statement}")
-        cursor = self.conn.cursor()
-        self._execute_sql(statement, cursor)
-        self.conn.commit()
-        return self.get_customer_records()
+        values = self._protect_record(record)
+        statement = UPDATE_SQL if self.blind_index is None else UPDATE_BLIND_INDEX_SQL
+        # setting all columns by primary key can be repeated
+        self._write(
+            statement,
+            tuple(values[f] for f in UPDATE_FIELDS)
+            + self.blind_index_values(record)
+            + (int(record["cust_no"]),),
+            idempotent=True,
+        )
+        self._customers_changed()
+        # create_date is not part of the update, but stored in plaintext
+        rows = self._query(SELECT_CREATE_DATE_SQL, (int(record["cust_no"]),))
+        if not rows:
+            return []
+        return [written_customer(record["cust_no"], record, rows[0][0])]
+
+    # Finds customers by ssn or ccn with one blind index probe, only the
+    # matching rows are decrypted.
+    def find_customers(self, field, value):
+        if self.blind_index is None:
+            raise ValueError("blind indexes are not enabled")
+        rows = self._query(
+            SELECT_BY_BLIND_INDEX_SQL[field],
+            (self.blind_index.compute(field, value),),
+            replica=True,
+        )
+        return self.process_customers(rows)
+
+    def get_unindexed_rows(self, after, size):
+        return self._query(SELECT_UNINDEXED_SQL, (after, size))
+
+    # Every update holds (cust_no, stored (ssn, ccn), blind index values).
+    def update_blind_indexes(self, updates):
+        if not updates:
+            return 0
+        return self._write_many(
+            UPDATE_BLIND_INDEXES_SQL,
+            [(*indexes, cust_no, *stored) for cust_no, stored, indexes in updates],
+            idempotent=True,
+        )
+
+    def get_checkpoint(self, job):
+        rows = self._query(SELECT_CHECKPOINT_SQL, (job,))
+        return rows[0][0] if rows else 0
+
+    def save_checkpoint(self, job, position):
+        self._write(SAVE_CHECKPOINT_SQL, (job, position), idempotent=True)
+
+    # Returns cust_no and the stored values of the Transit protected columns
+    # of the next rows after the given cust_no.
+    def get_protected_rows(self, after, size):
+        columns = ", ".join(f"`{FIELD_COLUMNS[f]}`" for f in self.TRANSIT_FIELDS)
+        statement = (
+            f"SELECT cust_no, {columns} FROM `customers` "
+            "WHERE cust_no > %s ORDER BY cust_no LIMIT %s"
+        )
+        return self._query(statement, (after, size))
+
+    # Replaces the Transit protected columns of many rows. Every update holds
+    # (cust_no, old values, new values) and only applies while the row still
+    # has the old values, so concurrent writes are never overwritten.
+    def update_protected_rows(self, updates):
+        if not updates:
+            return 0
+        fields = self.TRANSIT_FIELDS
+        assignments = ", ".join(f"`{FIELD_COLUMNS[f]}` = %s" for f in fields)
+        conditions = " AND ".join(f"`{FIELD_COLUMNS[f]}` = %s" for f in fields)
+        statement = (
+            f"UPDATE `customers` SET {assignments} WHERE cust_no = %s AND {conditions}"
+        )
+        # rows only match their old values, a repeated update is a no-op
+        return self._write_many(
+            statement,
+            [(*new, cust_no, *old) for cust_no, old, new in updates],
+            idempotent=True,
+        )
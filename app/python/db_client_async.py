@@ -0,0 +1,561 @@
+import asyncio
+import base64
+import logging
+import time
+
+import aiomysql
+import httpx
+
+from blind_index import BLIND_INDEX_KEY_ID, BlindIndex
+from cache import PlaintextCache
+from db_client import (
+    CUSTOMER_FIELDS,
+    INSERT_BLIND_INDEX_SQL,
+    INSERT_DATA_KEY_SQL,
+    INSERT_FIELDS,
+    INSERT_SQL,
+    RECORD_FIELDS,
+    SELECT_BY_BLIND_INDEX_SQL,
+    SELECT_CREATE_DATE_SQL,
+    SELECT_CREATED_AT_SQL,
+    SELECT_CUSTOMER_SQL,
+    SELECT_CUSTOMERS_SQL,
+    SELECT_DATA_KEY_SQL,
+    STREAM_CHUNK_SIZE,
+    TRANSIT_BATCH_SIZE,
+    UPDATE_BLIND_INDEX_SQL,
+    UPDATE_FIELDS,
+    UPDATE_SQL,
+    row_to_customer,
+    select_fields,
+    select_sql,
+    stream_params,
+    stream_position,
+    stream_query,
+    written_customer,
+)
+from db_client import DbClient as BlockingDbClient
+from db_retry import (
+    CONNECT_ATTEMPTS,
+    CONNECT_MAX_DELAY,
+    RECONNECT_BASE_DELAY,
+    backoff_delays,
+)
+from envelope import EnvelopeCipher
+from metrics import (
+    DB_CONNECT_RETRIES,
+    DB_QUERY_DURATION,
+    VAULT_OPERATION_DURATION,
+    statement_type,
+)
+from migrations import parse_create_date
+from vault_http import VAULT_POOL_SIZE, VAULT_TIMEOUT, LatencyStats
+
+# connections of the async pool when [DATABASE] PoolSize is 0, a single
+# connection would serialize all in-flight requests
+ASYNC_POOL_SIZE = 10
+
+logger = logging.getLogger(__name__)
+
+
+# DbClient for the ASGI app. MySQL is reached through an aiomysql pool and
+# Vault through an httpx.AsyncClient, so a request waiting on I/O does not
+# hold a thread. Independent Vault calls of a request run concurrently.
+class DbClient:
+    pool: aiomysql.Pool = None
+    uri: str = None
+    port: int = None
+    username: str = None
+    password: str = None
+    db: str = None
+
+    vault_client: httpx.AsyncClient = None
+    vault_stats: LatencyStats = None
+    key_name: str = None
+    mount_point: str = None
+    namespace: str = None
+    batch_size: int = TRANSIT_BATCH_SIZE
+    cache: PlaintextCache = None
+    blind_index: BlindIndex = None
+    is_initialized: bool = False
+
+    # customer fields which are protected with Transit
+    TRANSIT_FIELDS = BlockingDbClient.TRANSIT_FIELDS
+
+    # the plaintext cache and the record helpers do no I/O, they are shared
+    # with the blocking client
+    blind_index_values = BlockingDbClient.blind_index_values
+    recoverable_fields = BlockingDbClient.recoverable_fields
+    init_cache = BlockingDbClient.init_cache
+    flush_cache = BlockingDbClient.flush_cache
+    retire_key_versions = BlockingDbClient.retire_key_versions
+    vault_latency_stats = BlockingDbClient.vault_latency_stats
+    cache_stats = BlockingDbClient.cache_stats
+    cache_get = BlockingDbClient.cache_get
+    cache_put = BlockingDbClient.cache_put
+
+    async def init_db(
+        self,
+        uri,
+        prt,
+        uname,
+        pw,
+        db,
+        pool_size=0,
+        pool_max_lifetime=1800,
+        init_schema=True,
+    ):
+        self.uri = uri
+        self.port = int(prt)
+        self.username = uname
+        self.password = pw
+        if init_schema:
+            await self.init_schema(db)
+        self.pool = await self._create_pool(
+            db, pool_size if pool_size > 0 else ASYNC_POOL_SIZE, pool_max_lifetime
+        )
+        self.db = db
+        self.is_initialized = True
+        logger.info("database is initialized")
+
+    # Creates the pool, retrying with the backoff of the blocking client
+    # while MySQL does not accept connections yet.
+    async def _create_pool(self, db, maxsize, pool_recycle):
+        delays = backoff_delays(
+            CONNECT_ATTEMPTS, RECONNECT_BASE_DELAY, CONNECT_MAX_DELAY
+        )
+        for delay in delays:
+            try:
+                logger.debug(f"Connecting to {self.uri}:{self.port}")
+                return await aiomysql.create_pool(
+                    host=self.uri,
+                    port=self.port,
+                    user=self.username,
+                    password=self.password,
+                    db=db,
+                    minsize=1,
+                    maxsize=maxsize,
+                    pool_recycle=pool_recycle,
+                    autocommit=True,
+                )
+            except aiomysql.Error as err:
+                logger.error(err)
+                DB_CONNECT_RETRIES.inc()
+                logger.debug(f"Sleeping {delay:.3f} seconds before retry")
+                await asyncio.sleep(delay)
+
+        raise ConnectionError(
+            f"Could not connect {self.uri}:{self.port} with user {self.username}"
+        )
+
+    # Migrations run once before serving with the blocking driver, in a
+    # thread so that the event loop is not blocked, see migrations.py.
+    async def init_schema(self, db):
+        await asyncio.to_thread(self._migrate, db)
+
+    def _migrate(self, db):
+        client = BlockingDbClient()
+        client.connect_db(self.uri, self.port, self.username, self.password)
+        try:
+            return client.init_schema(db)
+        finally:
+            client.conn.close()
+
+    async def _fetch(self, sql, params=None):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                with DB_QUERY_DURATION.time(statement_type(sql)):
+                    await cursor.execute(sql, params)
+                return await cursor.fetchall()
+
+    # Runs a write and returns the id of the inserted row. With many, params
+    # holds the parameters of every row and is sent as one multi-row INSERT.
+    async def _write(self, sql, params, many=False):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                with DB_QUERY_DURATION.time(statement_type(sql)):
+                    if many:
+                        await cursor.executemany(sql, params)
+                    else:
+                        await cursor.execute(sql, params)
+                return cursor.lastrowid
+
+    async def close(self):
+        if self.vault_client is not None:
+            await self.vault_client.aclose()
+        if self.pool is not None:
+            self.pool.close()
+            await self.pool.wait_closed()
+
+    def get_namespace(self):
+        return self.namespace
+
+    async def init_vault(
+        self,
+        addr,
+        token,
+        namespace,
+        path,
+        key_name,
+        batch_size=TRANSIT_BATCH_SIZE,
+        timeout=VAULT_TIMEOUT,
+        pool_size=VAULT_POOL_SIZE,
+        verify=False,
+    ):
+        if not addr or not token:
+            logger.warning("Skipping initialization...")
+            return
+        logger.warning(f"Connecting to vault server: {addr}")
+        headers = {"X-Vault-Token": token}
+        if namespace:
+            headers["X-Vault-Namespace"] = namespace
+        self.vault_stats = LatencyStats()
+        self.vault_client = httpx.AsyncClient(
+            base_url=addr,
+            headers=headers,
+            timeout=timeout,
+            verify=verify,
+            limits=httpx.Limits(
+                max_connections=pool_size, max_keepalive_connections=pool_size
+            ),
+        )
+        self.namespace = namespace
+        try:
+            await self._vault("lookup", "GET", "auth/token/lookup-self")
+        except Exception as e:
+            await self.vault_client.aclose()
+            self.vault_client = None
+            logger.error(f"could not authenticate to vault: {e}")
+            return
+        self.key_name = key_name or None
+        self.mount_point = path
+        self.batch_size = batch_size
+        logger.debug(f"Initialized vault_client: {addr}")
+
+    async def _vault(self, operation, method, path, payload=None):
+        started = time.perf_counter()
+        with VAULT_OPERATION_DURATION.time(operation):
+            response = await self.vault_client.request(
+                method, f"/v1/{path}", json=payload
+            )
+        self.vault_stats.observe(f"{method} {path}", time.perf_counter() - started)
+        response.raise_for_status()
+        return response.json()["data"] if response.content else None
+
+    async def vault_db_auth(self, path):
+        try:
+            data = await self._vault("creds_read", "GET", path)
+            self.username = data["username"]
+            self.password = data["password"]
+            logger.debug(f"Retrieved username {self.username} from Vault.")
+        except Exception as e:
+            logger.error(
+                f"An error occurred reading DB creds from path {path}.  Error: {e}"
+            )
+
+    # Loads the index key which the blocking client stores, both clients
+    # compute the same indexes.
+    async def init_blind_index(self):
+        if self.vault_client is None:
+            return
+        rows = await self._fetch(SELECT_DATA_KEY_SQL, (BLIND_INDEX_KEY_ID,))
+        if not rows:
+            data = await self._vault(
+                "datakey",
+                "POST",
+                f"{self.mount_point}/datakey/plaintext/{self.key_name}",
+            )
+            await self._write(
+                INSERT_DATA_KEY_SQL, (BLIND_INDEX_KEY_ID, data["ciphertext"])
+            )
+            # another instance may have stored its key first
+            rows = await self._fetch(SELECT_DATA_KEY_SQL, (BLIND_INDEX_KEY_ID,))
+        data = await self._vault(
+            "decrypt",
+            "POST",
+            f"{self.mount_point}/decrypt/{self.key_name}",
+            {"ciphertext": rows[0][0]},
+        )
+        self.blind_index = BlindIndex(base64.b64decode(data["plaintext"]))
+        logger.info("Blind indexes for ssn and ccn are enabled")
+
+    def _chunks(self, values):
+        size = max(self.batch_size, 1)
+        return [values[i : i + size] for i in range(0, len(values), size)]
+
+    async def _encrypt_chunk(self, plaintexts):
+        try:
+            data = await self._vault(
+                "encrypt",
+                "POST",
+                f"{self.mount_point}/encrypt/{self.key_name}",
+                {
+                    "batch_input": [
+                        {"plaintext": base64.b64encode(p.encode()).decode("ascii")}
+                        for p in plaintexts
+                    ]
+                },
+            )
+        except Exception as e:
+            logger.error(f"There was an error encrypting the data: {e}")
+            return [None] * len(plaintexts)
+
+        results = []
+        for plaintext, item in zip(plaintexts, data["batch_results"]):
+            if item.get("error"):
+                logger.error(f"There was an error encrypting the data: {item['error']}")
+                results.append(None)
+                continue
+            self.cache_put(item["ciphertext"], plaintext)
+            results.append(item["ciphertext"])
+        return results
+
+    # Encrypts many values with Transit batch_input, the chunks are sent
+    # concurrently and failed items are None.
+    async def encrypt_batch(self, values):
+        results = []
+        for ciphertexts in await asyncio.gather(
+            *(self._encrypt_chunk(chunk) for chunk in self._chunks(values))
+        ):
+            results.extend(ciphertexts)
+        return results
+
+    async def _decrypt_one(self, value):
+        try:
+            data = await self._vault(
+                "decrypt",
+                "POST",
+                f"{self.mount_point}/decrypt/{self.key_name}",
+                {"ciphertext": value},
+            )
+        except Exception as e:
+            logger.error(f"There was an error decrypting the data: {e}")
+            return None
+        plaintext = base64.b64decode(data["plaintext"]).decode()
+        self.cache_put(value, plaintext)
+        return plaintext
+
+    async def _decrypt_chunk(self, ciphertexts):
+        if len(ciphertexts) == 1:
+            return [await self._decrypt_one(ciphertexts[0])]
+        try:
+            data = await self._vault(
+                "decrypt",
+                "POST",
+                f"{self.mount_point}/decrypt/{self.key_name}",
+                {"batch_input": [{"ciphertext": c} for c in ciphertexts]},
+            )
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 400:
+                logger.error(f"There was an error decrypting the data: {e}")
+                return [None] * len(ciphertexts)
+            # Vault rejects the whole batch if a single item is invalid,
+            # retry item by item so that only the broken values fail
+            logger.warning(f"Batch decryption failed, retrying per item: {e}")
+            return await asyncio.gather(*(self._decrypt_one(c) for c in ciphertexts))
+        except Exception as e:
+            logger.error(f"There was an error decrypting the data: {e}")
+            return [None] * len(ciphertexts)
+
+        results = []
+        for ciphertext, item in zip(ciphertexts, data["batch_results"]):
+            if item.get("error"):
+                logger.error(f"There was an error decrypting the data: {item['error']}")
+                results.append(None)
+                continue
+            plaintext = base64.b64decode(item["plaintext"]).decode()
+            self.cache_put(ciphertext, plaintext)
+            results.append(plaintext)
+        return results
+
+    # Decrypts a list of values, the Transit chunks of cache misses are sent
+    # concurrently. Failed items are returned as None.
+    async def decrypt_batch(self, values):
+        results = [None] * len(values)
+        pending = []
+        for i, value in enumerate(values):
+            if EnvelopeCipher.is_envelope(value):
+                logger.error("Envelope encrypted values need the blocking app")
+            elif not value.startswith("vault:v"):
+                results[i] = value
+            elif (cached := self.cache_get(value)) is not None:
+                results[i] = cached
+            else:
+                pending.append(i)
+
+        chunks = self._chunks(pending)
+        decrypted = await asyncio.gather(
+            *(self._decrypt_chunk([values[i] for i in chunk]) for chunk in chunks)
+        )
+        for chunk, plaintexts in zip(chunks, decrypted):
+            for i, plaintext in zip(chunk, plaintexts):
+                results[i] = plaintext
+        return results
+
+    # Replaces the protected fields of all customers in place and returns the
+    # indexes of the customers which could not be fully decrypted.
+    async def _decrypt_customers(self, customers):
+        slots = [
+            (i, field)
+            for i in range(len(customers))
+            for field in self.TRANSIT_FIELDS
+            if field in customers[i]
+        ]
+        plaintexts = await self.decrypt_batch([customers[i][f] for i, f in slots])
+        failed = set()
+        for (i, field), plaintext in zip(slots, plaintexts):
+            if plaintext is None:
+                failed.add(i)
+            else:
+                customers[i][field] = plaintext
+        return failed
+
+    async def process_customers(self, rows, raw=None, fields=RECORD_FIELDS):
+        customers = [row_to_customer(row, fields) for row in rows]
+        if self.vault_client is None or raw:
+            return customers
+        failed = await self._decrypt_customers(customers)
+        results = []
+        for i, r in enumerate(customers):
+            if i in failed:
+                logger.error(
+                    f"There was an error retrieving the record {r['customer_number']}"
+                )
+                continue
+            results.append(r)
+        return results
+
+    async def get_customer_records(self, num=None, raw=None, fields=None):
+        fields = select_fields(fields)
+        rows = await self._fetch(
+            select_sql(SELECT_CUSTOMERS_SQL, fields), (int(num or 50),)
+        )
+        return await self.process_customers(rows, raw, fields)
+
+    # Streams customers ordered by cust_no, starting after the given cust_no,
+    # or those of a date range, like the blocking client in chunks of
+    # STREAM_CHUNK_SIZE rows.
+    async def iter_customer_records(
+        self,
+        after=None,
+        limit=None,
+        raw=None,
+        fields=None,
+        created_from=None,
+        created_before=None,
+    ):
+        fields = select_fields(fields)
+        after_created_at = None
+        if after is not None and (created_from or created_before):
+            rows = await self._fetch(SELECT_CREATED_AT_SQL, (after,))
+            after_created_at = rows[0][0] if rows else None
+        sql, bounds, last = stream_query(
+            fields, after, created_from, created_before, after_created_at
+        )
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = STREAM_CHUNK_SIZE
+            if remaining is not None:
+                size = min(size, remaining)
+            rows = await self._fetch(sql, stream_params(bounds, last, size))
+            if not rows:
+                return
+            last = stream_position(rows[-1], last)
+            if remaining is not None:
+                remaining -= len(rows)
+            for customer in await self.process_customers(rows, raw, fields):
+                yield customer
+            if len(rows) < size:
+                return
+
+    async def get_customer_record(self, cid, fields=None):
+        fields = select_fields(fields)
+        rows = await self._fetch(select_sql(SELECT_CUSTOMER_SQL, fields), (int(cid),))
+        return await self.process_customers(rows, fields=fields)
+
+    async def find_customers(self, field, value):
+        if self.blind_index is None:
+            raise ValueError("blind indexes are not enabled")
+        rows = await self._fetch(
+            SELECT_BY_BLIND_INDEX_SQL[field],
+            (self.blind_index.compute(field, value),),
+        )
+        return await self.process_customers(rows)
+
+    # Returns the insert parameters of all records with their protected fields
+    # encrypted and the errors of records which could not be protected.
+    async def protect_records(self, records):
+        rows = [
+            [r[f] for f in CUSTOMER_FIELDS] + [parse_create_date(r["create_date"])]
+            for r in records
+        ]
+        errors = {}
+        if self.vault_client is None:
+            return rows, errors
+        slots = [
+            (i, field) for i in range(len(records)) for field in self.TRANSIT_FIELDS
+        ]
+        ciphertexts = await self.encrypt_batch([records[i][f] for i, f in slots])
+        for (i, field), ciphertext in zip(slots, ciphertexts):
+            if ciphertext is None:
+                errors[i] = f"could not protect {field}"
+            else:
+                rows[i][CUSTOMER_FIELDS.index(field)] = ciphertext
+        return rows, errors
+
+    async def _protect_record(self, record):
+        rows, errors = await self.protect_records([{"create_date": "", **record}])
+        if errors:
+            raise ValueError(errors[0])
+        return dict(zip(INSERT_FIELDS, rows[0]))
+
+    async def insert_customer_record(self, record):
+        values = await self._protect_record(record)
+        statement = INSERT_SQL if self.blind_index is None else INSERT_BLIND_INDEX_SQL
+        cust_no = await self._write(
+            statement,
+            tuple(values[f] for f in INSERT_FIELDS) + self.blind_index_values(record),
+        )
+        return [written_customer(cust_no, record, record["create_date"])]
+
+    # Inserts all records with one multi-row INSERT and returns an error
+    # message per record index which was not inserted. A failed INSERT is
+    # retried row by row, so that only the bad rows fail.
+    async def insert_customer_records(self, records):
+        rows, errors = await self.protect_records(records)
+        pending = [
+            (i, row + list(self.blind_index_values(records[i])))
+            for i, row in enumerate(rows)
+            if i not in errors
+        ]
+        if not pending:
+            return errors
+        statement = INSERT_SQL if self.blind_index is None else INSERT_BLIND_INDEX_SQL
+        try:
+            await self._write(statement, [row for _, row in pending], many=True)
+        except aiomysql.Error as e:
+            if len(pending) == 1:
+                errors[pending[0][0]] = str(e)
+                return errors
+            logger.warning(f"Batch insert failed, inserting row by row: {e}")
+            for i, row in pending:
+                try:
+                    await self._write(statement, tuple(row))
+                except aiomysql.Error as err:
+                    logger.error(f"There was an error inserting the record: {err}")
+                    errors[i] = str(err)
+        return errors
+
+    async def update_customer_record(self, record):
+        values = await self._protect_record(record)
+        statement = UPDATE_SQL if self.blind_index is None else UPDATE_BLIND_INDEX_SQL
+        await self._write(
+            statement,
+            tuple(values[f] for f in UPDATE_FIELDS)
+            + self.blind_index_values(record)
+            + (int(record["cust_no"]),),
+        )
+        rows = await self._fetch(SELECT_CREATE_DATE_SQL, (int(record["cust_no"]),))
+        if not rows:
+            return []
+        return [written_customer(record["cust_no"], record, rows[0][0])]
@@ -1,15 +1,28 @@
 import logging
 
+import hvac.exceptions
+
 from db_client import DbClient as TransitDBClient
+from metrics import VAULT_OPERATION_DURATION
 
 logger = logging.getLogger(__name__)
 
 
+# transformed values carry no prefix, so cache keys are scoped per role
+def transform_cache_key(mount_point, role, value):
+    return f"{mount_point}/{role}:{value}"
+
+
 class DbClient(TransitDBClient):
     transform_mount_point = None
     transform_masking_mount_point = None
     ssn_role = None
     ccn_role = None
+    ccn_decode = False
+    transform_headers = None
+
+    # ssn and ccn are protected with Transform instead
+    TRANSIT_FIELDS = ("birth_date", "address", "salary")
 
     # Later we will check to see if this is None to see whether to use Vault or not
     def init_transform(
@@ -18,38 +31,119 @@ class DbClient(TransitDBClient):
         transform_masking_path,
         ssn_role,
         ccn_role,
+        ccn_decode=False,
     ):
         self.transform_mount_point = transform_path
         self.transform_masking_mount_point = transform_masking_path
         self.ssn_role = ssn_role
         self.ccn_role = ccn_role
+        self.ccn_decode = ccn_decode
+        self.transform_headers = {
+            "X-Vault-Token": self.vault_client.token,
+            "X-Vault-Namespace": self.get_namespace(),
+            "Content-Type": "application/json",
+            "cache-control": "no-cache",
+        }
         logger.debug(f"Initialized transform: {self.vault_client}")
 
-    def encode_ssn(self, value):
+    def _transform(self, mount_point, operation, role, payload):
+        # transform not available in hvac, raw api call. The adapter joins
+        # the path to the Vault address itself.
+        url = f"/v1/{mount_point}/{operation}/{role}"
+        with VAULT_OPERATION_DURATION.time(operation):
+            response = self.vault_client.adapter.post(
+                url=url,
+                json=payload,
+                headers=self.transform_headers,
+                timeout=self.vault_timeout,
+            )
+        return response["data"]
+
+    def _transform_one(self, mount_point, operation, role, value):
         try:
-            # transform not available in hvac, raw api call
-            url = (
-                self.vault_client.url
-                + "/v1/"
-                + self.transform_mount_point
-                + "/encode/"
-                + self.ssn_role
+            return self._transform(
+                mount_point, operation, role, {"value": value, "transformation": role}
+            )[f"{operation}d_value"]
+        except Exception as e:
+            logger.error(f"There was an error during {operation}: {e}")
+        return None
+
+    def _transform_chunk(self, mount_point, operation, role, values):
+        if len(values) == 1:
+            return [self._transform_one(mount_point, operation, role, values[0])]
+        try:
+            data = self._transform(
+                mount_point,
+                operation,
+                role,
+                {"batch_input": [{"value": v, "transformation": role} for v in values]},
             )
-            headers = {
-                "X-Vault-Token": self.vault_client.token,
-                "X-Vault-Namespace": super().get_namespace(),
-                "Content-Type": "application/json",
-                "cache-control": "no-cache",
-            }
+            batch_results = data["batch_results"]
+        except hvac.exceptions.InvalidRequest as e:
+            # a single invalid value rejects the whole batch, retry item
+            # by item so that only the broken values fail
+            logger.warning(f"Batch {operation} failed, retrying per item: {e}")
+            return [
+                self._transform_one(mount_point, operation, role, v) for v in values
+            ]
+        except Exception as e:
+            logger.error(f"There was an error during {operation}: {e}")
+            return [None] * len(values)
+
+        results = []
+        for item in batch_results:
+            if item.get("error"):
+                logger.error(f"There was an error during {operation}: {item['error']}")
+                results.append(None)
+                continue
+            results.append(item[f"{operation}d_value"])
+        return results
+
+    # Runs a Transform encode or decode for many values with batch_input.
+    # Failed items are returned as None so that callers can handle just those.
+    def _transform_batch(self, mount_point, operation, role, values):
+        size = max(self.batch_size, 1)
+        chunks = [values[i : i + size] for i in range(0, len(values), size)]
+        results = []
+        for chunk_results in self._map(
+            lambda chunk: self._transform_chunk(mount_point, operation, role, chunk),
+            chunks,
+        ):
+            results.extend(chunk_results)
+        return results
+
+    # decodes values through the plaintext cache, only misses go to Vault
+    def _decode_batch(self, mount_point, role, values):
+        results = [None] * len(values)
+        pending = []
+        for i, value in enumerate(values):
+            key = transform_cache_key(mount_point, role, value)
+            cached = self.cache_get(key)
+            if cached is None:
+                pending.append(i)
+            else:
+                results[i] = cached
+        decoded = self._transform_batch(
+            mount_point, "decode", role, [values[i] for i in pending]
+        )
+        for i, value in zip(pending, decoded):
+            results[i] = value
+            self.cache_put(transform_cache_key(mount_point, role, values[i]), value)
+        return results
 
-            response = self.vault_client.adapter.post(
-                url=url,
-                json={"value": value, "transformation": self.ssn_role},
-                headers=headers,
-                timeout=300,
+    def encode_ssn(self, value):
+        try:
+            encoded = self._transform(
+                self.transform_mount_point,
+                "encode",
+                self.ssn_role,
+                {"value": value, "transformation": self.ssn_role},
+            )["encoded_value"]
+            self.cache_put(
+                transform_cache_key(self.transform_mount_point, self.ssn_role, encoded),
+                value,
             )
-            logger.debug(f"Response: {response.text}")
-            return response.json()["data"]["encoded_value"]
+            return encoded
         except Exception as e:
             logger.error(f"There was an error encrypting the data: {e}")
 
@@ -57,29 +151,12 @@ class DbClient(TransitDBClient):
 
     def encode_ccn(self, value):
         try:
-            # transform not available in hvac, raw api call
-            url = (
-                self.vault_client.url
-                + "/v1/"
-                + self.transform_masking_mount_point
-                + "/encode/"
-                + self.ccn_role
-            )
-            headers = {
-                "X-Vault-Token": self.vault_client.token,
-                "X-Vault-Namespace": self.get_namespace(),
-                "Content-Type": "application/json",
-                "cache-control": "no-cache",
-            }
-
-            response = self.vault_client.adapter.post(
-                url=url,
-                json={"value": value, "transformation": self.ccn_role},
-                headers=headers,
-                timeout=300,
-            )
-            logger.debug(f"Response: {response.text}")
-            return response.json()["data"]["encoded_value"]
+            return self._transform(
+                self.transform_masking_mount_point,
+                "encode",
+                self.ccn_role,
+                {"value": value, "transformation": self.ccn_role},
+            )["encoded_value"]
         except Exception as e:
             logger.error(f"There was an error encrypting the data: {e}")
 
@@ -88,77 +165,74 @@ class DbClient(TransitDBClient):
     def decode_ssn(self, value):
         # we're going to have funny stuff if ProtectRecords is false
         logger.debug(f"Decoding {value}")
+        key = transform_cache_key(self.transform_mount_point, self.ssn_role, value)
+        cached = self.cache_get(key)
+        if cached is not None:
+            return cached
         try:
-            # transform not available in hvac, raw api call
-            url = (
-                self.vault_client.url
-                + "/v1/"
-                + self.transform_mount_point
-                + "/decode/"
-                + self.ssn_role
-            )
-            headers = {
-                "X-Vault-Token": self.vault_client.token,
-                "X-Vault-Namespace": self.get_namespace(),
-                "Content-Type": "application/json",
-                "cache-control": "no-cache",
-            }
-
-            response = self.vault_client.adapter.post(
-                url=url,
-                json={"value": value, "transformation": self.ssn_role},
-                headers=headers,
-                timeout=300,
-            )
-            logger.debug(f"Response: {response.text}")
-            return response.json()["data"]["decoded_value"]
+            decoded = self._transform(
+                self.transform_mount_point,
+                "decode",
+                self.ssn_role,
+                {"value": value, "transformation": self.ssn_role},
+            )["decoded_value"]
+            self.cache_put(key, decoded)
+            return decoded
         except Exception as e:
             logger.error(f"There was an error decoding the data: {e}")
         return None
 
-    def process_customer(self, row, raw=None):
-        r = {}
-        r["customer_number"] = row[0]
-        r["birth_date"] = row[1]
-        r["first_name"] = row[2]
-        r["last_name"] = row[3]
-        r["create_date"] = row[4]
-        r["ssn"] = row[5]
-        r["ccn"] = row[6]
-        r["address"] = row[7]
-        r["salary"] = row[8]
-        if self.vault_client is not None and not raw:
-            r["birth_date"] = self.decrypt(r["birth_date"])
-            r["ssn"] = self.decode_ssn(r["ssn"])
-            r["address"] = self.decrypt(r["address"])
-            r["salary"] = self.decrypt(r["salary"])
-        return r
-
-    def get_insert_sql(self, record) -> str:
-        if self.vault_client is None:
-            return super().get_insert_sql(record)
-
-        return f"""INSERT INTO `customers` (`birth_date`, `first_name`, `last_name`, `create_date`,
-                    `social_security_number`, `credit_card_number`, `address`, `salary`)
-                            VALUES  ("{self.encrypt(record["birth_date"])}",
-                                     "{record["first_name"]}",
-                                     "{record["last_name"]}",
-                                     "{record["create_date"]}",
-                                     "{self.encode_ssn(record["ssn"])}",
-                                     "{self.encode_ccn(record["ccn"])}",
-                                     "{self.encrypt(record["address"])}",
-                                     "{self.encrypt(record["salary"])}");"""
-
-    def get_update_sql(self, record) -> str:
+    def decode_ssns(self, values):
+        return self._decode_batch(self.transform_mount_point, self.ssn_role, values)
+
+    # masking is one-way, so the stored ccns are returned unless the ccn role
+    # uses a reversible transformation
+    def decode_ccns(self, values):
+        if not self.ccn_decode:
+            return list(values)
+        decoded = self._decode_batch(
+            self.transform_masking_mount_point, self.ccn_role, values
+        )
+        return [d if d is not None else v for d, v in zip(decoded, values)]
+
+    # masked card numbers cannot be decoded, their blind index is only
+    # written together with the plaintext
+    def recoverable_fields(self):
+        return ("ssn", "ccn") if self.ccn_decode else ("ssn",)
+
+    # decodes field of all customers unless it was not read
+    def _decode_field(self, customers, field, decode):
+        if not customers or field not in customers[0]:
+            return
+        for r, value in zip(customers, decode([r[field] for r in customers])):
+            r[field] = value
+
+    def _decrypt_customers(self, customers):
+        failed = super()._decrypt_customers(customers)
+        self._decode_field(customers, "ssn", self.decode_ssns)
+        self._decode_field(customers, "ccn", self.decode_ccns)
+        return failed
+
+    def protect_records(self, records):
+        rows, errors = super().protect_records(records)
         if self.vault_client is None:
-            return super().get_update_sql(record)
-
-        return f"""UPDATE `customers`
-                    SET birth_date = "{self.encrypt(record["birth_date"])}", f
-                    irst_name = "{record["first_name"]}",
-                    last_name = "{record["last_name"]}",
-                    social_security_number = "{self.encode_ssn(record["ssn"])}",
-                    credit_card_number = "{self.encode_ccn(record["ccn"])}",
-                    address = "{self.encrypt(record["address"])}",
-                    salary = "{self.encrypt(record["salary"])}"
-                    WHERE cust_no = {record["cust_no"]};"""
+            return rows, errors
+        self._protect_field(
+            records,
+            rows,
+            errors,
+            "ssn",
+            lambda values: self._transform_batch(
+                self.transform_mount_point, "encode", self.ssn_role, values
+            ),
+        )
+        self._protect_field(
+            records,
+            rows,
+            errors,
+            "ccn",
+            lambda values: self._transform_batch(
+                self.transform_masking_mount_point, "encode", self.ccn_role, values
+            ),
+        )
+        return rows, errors
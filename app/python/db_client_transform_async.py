@@ -0,0 +1,173 @@
+import asyncio
+import logging
+
+import httpx
+
+from db_client import CUSTOMER_FIELDS
+from db_client_async import DbClient as TransitDBClient
+from db_client_transform import DbClient as BlockingTransformClient
+from db_client_transform import transform_cache_key
+
+logger = logging.getLogger(__name__)
+
+
+class DbClient(TransitDBClient):
+    transform_mount_point = None
+    transform_masking_mount_point = None
+    ssn_role = None
+    ccn_role = None
+    ccn_decode = False
+
+    # ssn and ccn are protected with Transform instead
+    TRANSIT_FIELDS = BlockingTransformClient.TRANSIT_FIELDS
+
+    recoverable_fields = BlockingTransformClient.recoverable_fields
+
+    def init_transform(
+        self,
+        transform_path,
+        transform_masking_path,
+        ssn_role,
+        ccn_role,
+        ccn_decode=False,
+    ):
+        self.transform_mount_point = transform_path
+        self.transform_masking_mount_point = transform_masking_path
+        self.ssn_role = ssn_role
+        self.ccn_role = ccn_role
+        self.ccn_decode = ccn_decode
+        logger.debug("Initialized transform")
+
+    async def _transform_one(self, mount_point, operation, role, value):
+        try:
+            data = await self._vault(
+                operation,
+                "POST",
+                f"{mount_point}/{operation}/{role}",
+                {"value": value, "transformation": role},
+            )
+            return data[f"{operation}d_value"]
+        except Exception as e:
+            logger.error(f"There was an error during {operation}: {e}")
+        return None
+
+    async def _transform_chunk(self, mount_point, operation, role, values):
+        if len(values) == 1:
+            return [await self._transform_one(mount_point, operation, role, values[0])]
+        try:
+            data = await self._vault(
+                operation,
+                "POST",
+                f"{mount_point}/{operation}/{role}",
+                {"batch_input": [{"value": v, "transformation": role} for v in values]},
+            )
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 400:
+                logger.error(f"There was an error during {operation}: {e}")
+                return [None] * len(values)
+            # a single invalid value rejects the whole batch, retry item
+            # by item so that only the broken values fail
+            logger.warning(f"Batch {operation} failed, retrying per item: {e}")
+            return await asyncio.gather(
+                *(self._transform_one(mount_point, operation, role, v) for v in values)
+            )
+        except Exception as e:
+            logger.error(f"There was an error during {operation}: {e}")
+            return [None] * len(values)
+
+        results = []
+        for item in data["batch_results"]:
+            if item.get("error"):
+                logger.error(f"There was an error during {operation}: {item['error']}")
+                results.append(None)
+                continue
+            results.append(item[f"{operation}d_value"])
+        return results
+
+    async def _transform_batch(self, mount_point, operation, role, values):
+        results = []
+        for chunk_results in await asyncio.gather(
+            *(
+                self._transform_chunk(mount_point, operation, role, chunk)
+                for chunk in self._chunks(values)
+            )
+        ):
+            results.extend(chunk_results)
+        return results
+
+    # decodes values through the plaintext cache, only misses go to Vault
+    async def _decode_batch(self, mount_point, role, values):
+        results = [None] * len(values)
+        pending = []
+        for i, value in enumerate(values):
+            key = transform_cache_key(mount_point, role, value)
+            cached = self.cache_get(key)
+            if cached is None:
+                pending.append(i)
+            else:
+                results[i] = cached
+        decoded = await self._transform_batch(
+            mount_point, "decode", role, [values[i] for i in pending]
+        )
+        for i, value in zip(pending, decoded):
+            results[i] = value
+            self.cache_put(transform_cache_key(mount_point, role, values[i]), value)
+        return results
+
+    async def decode_ssns(self, values):
+        return await self._decode_batch(
+            self.transform_mount_point, self.ssn_role, values
+        )
+
+    async def decode_ccns(self, values):
+        if not self.ccn_decode:
+            return list(values)
+        decoded = await self._decode_batch(
+            self.transform_masking_mount_point, self.ccn_role, values
+        )
+        return [d if d is not None else v for d, v in zip(decoded, values)]
+
+    async def _decode_field(self, customers, field, decode):
+        if not customers or field not in customers[0]:
+            return
+        for r, value in zip(customers, await decode([r[field] for r in customers])):
+            r[field] = value
+
+    # Transit fields, ssns and ccns are independent and decoded concurrently
+    async def _decrypt_customers(self, customers):
+        failed, _, _ = await asyncio.gather(
+            super()._decrypt_customers(customers),
+            self._decode_field(customers, "ssn", self.decode_ssns),
+            self._decode_field(customers, "ccn", self.decode_ccns),
+        )
+        return failed
+
+    def _apply_field(self, rows, errors, field, protected):
+        column = CUSTOMER_FIELDS.index(field)
+        for i, value in enumerate(protected):
+            if value is None:
+                errors[i] = f"could not protect {field}"
+            else:
+                rows[i][column] = value
+
+    async def protect_records(self, records):
+        if self.vault_client is None:
+            return await super().protect_records(records)
+        (rows, errors), ssns, ccns = await asyncio.gather(
+            super().protect_records(records),
+            self._transform_batch(
+                self.transform_mount_point,
+                "encode",
+                self.ssn_role,
+                [r["ssn"] for r in records],
+            ),
+            self._transform_batch(
+                self.transform_masking_mount_point,
+                "encode",
+                self.ccn_role,
+                [r["ccn"] for r in records],
+            ),
+        )
+        self._apply_field(rows, errors, "ssn", ssns)
+        self._apply_field(rows, errors, "ccn", ccns)
+        return rows, errors
@@ -0,0 +1,154 @@
+import logging
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+import mysql.connector
+
+from db_retry import is_connection_lost
+
+logger = logging.getLogger(__name__)
+
+
+# Fixed size pool of MySQL connections. Connections are opened lazily through
+# the connect factory, pinged before reuse when they were idle for longer than
+# validate_after seconds and closed once they are older than max_lifetime or
+# were opened before the last rotate().
+class ConnectionPool:
+    def __init__(
+        self, connect, size, max_lifetime=1800, validate_after=30, timeout=10
+    ):
+        self._connect = connect
+        self.size = size
+        self.max_lifetime = max_lifetime
+        self.validate_after = validate_after
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._created = {}
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.opened = 0
+        self.recycled = 0
+
+    def _open(self):
+        conn = self._connect()
+        with self._lock:
+            self._created[id(conn)] = time.monotonic()
+            self._generations[id(conn)] = self.generation
+            self.opened += 1
+        return conn
+
+    def _discard(self, conn):
+        with self._lock:
+            self._created.pop(id(conn), None)
+            self._generations.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception as e:
+            logger.debug(f"Error closing pooled connection: {e}")
+
+    def _outdated(self, conn):
+        return self._generations.get(id(conn), self.generation) < self.generation
+
+    def _usable(self, conn, idle_since):
+        now = time.monotonic()
+        if self._outdated(conn):
+            return False
+        if now - self._created.get(id(conn), now) > self.max_lifetime:
+            self.recycled += 1
+            return False
+        if now - idle_since < self.validate_after:
+            return True
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except mysql.connector.Error:
+            return False
+
+    def acquire(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError(
+                f"No database connection available after {self.timeout}s"
+            )
+        try:
+            while True:
+                try:
+                    conn, idle_since = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._open()
+                if self._usable(conn, idle_since):
+                    return conn
+                self._discard(conn)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn, broken=False):
+        try:
+            if broken or self._outdated(conn):
+                self._discard(conn)
+                return
+            try:
+                # end the read snapshot so the next user sees fresh data
+                if conn.in_transaction:
+                    conn.rollback()
+            except mysql.connector.Error:
+                self._discard(conn)
+                return
+            self._idle.put((conn, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    # The slot is given back however the block exits. Connections interrupted
+    # by anything else than an Exception, e.g. KeyboardInterrupt in the middle
+    # of a query, are in an unknown protocol state and are discarded.
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        broken = True
+        try:
+            yield conn
+            broken = False
+        except (
+            mysql.connector.errors.OperationalError,
+            mysql.connector.errors.InterfaceError,
+        ):
+            raise
+        except mysql.connector.Error as err:
+            # a demoted primary answers with read-only errors
+            broken = is_connection_lost(err)
+            raise
+        except Exception:
+            broken = False
+            raise
+        finally:
+            self.release(conn, broken=broken)
+
+    # Replaces all open connections, for example after a credential change.
+    # Connections in use finish their work and are closed when released, idle
+    # ones on their next checkout, so the replacements are opened gradually
+    # by the callers which need them.
+    def rotate(self):
+        with self._lock:
+            self.generation += 1
+
+    def close(self):
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(conn)
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "idle": self._idle.qsize(),
+            "open": len(self._created),
+            "opened": self.opened,
+            "recycled": self.recycled,
+            "generation": self.generation,
+        }
@@ -0,0 +1,47 @@
+import itertools
+import random
+
+from mysql.connector import errorcode, errors
+
+RECONNECT_ATTEMPTS = 5
+RECONNECT_BASE_DELAY = 0.05
+RECONNECT_MAX_DELAY = 2.0
+
+CONNECT_ATTEMPTS = 10
+CONNECT_MAX_DELAY = 5.0
+
+# Client errors of a connection which is gone, and server errors of a primary
+# which a failover demoted to a read-only replica. In both cases the next
+# connection reaches a working server.
+CONNECTION_LOST_ERRORS = frozenset(
+    (
+        errorcode.CR_CONNECTION_ERROR,
+        errorcode.CR_CONN_HOST_ERROR,
+        errorcode.CR_SERVER_GONE_ERROR,
+        errorcode.CR_SERVER_LOST,
+        errorcode.CR_SERVER_LOST_EXTENDED,
+        errorcode.ER_CLIENT_INTERACTION_TIMEOUT,
+        errorcode.ER_OPTION_PREVENTS_STATEMENT,
+        errorcode.ER_CANT_EXECUTE_IN_READ_ONLY_TRANSACTION,
+    )
+)
+
+
+def is_connection_lost(err):
+    if err.errno in CONNECTION_LOST_ERRORS:
+        return True
+    # "MySQL Connection not available" carries no error number
+    return err.errno == -1 and isinstance(
+        err, (errors.OperationalError, errors.InterfaceError)
+    )
+
+
+# Exponential backoff with full jitter: retry n waits a random time of up to
+# base_delay * 2**n seconds, capped at max_delay, so that all clients of a
+# failed over server do not reconnect in lockstep. With attempts None the
+# delays never run out.
+def backoff_delays(
+    attempts, base_delay=RECONNECT_BASE_DELAY, max_delay=RECONNECT_MAX_DELAY
+):
+    for attempt in itertools.count() if attempts is None else range(attempts):
+        yield random.uniform(0, min(max_delay, base_delay * 2**attempt))
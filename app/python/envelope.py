@@ -0,0 +1,114 @@
+import base64
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+ENVELOPE_PREFIX = "env:v1:"
+
+DATA_KEY_TTL = 3600
+DATA_KEY_MAX_USES = 1_000_000
+UNWRAPPED_KEYS = 64
+
+NONCE_SIZE = 12
+
+
+# Envelope encryption with Transit data keys. Values are encrypted locally with
+# AES-GCM under a data key which Transit generated and wrapped. The wrapped key
+# is stored through store_key and every value carries the id of its key:
+#
+#   env:v1:<key id>:<base64 nonce + ciphertext>
+#
+# The current data key is replaced after ttl seconds or max_uses encryptions,
+# unwrapped keys are kept in a small LRU so that decryption only calls Transit
+# once per key.
+class EnvelopeCipher:
+    def __init__(
+        self,
+        generate_key,
+        unwrap_key,
+        store_key,
+        load_key,
+        ttl=DATA_KEY_TTL,
+        max_uses=DATA_KEY_MAX_USES,
+    ):
+        self._generate_key = generate_key
+        self._unwrap_key = unwrap_key
+        self._store_key = store_key
+        self._load_key = load_key
+        self.ttl = ttl
+        self.max_uses = max_uses
+        self._current = None
+        self._expires = 0
+        self._uses = 0
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_envelope(value):
+        return value.startswith(ENVELOPE_PREFIX)
+
+    @staticmethod
+    def key_id(wrapped_key):
+        return hashlib.sha256(wrapped_key.encode()).hexdigest()[:16]
+
+    def _remember(self, key_id, key):
+        self._keys[key_id] = AESGCM(key)
+        self._keys.move_to_end(key_id)
+        while len(self._keys) > UNWRAPPED_KEYS:
+            self._keys.popitem(last=False)
+
+    def _rotate(self):
+        key, wrapped_key = self._generate_key()
+        key_id = self.key_id(wrapped_key)
+        self._store_key(key_id, wrapped_key)
+        self._remember(key_id, key)
+        self._current = key_id
+        self._expires = time.monotonic() + self.ttl
+        self._uses = 0
+
+    def rotate(self):
+        with self._lock:
+            self._rotate()
+
+    def _encryption_key(self):
+        with self._lock:
+            if (
+                self._current is None
+                or self._current not in self._keys
+                or self._uses >= self.max_uses
+                or time.monotonic() >= self._expires
+            ):
+                self._rotate()
+            self._uses += 1
+            return self._current, self._keys[self._current]
+
+    def _decryption_key(self, key_id):
+        with self._lock:
+            aesgcm = self._keys.get(key_id)
+            if aesgcm is not None:
+                self._keys.move_to_end(key_id)
+                return aesgcm
+        wrapped_key = self._load_key(key_id)
+        if wrapped_key is None:
+            raise KeyError(f"unknown data key {key_id}")
+        key = self._unwrap_key(wrapped_key)
+        with self._lock:
+            self._remember(key_id, key)
+            return self._keys[key_id]
+
+    def encrypt(self, value):
+        key_id, aesgcm = self._encryption_key()
+        nonce = os.urandom(NONCE_SIZE)
+        ciphertext = aesgcm.encrypt(nonce, value.encode(), None)
+        payload = base64.b64encode(nonce + ciphertext).decode("ascii")
+        return f"{ENVELOPE_PREFIX}{key_id}:{payload}"
+
+    def decrypt(self, value):
+        key_id, payload = value[len(ENVELOPE_PREFIX) :].split(":", 1)
+        data = base64.b64decode(payload)
+        aesgcm = self._decryption_key(key_id)
+        return aesgcm.decrypt(data[:NONCE_SIZE], data[NONCE_SIZE:], None).decode()
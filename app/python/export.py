@@ -0,0 +1,301 @@
+import argparse
+import csv
+import io
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+
+from db_client import select_fields
+from metrics import CUSTOMER_EXPORT_ROWS
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # without the export extra only CSV is written
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+# rows per MySQL query, batch of Vault calls and Parquet row group
+EXPORT_CHUNK_SIZE = 5000
+
+# chunks read and decrypted ahead of the one being written
+EXPORT_PREFETCH = 2
+
+# output formats and the content types of their responses
+EXPORT_FORMATS = {
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "csv": "text/csv",
+}
+
+EXPORT_EXTENSIONS = {
+    ".parquet": "parquet",
+    ".arrow": "arrow",
+    ".arrows": "arrow",
+    ".csv": "csv",
+}
+
+
+def default_format():
+    return "csv" if pyarrow is None else "parquet"
+
+
+# Yields the items of iterable, which are produced by a thread up to ahead
+# items in advance. The next chunk is then read and decrypted while the
+# current one is encoded and written.
+def prefetch(iterable, ahead=EXPORT_PREFETCH):
+    items = queue.Queue(ahead)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((None, None))
+        except Exception as e:
+            put((None, e))
+
+    thread = threading.Thread(target=produce, name="export_prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is None:
+                return
+            yield item
+    finally:
+        # a consumer which stops early releases the producer
+        stopped.set()
+
+
+# Write-only file which hands out the bytes written so far, so that an
+# export is streamed chunk by chunk instead of being held in memory. tell()
+# counts all bytes, writers need it for the offsets in their footers.
+class ChunkSink(io.RawIOBase):
+    def __init__(self):
+        super().__init__()
+        self._parts = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def take(self):
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+
+class CsvWriter:
+    def __init__(self, sink, fields):
+        self.sink = sink
+        self.fields = fields
+        self._text = io.StringIO()
+        self._csv = csv.writer(self._text)
+        self._csv.writerow(fields)
+
+    def _flush(self):
+        self.sink.write(self._text.getvalue().encode("utf-8"))
+        self._text.seek(0)
+        self._text.truncate()
+
+    def write(self, customers):
+        self._csv.writerows([c[f] for f in self.fields] for c in customers)
+        self._flush()
+
+    def close(self):
+        self._flush()
+
+
+# Parquet with one zstd compressed row group per chunk, or an Arrow IPC
+# stream with one record batch per chunk.
+class ArrowWriter:
+    def __init__(self, sink, fields, fmt):
+        self.fields = fields
+        self.schema = pyarrow.schema(
+            [
+                (f, pyarrow.int64() if f == "customer_number" else pyarrow.string())
+                for f in fields
+            ]
+        )
+        if fmt == "parquet":
+            self._writer = pyarrow.parquet.ParquetWriter(
+                sink, self.schema, compression="zstd"
+            )
+        else:
+            self._writer = pyarrow.ipc.new_stream(
+                sink,
+                self.schema,
+                options=pyarrow.ipc.IpcWriteOptions(compression="zstd"),
+            )
+
+    def write(self, customers):
+        columns = [[c[f] for c in customers] for f in self.fields]
+        self._writer.write_table(pyarrow.Table.from_arrays(columns, schema=self.schema))
+
+    def close(self):
+        self._writer.close()
+
+
+# Exports the decrypted customers ordered by cust_no, or those created in a
+# date range. The table is read in primary key chunks of chunk_size rows,
+# every chunk is decrypted with batched Vault calls spread over the client's
+# workers and written as soon as it is ready, so memory is bounded by the
+# chunks in flight and not by the size of the table.
+class CustomerExport:
+    def __init__(
+        self,
+        dbc,
+        fmt=None,
+        fields=None,
+        chunk_size=EXPORT_CHUNK_SIZE,
+        ahead=EXPORT_PREFETCH,
+        created_from=None,
+        created_before=None,
+    ):
+        fmt = fmt or default_format()
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"unknown format: {fmt}")
+        if fmt != "csv" and pyarrow is None:
+            raise ValueError(f"the {fmt} format needs pyarrow")
+        self.dbc = dbc
+        self.fmt = fmt
+        self.fields = select_fields(fields)
+        self.chunk_size = chunk_size
+        self.ahead = ahead
+        self.created_from = created_from
+        self.created_before = created_before
+        self.rows = 0
+        self.chunks = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    @property
+    def content_type(self):
+        return EXPORT_FORMATS[self.fmt]
+
+    def _writer(self, sink):
+        if self.fmt == "csv":
+            return CsvWriter(sink, self.fields)
+        return ArrowWriter(sink, self.fields, self.fmt)
+
+    def summary(self):
+        return {
+            "format": self.fmt,
+            "rows": self.rows,
+            "chunks": self.chunks,
+            "bytes": self.bytes,
+            "seconds": round(self.seconds, 3),
+            "rows_per_second": (
+                round(self.rows / self.seconds, 1) if self.seconds else 0.0
+            ),
+        }
+
+    # Yields the encoded output chunk by chunk
+    def stream(self):
+        started = time.monotonic()
+        sink = ChunkSink()
+        writer = self._writer(sink)
+        chunks = self.dbc.iter_customer_chunks(
+            fields=self.fields,
+            created_from=self.created_from,
+            created_before=self.created_before,
+            chunk_size=self.chunk_size,
+        )
+        for customers in prefetch(chunks, self.ahead):
+            if not customers:
+                continue
+            writer.write(customers)
+            self.rows += len(customers)
+            self.chunks += 1
+            CUSTOMER_EXPORT_ROWS.inc(self.fmt, amount=len(customers))
+            logger.debug(f"Exported {self.rows} customers")
+            yield sink.take()
+        writer.close()
+        self.bytes = sink.tell()
+        self.seconds = time.monotonic() - started
+        logger.info(f"Export finished: {self.summary()}")
+        yield sink.take()
+
+    # writes the export to a binary file and returns its summary
+    def write_to(self, file):
+        for data in self.stream():
+            file.write(data)
+        return self.summary()
+
+
+def main():
+    # app is only needed to set up the client from config.ini
+    import app  # pylint: disable=import-outside-toplevel
+
+    parser = argparse.ArgumentParser(
+        description="Export the decrypted customers as Parquet, Arrow or CSV"
+    )
+    parser.add_argument("file", help="output file, - writes stdout")
+    parser.add_argument("--format", choices=list(EXPORT_FORMATS))
+    parser.add_argument("--fields", help="comma separated fields, default all")
+    parser.add_argument("--chunk-size", type=int)
+    parser.add_argument("--created-from", help="first creation date")
+    parser.add_argument("--created-before", help="creation date to stop before")
+    args = parser.parse_args()
+
+    app_config = app.read_config()
+    logging.basicConfig(level=app.log_level[app_config["DEFAULT"]["LogLevel"]])
+    fmt = args.format
+    if fmt is None:
+        fmt = EXPORT_EXTENSIONS.get(os.path.splitext(args.file)[1].lower())
+    chunk_size = args.chunk_size or app_config.getint(
+        "DATABASE", "ExportChunkSize", fallback=EXPORT_CHUNK_SIZE
+    )
+
+    dbc = app.init_client(app_config)
+    try:
+        export = CustomerExport(
+            dbc,
+            fmt=fmt,
+            fields=app.parse_fields(args.fields),
+            chunk_size=chunk_size,
+            created_from=app.parse_date(args.created_from),
+            created_before=app.parse_date(args.created_before),
+        )
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.file == "-":
+        summary = export.write_to(sys.stdout.buffer)
+    else:
+        with open(args.file, "wb") as f:
+            summary = export.write_to(f)
+    # stdout may hold the export
+    print(json.dumps(summary, indent=2), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
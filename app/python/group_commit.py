@@ -0,0 +1,98 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from metrics import DB_GROUP_COMMIT_SIZE
+
+logger = logging.getLogger(__name__)
+
+GROUP_COMMIT_SIZE = 100
+GROUP_COMMIT_DELAY = 0.005
+GROUP_COMMIT_QUEUE_SIZE = 1000
+GROUP_COMMIT_TIMEOUT = 10
+
+
+# Group commit of single inserts. Callers submit records to a bounded queue
+# and wait for their own result. A background thread takes the first waiting
+# record, collects further ones for up to max_delay seconds or until
+# max_size records are pending, and writes them with one call of
+# insert_batch, which returns a result or an exception per record. Many
+# concurrent inserts then share one transaction and one commit instead of
+# committing one by one.
+class GroupCommitter:
+    name = "group_commit"
+
+    def __init__(
+        self,
+        insert_batch,
+        max_size=GROUP_COMMIT_SIZE,
+        max_delay=GROUP_COMMIT_DELAY,
+        queue_size=GROUP_COMMIT_QUEUE_SIZE,
+        timeout=GROUP_COMMIT_TIMEOUT,
+    ):
+        self.insert_batch = insert_batch
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self._queue = queue.Queue(queue_size)
+        self._thread = None
+
+    # Blocks until the batch of record is committed and returns its result.
+    # A full queue makes callers wait up to timeout seconds for space.
+    def submit(self, record):
+        future = Future()
+        try:
+            self._queue.put((record, future), timeout=self.timeout)
+        except queue.Full as e:
+            raise TimeoutError("the group commit queue is full") from e
+        return future.result()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_size and batch[-1] is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _flush(self, batch):
+        DB_GROUP_COMMIT_SIZE.observe(len(batch))
+        try:
+            results = self.insert_batch([record for record, _ in batch])
+        except Exception as e:
+            logger.error(f"There was an error committing {len(batch)} inserts: {e}")
+            results = [e] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def run(self):
+        while True:
+            batch = self._collect()
+            stopped = batch[-1] is None
+            if stopped:
+                batch.pop()
+            if batch:
+                self._flush(batch)
+            if stopped:
+                return
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+        self._thread.start()
+        return self._thread
+
+    # commits the records submitted so far and stops the thread
+    def stop(self):
+        self._queue.put(None)
+        if self._thread is not None:
+            self._thread.join()
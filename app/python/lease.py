@@ -0,0 +1,113 @@
+import logging
+import threading
+import time
+
+from db_retry import backoff_delays
+from metrics import DB_LEASE_RENEWALS, DB_LEASE_TTL
+
+logger = logging.getLogger(__name__)
+
+LEASE_RENEW_FRACTION = 2 / 3
+LEASE_ROTATE_BEFORE = 300
+LEASE_RETRY_BASE_DELAY = 1.0
+LEASE_RETRY_MAX_DELAY = 30.0
+
+
+# Keeps the dynamic MySQL credentials of a client valid. The lease is renewed
+# once renew_fraction of its duration passed. When Vault no longer extends it
+# past rotate_before seconds, because the role's max TTL is near or the lease
+# is not renewable, new credentials are read and the client's connections are
+# rotated to them before the old ones expire.
+class LeaseManager:
+    name = "db_lease"
+
+    def __init__(
+        self,
+        dbc,
+        renew_fraction=LEASE_RENEW_FRACTION,
+        rotate_before=LEASE_ROTATE_BEFORE,
+    ):
+        self.dbc = dbc
+        self.renew_fraction = renew_fraction
+        self.rotate_before = rotate_before
+        self.expires_at = None
+        self.renew_at = None
+        self._rotate_below = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._track(dbc.db_lease, rotated=True)
+        DB_LEASE_TTL.set_function(self.ttl)
+
+    @classmethod
+    def from_config(cls, dbc, conf):
+        return cls(
+            dbc,
+            renew_fraction=conf.getfloat(
+                "VAULT", "LeaseRenewFraction", fallback=LEASE_RENEW_FRACTION
+            ),
+            rotate_before=conf.getint(
+                "VAULT", "LeaseRotateBefore", fallback=LEASE_ROTATE_BEFORE
+            ),
+        )
+
+    def ttl(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def _track(self, lease, rotated=False):
+        now = time.monotonic()
+        duration = lease["lease_duration"]
+        self.expires_at = now + duration
+        self.renew_at = now + duration * self.renew_fraction
+        if rotated:
+            # a lease shorter than rotate_before is still renewed, and replaced
+            # within the second half of the time left at its renewal
+            self._rotate_below = min(
+                self.rotate_before, duration * (1 - self.renew_fraction) / 2
+            )
+
+    def _renew(self):
+        lease = self.dbc.db_lease
+        renewed = self.dbc.renew_db_lease(lease["lease_id"], lease["lease_duration"])
+        self._track(renewed)
+        DB_LEASE_RENEWALS.inc("renewed")
+        logger.debug(f"Renewed the database lease for {renewed['lease_duration']}s")
+        return renewed["lease_duration"] > self._rotate_below
+
+    def _rotate(self):
+        secret = self.dbc.read_db_credentials(self.dbc.db_creds_path)
+        self.dbc.rotate_credentials(secret)
+        self._track(secret, rotated=True)
+        DB_LEASE_RENEWALS.inc("rotated")
+        logger.info(f"Rotated the database credentials to {self.dbc.username}")
+
+    def refresh(self):
+        lease = self.dbc.db_lease
+        if lease["renewable"] and self.ttl() > self._rotate_below and self._renew():
+            return
+        self._rotate()
+
+    def run(self):
+        delays = None
+        while not self._stop.wait(max(0.0, self.renew_at - time.monotonic())):
+            try:
+                self.refresh()
+                delays = None
+            except Exception as e:
+                DB_LEASE_RENEWALS.inc("failed")
+                logger.error(f"There was an error refreshing the database lease: {e}")
+                if delays is None:
+                    delays = backoff_delays(
+                        None, LEASE_RETRY_BASE_DELAY, LEASE_RETRY_MAX_DELAY
+                    )
+                self.renew_at = time.monotonic() + next(delays)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,238 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for label_values, value in sorted(values.items()):
+            yield f"{self.name}{_labels(self.labels, label_values)} {_number(value)}"
+
+
+# Gauges hold the last set value, or call a function on every scrape for
+# values which change with time.
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        self._functions = {}
+        self._lock = threading.Lock()
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+    def set_function(self, function, *label_values):
+        with self._lock:
+            self._functions[label_values] = function
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        for label_values, function in functions.items():
+            values[label_values] = function()
+        for label_values, value in sorted(values.items()):
+            yield f"{self.name}{_labels(self.labels, label_values)} {_number(value)}"
+
+
+# Histograms keep one bucket count per label set, observing is a bisect and
+# a few additions under a lock.
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, *label_values):
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            counts, total = self._values.get(
+                label_values, ([0] * (len(self.buckets) + 1), 0.0)
+            )
+            counts[index] += 1
+            self._values[label_values] = (counts, total + seconds)
+
+    @contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def samples(self):
+        with self._lock:
+            values = {k: (list(c), t) for k, (c, t) in self._values.items()}
+        for label_values, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                yield (
+                    f"{self.name}_bucket"
+                    f"{_labels(self.labels, label_values, le)} {cumulative}"
+                )
+            labels = _labels(self.labels, label_values)
+            yield f"{self.name}_sum{labels} {_number(total)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.register(
+    Counter(
+        "http_requests_total",
+        "HTTP requests by route, method and status.",
+        ("route", "method", "status"),
+    )
+)
+HTTP_REQUEST_DURATION = REGISTRY.register(
+    Histogram(
+        "http_request_duration_seconds",
+        "Time until the response of a route is returned.",
+        ("route", "method"),
+    )
+)
+DB_QUERY_DURATION = REGISTRY.register(
+    Histogram(
+        "db_query_duration_seconds",
+        "MySQL statement execution time by statement type.",
+        ("statement",),
+    )
+)
+DB_CONNECT_RETRIES = REGISTRY.register(
+    Counter("db_connect_retries_total", "Failed MySQL connection attempts.")
+)
+DB_RECONNECTS = REGISTRY.register(
+    Counter("db_reconnects_total", "Reconnects after a lost MySQL connection.")
+)
+DB_GROUP_COMMIT_SIZE = REGISTRY.register(
+    Histogram(
+        "db_group_commit_size",
+        "Inserts committed together by one group commit.",
+        buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+    )
+)
+DB_READS = REGISTRY.register(
+    Counter(
+        "db_reads_total",
+        "Customer reads by the server which answered them.",
+        ("server",),
+    )
+)
+DB_REPLICA_UP = REGISTRY.register(
+    Gauge(
+        "db_replica_up",
+        "Whether a read replica is used, 0 while it is skipped after a failure.",
+        ("replica",),
+    )
+)
+DB_LEASE_TTL = REGISTRY.register(
+    Gauge(
+        "db_credential_lease_ttl_seconds",
+        "Remaining TTL of the dynamic MySQL credential lease.",
+    )
+)
+DB_LEASE_RENEWALS = REGISTRY.register(
+    Counter(
+        "db_credential_lease_renewals_total",
+        "Dynamic MySQL credential lease renewals by result.",
+        ("result",),
+    )
+)
+CUSTOMER_EXPORT_ROWS = REGISTRY.register(
+    Counter(
+        "customer_export_rows_total",
+        "Customers written by exports by output format.",
+        ("format",),
+    )
+)
+VAULT_OPERATION_DURATION = REGISTRY.register(
+    Histogram(
+        "vault_operation_duration_seconds",
+        "Vault call time by operation, batched calls count once.",
+        ("operation",),
+    )
+)
+
+
+def statement_type(sql):
+    return sql.lstrip().split(None, 1)[0].upper()
@@ -0,0 +1,303 @@
+import logging
+import time
+from datetime import datetime
+
+import mysql.connector
+from mysql.connector import errorcode
+
+logger = logging.getLogger(__name__)
+
+MIGRATION_CHUNK_SIZE = 1000
+MIGRATION_ROWS_PER_SECOND = 5000
+
+# seconds to wait for another instance which is migrating the same database
+MIGRATION_LOCK_TIMEOUT = 300
+
+MIGRATION_LOCK_NAME = "schema_migrations"
+
+# DDL which already took effect, an interrupted migration skips it on rerun
+ALREADY_APPLIED_ERRORS = frozenset(
+    (errorcode.ER_DUP_FIELDNAME, errorcode.ER_DUP_KEYNAME)
+)
+
+MIGRATIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS `schema_migrations` (
+    `version` int(11) NOT NULL,
+    `description` varchar(255) NOT NULL,
+    `applied_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (`version`)
+) ENGINE=InnoDB;"""
+
+SELECT_VERSIONS_SQL = "SELECT version FROM `schema_migrations`"
+
+INSERT_VERSION_SQL = (
+    "INSERT INTO `schema_migrations` (`version`, `description`) VALUES (%s, %s)"
+)
+
+GET_LOCK_SQL = "SELECT GET_LOCK(%s, %s)"
+
+RELEASE_LOCK_SQL = "SELECT RELEASE_LOCK(%s)"
+
+# The tables of the first release. They were created on every start before
+# migrations existed, IF NOT EXISTS adopts such databases at version 1.
+CUSTOMER_TABLE = """
+CREATE TABLE IF NOT EXISTS `customers` (
+    `cust_no` int(11) NOT NULL AUTO_INCREMENT,
+    `birth_date` varchar(255) NOT NULL,
+    `first_name` varchar(255) NOT NULL,
+    `last_name` varchar(255) NOT NULL,
+    `create_date` varchar(255) NOT NULL,
+    `social_security_number` varchar(255) NOT NULL,
+    `credit_card_number` varchar(255) NOT NULL,
+    `address` varchar(255) NOT NULL,
+    `salary` varchar(255) NOT NULL,
+    PRIMARY KEY (`cust_no`)
+) ENGINE=InnoDB;"""
+
+DATA_KEY_TABLE = """
+CREATE TABLE IF NOT EXISTS `data_keys` (
+    `key_id` varchar(32) NOT NULL,
+    `wrapped_key` varchar(255) NOT NULL,
+    PRIMARY KEY (`key_id`)
+) ENGINE=InnoDB;"""
+
+CHECKPOINT_TABLE = """
+CREATE TABLE IF NOT EXISTS `job_checkpoints` (
+    `job` varchar(64) NOT NULL,
+    `position` int(11) NOT NULL,
+    PRIMARY KEY (`job`)
+) ENGINE=InnoDB;"""
+
+SEED_CUSTOMERS = """
+INSERT IGNORE into customers (`cust_no`, `birth_date`, `first_name`, `last_name`,
+    `create_date`, `social_security_number`, `credit_card_number`, `address`, `salary`)
+VALUES
+  (2, "3/14/69", "Larry", "Johnson", "2020-01-01T14:49:12.301977", "360-56-6750", "3600-5600-6750-0000", "Tyler, Texas", "7000000"),
+  (40, "11/26/69", "Shawn", "Kemp", "2020-02-21T10:24:55.985726", "235-32-8091", "2350-3200-8091-0001", "Elkhart, Indiana", "15000000"),
+  (34, "2/20/63", "Charles", "Barkley", "2019-04-09T01:10:20.548144", "531-72-1553", "5310-7200-1553-0002", "Leeds, Alabama", "9000000");
+"""
+
+# The other columns stay varchar(255), with Vault they hold ciphertexts.
+# LOCK=NONE lets MySQL refuse the change rather than block writes.
+ADD_CREATED_AT_SQL = """
+ALTER TABLE `customers` ADD COLUMN `created_at` datetime(6) NULL, LOCK=NONE"""
+
+ADD_CREATED_AT_INDEX_SQL = """
+ALTER TABLE `customers` ADD INDEX `created_at` (`created_at`), LOCK=NONE"""
+
+# HMACs of the SSN and CCN, filled once [VAULT] BlindIndex is enabled
+ADD_BLIND_INDEX_COLUMNS_SQL = tuple(
+    f"ALTER TABLE `customers` ADD COLUMN `{column}` char(64) NULL, LOCK=NONE"
+    for column in ("ssn_bidx", "ccn_bidx")
+)
+
+ADD_BLIND_INDEXES_SQL = tuple(
+    f"ALTER TABLE `customers` ADD INDEX `{column}` (`{column}`), LOCK=NONE"
+    for column in ("ssn_bidx", "ccn_bidx")
+)
+
+SELECT_CREATE_DATES_SQL = """
+SELECT cust_no, create_date FROM `customers`
+WHERE cust_no > %s AND created_at IS NULL
+ORDER BY cust_no LIMIT %s"""
+
+UPDATE_CREATED_AT_SQL = """
+UPDATE `customers` SET created_at = %s
+WHERE cust_no = %s AND created_at IS NULL"""
+
+SELECT_CHECKPOINT_SQL = "SELECT position FROM `job_checkpoints` WHERE job = %s"
+
+SAVE_CHECKPOINT_SQL = """
+INSERT INTO `job_checkpoints` (`job`, `position`) VALUES (%s, %s)
+ON DUPLICATE KEY UPDATE position = VALUES(position)"""
+
+
+# Returns the typed created_at of a create_date string such as
+# "2020-01-01T14:49:12.301977" or None when it is no ISO date. Aware times
+# are stored in local time like the ones set by the app.
+def parse_create_date(value):
+    try:
+        created_at = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    if created_at.tzinfo is not None:
+        created_at = created_at.astimezone().replace(tzinfo=None)
+    return created_at
+
+
+# A schema version. Steps are SQL statements or functions called with the
+# Migrator and run in order, a version is recorded once all steps finished.
+class Migration:
+    def __init__(self, version, description, *steps):
+        self.version = version
+        self.description = description
+        self.steps = steps
+
+
+# Fills created_at from create_date in primary key chunks of one short
+# transaction each, so the table stays writable. Progress is checkpointed
+# and an interrupted backfill resumes after the last finished chunk.
+def backfill_created_at(migrator):
+    job = "migration_created_at"
+    after = migrator.get_checkpoint(job)
+    filled = 0
+    while True:
+        started = time.monotonic()
+        rows = migrator.fetch(SELECT_CREATE_DATES_SQL, (after, migrator.chunk_size))
+        if not rows:
+            break
+        updates = [
+            (created_at, cust_no)
+            for cust_no, created_at in (
+                (row[0], parse_create_date(row[1])) for row in rows
+            )
+            if created_at is not None
+        ]
+        if updates:
+            migrator.execute_many(UPDATE_CREATED_AT_SQL, updates)
+        filled += len(updates)
+        after = rows[-1][0]
+        migrator.save_checkpoint(job, after)
+        logger.info(f"Filled created_at of {filled} customers up to cust_no {after}")
+        migrator.throttle(len(rows), started)
+
+
+MIGRATIONS = (
+    Migration(
+        1,
+        "customers, data_keys and job_checkpoints tables",
+        CUSTOMER_TABLE,
+        DATA_KEY_TABLE,
+        CHECKPOINT_TABLE,
+        SEED_CUSTOMERS,
+    ),
+    # the index is built after the backfill, which then does not maintain it
+    Migration(
+        2,
+        "typed and indexed customers.created_at",
+        ADD_CREATED_AT_SQL,
+        backfill_created_at,
+        ADD_CREATED_AT_INDEX_SQL,
+    ),
+    Migration(
+        3,
+        "blind index columns customers.ssn_bidx and ccn_bidx",
+        *ADD_BLIND_INDEX_COLUMNS_SQL,
+        *ADD_BLIND_INDEXES_SQL,
+    ),
+)
+
+SCHEMA_VERSION = MIGRATIONS[-1].version
+
+
+# Applies the pending MIGRATIONS in version order on a blocking connection.
+# A named lock serializes instances which start at the same time, the
+# versions applied so far are kept in schema_migrations.
+class Migrator:
+    def __init__(
+        self,
+        conn,
+        chunk_size=MIGRATION_CHUNK_SIZE,
+        rows_per_second=MIGRATION_ROWS_PER_SECOND,
+        migrations=MIGRATIONS,
+    ):
+        self.conn = conn
+        self.chunk_size = chunk_size
+        self.rows_per_second = rows_per_second
+        self.migrations = migrations
+
+    def fetch(self, sql, params=None):
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def execute(self, sql, params=None):
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(sql, params)
+            self.conn.commit()
+        finally:
+            cursor.close()
+
+    def execute_many(self, sql, rows):
+        cursor = self.conn.cursor()
+        try:
+            cursor.executemany(sql, rows)
+            self.conn.commit()
+        finally:
+            cursor.close()
+
+    def get_checkpoint(self, job):
+        rows = self.fetch(SELECT_CHECKPOINT_SQL, (job,))
+        return rows[0][0] if rows else 0
+
+    def save_checkpoint(self, job, position):
+        self.execute(SAVE_CHECKPOINT_SQL, (job, position))
+
+    def throttle(self, rows, started):
+        if self.rows_per_second <= 0:
+            return
+        delay = rows / self.rows_per_second - (time.monotonic() - started)
+        if delay > 0:
+            time.sleep(delay)
+
+    def applied(self):
+        self.execute(MIGRATIONS_TABLE)
+        return {row[0] for row in self.fetch(SELECT_VERSIONS_SQL)}
+
+    def pending(self):
+        applied = self.applied()
+        return [m for m in self.migrations if m.version not in applied]
+
+    def _run_step(self, step):
+        if callable(step):
+            step(self)
+            return
+        try:
+            self.execute(step)
+        except mysql.connector.Error as err:
+            if err.errno not in ALREADY_APPLIED_ERRORS:
+                raise
+            logger.info(f"Skipping a step which was already applied: {err.msg}")
+
+    def apply(self, migration):
+        logger.info(f"Migrating to version {migration.version}...")
+        started = time.monotonic()
+        for step in migration.steps:
+            self._run_step(step)
+        self.execute(INSERT_VERSION_SQL, (migration.version, migration.description))
+        logger.info(
+            f"Migrated to version {migration.version}: {migration.description} "
+            f"in {time.monotonic() - started:.1f}s"
+        )
+
+    # Applies the pending migrations up to target and returns their versions
+    def migrate(self, target=None):
+        lock = (MIGRATION_LOCK_NAME, MIGRATION_LOCK_TIMEOUT)
+        if not self.fetch(GET_LOCK_SQL, lock)[0][0]:
+            raise TimeoutError("another instance is migrating the database")
+        try:
+            applied = []
+            for migration in self.pending():
+                if target is not None and migration.version > target:
+                    break
+                self.apply(migration)
+                applied.append(migration.version)
+            return applied
+        finally:
+            self.fetch(RELEASE_LOCK_SQL, (MIGRATION_LOCK_NAME,))
+
+
+# Creates database db if needed, selects it on conn and migrates it
+def migrate_database(conn, db, **kwargs):
+    cursor = conn.cursor()
+    try:
+        logger.info(f"Preparing database {db}...")
+        cursor.execute(f"CREATE DATABASE IF NOT EXISTS `{db}`")
+        cursor.execute(f"USE `{db}`")
+    finally:
+        cursor.close()
+    return Migrator(conn, **kwargs).migrate()
@@ -0,0 +1,138 @@
+import contextvars
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import mysql.connector
+
+from db_pool import ConnectionPool
+from db_retry import is_connection_lost
+from metrics import DB_READS, DB_REPLICA_UP
+
+logger = logging.getLogger(__name__)
+
+REPLICA_POOL_SIZE = 4
+REPLICA_RETRY_AFTER = 30
+REPLICA_STICKINESS = 5
+
+# Set while the reads of the current request must see its caller's own
+# writes, they go to the primary then.
+READ_PRIMARY = contextvars.ContextVar("read_primary", default=False)
+
+
+class NoReplicaAvailable(Exception):
+    pass
+
+
+# Parses "host1:3306, host2" into (host, port) pairs
+def parse_replicas(value, default_port):
+    replicas = []
+    for address in filter(None, (a.strip() for a in value.split(","))):
+        host, _, port = address.partition(":")
+        replicas.append((host, int(port or default_port)))
+    return replicas
+
+
+class Replica:
+    def __init__(self, host, port, pool):
+        self.host = host
+        self.port = port
+        self.pool = pool
+        self.down_until = 0.0
+        self.name = f"{host}:{port}"
+        DB_REPLICA_UP.set(1, self.name)
+
+    def is_up(self, now):
+        return self.down_until <= now
+
+    def mark_down(self, retry_after, err):
+        if self.is_up(time.monotonic()):
+            logger.warning(f"Replica {self.name} is unavailable: {err}")
+        self.down_until = time.monotonic() + retry_after
+        DB_REPLICA_UP.set(0, self.name)
+        # connections of a failed replica are not reused after it is back
+        self.pool.rotate()
+
+    def mark_up(self):
+        if self.down_until:
+            logger.info(f"Replica {self.name} is available again")
+            self.down_until = 0.0
+            DB_REPLICA_UP.set(1, self.name)
+
+
+# Read replicas of the primary with one connection pool each. Reads are
+# spread round robin over the replicas which are up. A replica whose
+# connection is lost is skipped for retry_after seconds, when all replicas
+# are down NoReplicaAvailable tells the caller to read from the primary.
+class ReplicaSet:
+    def __init__(
+        self,
+        addresses,
+        connect,
+        pool_size=REPLICA_POOL_SIZE,
+        max_lifetime=1800,
+        retry_after=REPLICA_RETRY_AFTER,
+    ):
+        self.retry_after = retry_after
+        self.replicas = [
+            Replica(
+                host,
+                port,
+                ConnectionPool(
+                    lambda host=host, port=port: connect(host, port),
+                    pool_size,
+                    max_lifetime=max_lifetime,
+                ),
+            )
+            for host, port in addresses
+        ]
+        self._next = itertools.cycle(range(len(self.replicas)))
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.replicas)
+
+    # Returns the next replica which is up, round robin
+    def choose(self):
+        now = time.monotonic()
+        with self._lock:
+            for _ in range(len(self.replicas)):
+                replica = self.replicas[next(self._next)]
+                if replica.is_up(now):
+                    return replica
+        raise NoReplicaAvailable("no read replica is available")
+
+    @contextmanager
+    def connection(self, replica):
+        DB_READS.inc(replica.name)
+        lost = None
+        try:
+            with replica.pool.connection() as conn:
+                yield conn
+        except mysql.connector.Error as err:
+            if is_connection_lost(err):
+                lost = err
+            raise
+        finally:
+            # any other outcome means the replica answered
+            if lost is None:
+                replica.mark_up()
+            else:
+                replica.mark_down(self.retry_after, lost)
+
+    def rotate(self):
+        for replica in self.replicas:
+            replica.pool.rotate()
+
+    def close(self):
+        for replica in self.replicas:
+            replica.pool.close()
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            replica.name: {"up": replica.is_up(now), **replica.pool.stats()}
+            for replica in self.replicas
+        }
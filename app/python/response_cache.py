@@ -0,0 +1,105 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+RESPONSE_CACHE_TTL = 60
+
+
+# LRU cache of rendered read responses. Entries and ETags belong to a data
+# version, which writes advance through invalidate(). A conditional request
+# is answered by comparing its ETag with the current version, without
+# rendering the response.
+#
+# Without shared_file the version is local to the process. With it, writes
+# touch the file and every worker reads its mtime, so a write in one worker
+# invalidates the responses of all others. The version also rolls over every
+# ttl seconds, which bounds the staleness after writes of other processes
+# such as bulk_import.py.
+class ResponseCache:
+    def __init__(self, max_size, ttl=RESPONSE_CACHE_TTL, shared_file=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.shared_file = shared_file
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.invalidations = 0
+        self._local_version = 0
+        self._last_modified = time.time()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if shared_file is not None and not os.path.exists(shared_file):
+            self.invalidate()
+
+    def __len__(self):
+        return len(self._entries)
+
+    # Returns the current data version and the time of the last write. The
+    # version is None while the shared file is missing, nothing is cached then.
+    def version(self):
+        if self.shared_file is None:
+            base, last_modified = self._local_version, self._last_modified
+        else:
+            try:
+                stat = os.stat(self.shared_file)
+            except OSError:
+                return None, time.time()
+            base, last_modified = stat.st_mtime_ns, stat.st_mtime
+        if self.ttl > 0:
+            return f"{base}.{int(time.time() // self.ttl)}", last_modified
+        return str(base), last_modified
+
+    def invalidate(self):
+        with self._lock:
+            self._local_version += 1
+            self._last_modified = time.time()
+            self._entries.clear()
+            self.invalidations += 1
+        if self.shared_file is not None:
+            with open(self.shared_file, "a", encoding="utf-8"):
+                os.utime(self.shared_file)
+
+    def etag(self, key, version):
+        return f"{version}-{hashlib.sha1(key.encode()).hexdigest()[:16]}"
+
+    # True when the client already has the current response of key
+    def is_fresh(self, key, version, if_none_match):
+        if version is None or not if_none_match.contains(self.etag(key, version)):
+            return False
+        with self._lock:
+            self.not_modified += 1
+        return True
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, version, response):
+        if version is None:
+            return
+        with self._lock:
+            self._entries[key] = (version, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "not_modified": self.not_modified,
+            "invalidations": self.invalidations,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
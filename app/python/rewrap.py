@@ -0,0 +1,174 @@
+import argparse
+import json
+import logging
+import sys
+import threading
+import time
+
+from cache import TRANSIT_VERSION
+
+logger = logging.getLogger(__name__)
+
+REWRAP_CHUNK_SIZE = 500
+REWRAP_ROWS_PER_SECOND = 1000
+
+
+# Upgrades stored Transit ciphertexts to the latest key version. The customers
+# table is streamed in primary key chunks, outdated values are rewrapped with
+# batched Transit calls and written back in one transaction per chunk. The
+# last finished cust_no is checkpointed, so an interrupted run resumes there.
+class RewrapJob:
+    name = "transit_rewrap"
+
+    def __init__(
+        self,
+        dbc,
+        chunk_size=REWRAP_CHUNK_SIZE,
+        rows_per_second=REWRAP_ROWS_PER_SECOND,
+    ):
+        self.dbc = dbc
+        self.chunk_size = chunk_size
+        self.rows_per_second = rows_per_second
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_config(cls, dbc, conf):
+        return cls(
+            dbc,
+            chunk_size=conf.getint(
+                "VAULT", "RewrapChunkSize", fallback=REWRAP_CHUNK_SIZE
+            ),
+            rows_per_second=conf.getint(
+                "VAULT", "RewrapRowsPerSecond", fallback=REWRAP_ROWS_PER_SECOND
+            ),
+        )
+
+    def _outdated(self, value, latest):
+        match = TRANSIT_VERSION.match(value)
+        return match is not None and int(match.group(1)) < latest
+
+    def _rewrap_rows(self, rows, latest):
+        slots = [
+            (r, c)
+            for r, row in enumerate(rows)
+            for c, value in enumerate(row[1:])
+            if self._outdated(value, latest)
+        ]
+        rewrapped = self.dbc.rewrap_batch([rows[r][c + 1] for r, c in slots])
+        new_values = {}
+        failed = 0
+        for (r, c), ciphertext in zip(slots, rewrapped):
+            if ciphertext is None:
+                failed += 1
+                continue
+            new_values.setdefault(r, list(rows[r][1:]))[c] = ciphertext
+        updates = [
+            (rows[r][0], tuple(rows[r][1:]), tuple(values))
+            for r, values in new_values.items()
+        ]
+        # rows changed by a concurrent write since they were read are skipped
+        updated = self.dbc.update_protected_rows(updates)
+        return updated, len(updates) - updated, failed
+
+    def _throttle(self, rows, started):
+        if self.rows_per_second <= 0:
+            return
+        delay = rows / self.rows_per_second - (time.monotonic() - started)
+        if delay > 0:
+            self._stop.wait(delay)
+
+    def run(self, restart=False):
+        started = time.monotonic()
+        latest = self.dbc.latest_key_version()
+        after = 0 if restart else self.dbc.get_checkpoint(self.name)
+        logger.info(f"Rewrapping to key version {latest} after cust_no {after}")
+        rows_seen = rewrapped = skipped = failed = 0
+        while not self._stop.is_set():
+            chunk_started = time.monotonic()
+            rows = self.dbc.get_protected_rows(after, self.chunk_size)
+            if not rows:
+                # start over with the next key rotation
+                self.dbc.save_checkpoint(self.name, 0)
+                break
+            done, changed, errors = self._rewrap_rows(rows, latest)
+            rows_seen += len(rows)
+            rewrapped += done
+            skipped += changed
+            failed += errors
+            after = rows[-1][0]
+            self.dbc.save_checkpoint(self.name, after)
+            logger.info(f"Rewrapped {rewrapped} rows up to cust_no {after}")
+            self._throttle(len(rows), chunk_started)
+
+        completed = not self._stop.is_set()
+        retired = 0
+        if completed and not failed:
+            # no stored value needs the older key versions any longer
+            retired = self.dbc.retire_key_versions(latest)
+        return {
+            "key_version": latest,
+            "rows": rows_seen,
+            "rewrapped": rewrapped,
+            "skipped": skipped,
+            "failed": failed,
+            "completed": completed,
+            "retired_cache_entries": retired,
+            "seconds": round(time.monotonic() - started, 3),
+        }
+
+    # Background runs of several processes, such as the workers of
+    # server.py, are serialized by a named lock, the others skip the run.
+    def _run_logged(self):
+        try:
+            with self.dbc.named_lock(self.name) as acquired:
+                if not acquired:
+                    logger.info("Another process is rewrapping the customers")
+                    return
+                logger.info(f"Rewrap finished: {self.run()}")
+        except Exception as e:
+            logger.error(f"There was an error rewrapping the customers: {e}")
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run_logged, name=self.name, daemon=True
+        )
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def main():
+    # app is only needed to set up the client from config.ini
+    import app  # pylint: disable=import-outside-toplevel
+
+    parser = argparse.ArgumentParser(
+        description="Rewrap Transit ciphertexts to the latest key version"
+    )
+    parser.add_argument("--chunk-size", type=int)
+    parser.add_argument("--rows-per-second", type=int)
+    parser.add_argument(
+        "--restart", action="store_true", help="ignore the saved checkpoint"
+    )
+    args = parser.parse_args()
+
+    app_config = app.read_config()
+    logging.basicConfig(level=app.log_level[app_config["DEFAULT"]["LogLevel"]])
+    dbc = app.init_client(app_config)
+    job = RewrapJob.from_config(dbc, app_config)
+    if args.chunk_size:
+        job.chunk_size = args.chunk_size
+    if args.rows_per_second is not None:
+        job.rows_per_second = args.rows_per_second
+    summary = job.run(restart=args.restart)
+    print(json.dumps(summary, indent=2))
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
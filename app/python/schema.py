@@ -0,0 +1,64 @@
+import argparse
+import logging
+import sys
+
+from db_client import DbClient
+from migrations import MIGRATION_CHUNK_SIZE, MIGRATION_ROWS_PER_SECOND, SCHEMA_VERSION
+
+logger = logging.getLogger(__name__)
+
+
+# Creates the database and applies the pending schema migrations with the
+# [DATABASE] credentials and returns the applied versions.
+def migrate_schema(app_config, chunk_size=None, rows_per_second=None):
+    chunk_size = chunk_size or app_config.getint(
+        "DATABASE", "MigrationChunkSize", fallback=MIGRATION_CHUNK_SIZE
+    )
+    if rows_per_second is None:
+        rows_per_second = app_config.getint(
+            "DATABASE", "MigrationRowsPerSecond", fallback=MIGRATION_ROWS_PER_SECOND
+        )
+    dbc = DbClient()
+    dbc.connect_db(
+        uri=app_config["DATABASE"]["Address"],
+        prt=app_config["DATABASE"]["Port"],
+        uname=app_config["DATABASE"]["User"],
+        pw=app_config["DATABASE"]["Password"],
+    )
+    try:
+        applied = dbc.init_schema(
+            app_config["DATABASE"]["Database"],
+            chunk_size=chunk_size,
+            rows_per_second=rows_per_second,
+        )
+    finally:
+        dbc.conn.close()
+    logger.info(f"Schema is at version {SCHEMA_VERSION}, applied: {applied or 'none'}")
+    return applied
+
+
+# Creates the database and applies the pending schema migrations, see
+# migrations.py. Run it once per deployment and before rolling out a release
+# with a new schema version, and start the app instances with
+# [DATABASE] InitSchema = False, so that they only connect.
+def main():
+    # app is only needed to read config.ini
+    import app  # pylint: disable=import-outside-toplevel
+
+    parser = argparse.ArgumentParser(
+        description="Create the database and apply pending schema migrations"
+    )
+    parser.add_argument("--chunk-size", type=int, help="rows per backfill chunk")
+    parser.add_argument(
+        "--rows-per-second", type=int, help="backfill rate limit, 0 for none"
+    )
+    args = parser.parse_args()
+
+    app_config = app.read_config()
+    logging.basicConfig(level=app.log_level[app_config["DEFAULT"]["LogLevel"]])
+    migrate_schema(app_config, args.chunk_size, args.rows_per_second)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,101 @@
+import logging
+import os
+
+from gunicorn.app.base import BaseApplication
+
+import app
+import schema
+
+SERVER_THREADS = 4
+SERVER_MAX_REQUESTS = 10000
+SERVER_MAX_REQUESTS_JITTER = 1000
+SERVER_TIMEOUT = 30
+SERVER_GRACEFUL_TIMEOUT = 30
+
+# gunicorn names of the LogLevel values
+GUNICORN_LOG_LEVELS = {
+    "CRITICAL": "critical",
+    "ERROR": "error",
+    "WARN": "warning",
+    "INFO": "info",
+    "DEBUG": "debug",
+}
+
+logger = logging.getLogger(__name__)
+
+
+# With InitSchema the master applies the pending migrations once before it
+# forks any worker. A backfill may take longer than the worker timeout, and
+# workers would otherwise queue on the migration lock one after another.
+def on_starting(_server):
+    app_config = app.read_config()
+    if app_config.getboolean("DATABASE", "InitSchema", fallback=True):
+        app.init_logging(app_config)
+        schema.migrate_schema(app_config)
+
+
+# Every worker builds its own Vault and MySQL clients after the fork, so no
+# socket, pool or HTTP session is shared between processes. The master only
+# connects to MySQL to migrate and closes the connection before forking. A
+# reload re-reads config.ini in the new workers.
+def post_worker_init(worker):
+    app_config = app.read_config()
+    app.init_logging(app_config)
+    use_pool(app_config, worker.cfg.threads)
+    # the schema was migrated by on_starting
+    app_config["DATABASE"]["InitSchema"] = "False"
+    app.init_app(app_config)
+    logger.info(f"Worker {worker.pid} is initialized")
+
+
+# Without a pool all threads of a worker would take turns on one MySQL
+# connection. Such workers get a pool of one connection per thread.
+def use_pool(conf, threads):
+    if threads > 1 and conf.getint("DATABASE", "PoolSize", fallback=0) <= 0:
+        logger.info(f"Using a pool of {threads} connections for {threads} threads")
+        conf["DATABASE"]["PoolSize"] = str(threads)
+
+
+def server_options(conf):
+    return {
+        "bind": f"0.0.0.0:{conf['DEFAULT']['Port']}",
+        "workers": conf.getint("DEFAULT", "ServerWorkers", fallback=os.cpu_count()),
+        "threads": conf.getint("DEFAULT", "ServerThreads", fallback=SERVER_THREADS),
+        "preload_app": conf.getboolean("DEFAULT", "ServerPreload", fallback=False),
+        "max_requests": conf.getint(
+            "DEFAULT", "ServerMaxRequests", fallback=SERVER_MAX_REQUESTS
+        ),
+        "max_requests_jitter": conf.getint(
+            "DEFAULT", "ServerMaxRequestsJitter", fallback=SERVER_MAX_REQUESTS_JITTER
+        ),
+        "timeout": conf.getint("DEFAULT", "ServerTimeout", fallback=SERVER_TIMEOUT),
+        "graceful_timeout": conf.getint(
+            "DEFAULT", "ServerGracefulTimeout", fallback=SERVER_GRACEFUL_TIMEOUT
+        ),
+        "loglevel": GUNICORN_LOG_LEVELS[conf["DEFAULT"]["LogLevel"]],
+        "on_starting": on_starting,
+        "post_worker_init": post_worker_init,
+    }
+
+
+# Production entry point of app.py on gunicorn. SIGHUP replaces the workers
+# gracefully, workers are recycled after ServerMaxRequests requests.
+class Server(BaseApplication):
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    # configured by load_config, there are no command line options
+    def init(self, parser, opts, args):
+        return None
+
+    def load(self):
+        return app.app
+
+
+if __name__ == "__main__":
+    Server(server_options(app.read_config())).run()
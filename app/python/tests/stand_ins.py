@@ -0,0 +1,49 @@
+import types
+import unittest
+
+import app
+from benchmark.fake_mysql import FakeMySQL
+from benchmark.fake_vault import FakeVault
+from benchmark.run import build_config
+from db_client import DbClient
+
+
+# Runs the clients against the MySQL and Vault stand-ins of the benchmark.
+# client() builds a client from config.ini settings like the app does.
+class StandInTestCase(unittest.TestCase):
+    def setUp(self):
+        self.vault = FakeVault(latency=0).start()
+        self.mysql = FakeMySQL()
+        self.factory = DbClient.connection_factory
+        DbClient.connection_factory = staticmethod(self.mysql.connect)
+        self.clients = []
+
+    def tearDown(self):
+        for dbc in self.clients:
+            if dbc.group_commit is not None:
+                dbc.group_commit.stop()
+        DbClient.connection_factory = self.factory
+        self.vault.stop()
+        self.mysql.close()
+
+    def config(self, cache_size=0, group_commit=False, **options):
+        args = types.SimpleNamespace(
+            concurrency=1,
+            batch_size=100,
+            workers=0,
+            cache_size=cache_size,
+            db_pool_size=0,
+            transform=False,
+            envelope=False,
+            group_commit=group_commit,
+        )
+        conf = build_config(args, self.vault)
+        for option, value in options.items():
+            section, key = option.split("_", 1)
+            conf[section][key] = str(value)
+        return conf
+
+    def client(self, **options):
+        dbc = app.init_client(self.config(**options))
+        self.clients.append(dbc)
+        return dbc
@@ -0,0 +1,31 @@
+import unittest
+
+from benchmark.run import customer
+from stand_ins import StandInTestCase
+
+
+# Lookups go through the HMAC columns, with separators removed from both the
+# stored and the searched value.
+class BlindIndexTest(StandInTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dbc = self.client(VAULT_BlindIndex=True)
+        for i in range(3):
+            record = customer(i)
+            if i == 1:
+                record["ssn"] = "123-45-6789"
+            self.dbc.insert_customer_record(record)
+
+    def test_separators_are_ignored(self):
+        dashed = self.dbc.find_customers("ssn", "123-45-6789")
+        plain = self.dbc.find_customers("ssn", "123456789")
+        self.assertEqual(len(dashed), 1)
+        self.assertEqual(dashed, plain)
+        self.assertEqual(dashed[0]["ssn"], "123-45-6789")
+
+    def test_other_values_do_not_match(self):
+        self.assertEqual(self.dbc.find_customers("ssn", "123-45-6780"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+import base64
+import unittest
+
+from cryptography.exceptions import InvalidTag
+
+from envelope import ENVELOPE_PREFIX
+from stand_ins import StandInTestCase
+
+
+# Data keys are generated and unwrapped by the Transit stand-in and stored
+# wrapped in data_keys.
+class EnvelopeTest(StandInTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dbc = self.client(VAULT_Envelope=True)
+
+    def test_round_trip(self):
+        value = self.dbc.encrypt("123-45-6789")
+        self.assertTrue(value.startswith(ENVELOPE_PREFIX))
+        self.assertNotIn("123-45-6789", value)
+        self.assertEqual(self.dbc.decrypt(value), "123-45-6789")
+
+    def test_decrypts_with_rotated_key(self):
+        old = self.dbc.encrypt("old value")
+        self.dbc.envelope.rotate()
+        new = self.dbc.encrypt("new value")
+        self.assertNotEqual(old.split(":")[2], new.split(":")[2])
+        # another instance only has the wrapped keys stored in data_keys
+        other = self.client(VAULT_Envelope=True)
+        self.assertEqual(other.decrypt(old), "old value")
+        self.assertEqual(other.decrypt(new), "new value")
+
+    def test_tampered_value_fails(self):
+        value = self.dbc.encrypt("123-45-6789")
+        prefix, payload = value.rsplit(":", 1)
+        data = bytearray(base64.b64decode(payload))
+        data[-1] ^= 1
+        tampered = f"{prefix}:{base64.b64encode(bytes(data)).decode('ascii')}"
+        with self.assertRaises(InvalidTag):
+            self.dbc.decrypt(tampered)
+
+
+if __name__ == "__main__":
+    unittest.main()
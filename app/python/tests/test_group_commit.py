@@ -0,0 +1,68 @@
+import threading
+import unittest
+from unittest import mock
+
+from benchmark.run import customer
+from stand_ins import StandInTestCase
+
+
+class GroupCommitTest(StandInTestCase):
+    def setUp(self):
+        super().setUp()
+        # long enough for all callers to share a batch
+        self.dbc = self.client(group_commit=True, DATABASE_GroupCommitDelay=0.2)
+
+    # Inserts the records from one thread each at the same time and returns
+    # the result or the exception of every caller.
+    def insert_concurrently(self, records):
+        results = [None] * len(records)
+        barrier = threading.Barrier(len(records))
+
+        def insert(i):
+            barrier.wait()
+            try:
+                results[i] = self.dbc.insert_customer_record(records[i])
+            except Exception as e:
+                results[i] = e
+
+        threads = [
+            threading.Thread(target=insert, args=(i,)) for i in range(len(records))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def stored_first_name(self, cust_no):
+        return self.dbc.get_customer_record(cust_no, fields=("first_name",))[0][
+            "first_name"
+        ]
+
+    def test_ids_map_to_callers(self):
+        records = [customer(i) for i in range(10)]
+        results = self.insert_concurrently(records)
+        cust_nos = [result[0]["customer_number"] for result in results]
+        self.assertEqual(len(set(cust_nos)), len(records))
+        for record, cust_no in zip(records, cust_nos):
+            self.assertEqual(self.stored_first_name(cust_no), record["first_name"])
+
+    def test_failed_row_fails_only_its_caller(self):
+        records = [customer(i) for i in range(5)]
+        # the ciphertext exceeds varchar(255)
+        records[2]["address"] = "x" * 300
+        results = self.insert_concurrently(records)
+        self.assertIsInstance(results[2], Exception)
+        for i in (0, 1, 3, 4):
+            cust_no = results[i][0]["customer_number"]
+            self.assertEqual(self.stored_first_name(cust_no), records[i]["first_name"])
+
+    def test_ids_follow_auto_increment_increment(self):
+        self.dbc.auto_increment_increment = 2
+        with mock.patch.object(self.dbc, "_insert_many", return_value=11):
+            results = self.dbc.insert_customer_batch([customer(i) for i in range(3)])
+        self.assertEqual([r[0]["customer_number"] for r in results], [11, 13, 15])
+
+
+if __name__ == "__main__":
+    unittest.main()
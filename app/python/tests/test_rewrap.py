@@ -0,0 +1,39 @@
+import unittest
+
+import app
+from benchmark.run import customer
+from rewrap import RewrapJob
+from stand_ins import StandInTestCase
+
+
+# With a plaintext cache, rotating the fake Transit key leaves cached
+# plaintexts of the old key version behind.
+class RewrapRetireTest(StandInTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dbc = self.client(cache_size=1000)
+        for i in range(5):
+            self.dbc.insert_customer_record(customer(i))
+        self.dbc.get_customer_records()
+        self.vault.key_version = 2
+
+    def test_completed_run_retires_old_key_versions(self):
+        # all cached plaintexts are of ciphertexts of key version 1
+        self.assertGreater(len(self.dbc.cache), 0)
+        summary = RewrapJob(self.dbc, rows_per_second=0).run(restart=True)
+        self.assertTrue(summary["completed"])
+        self.assertEqual(summary["failed"], 0)
+        self.assertGreater(summary["retired_cache_entries"], 0)
+        self.assertEqual(len(self.dbc.cache), 0)
+
+    def test_retire_endpoint(self):
+        app.dbc = self.dbc
+        client = app.app.test_client()
+        self.assertEqual(client.post("/cache/retire").status_code, 400)
+        response = client.post("/cache/retire?min_decryption_version=2")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.dbc.cache), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
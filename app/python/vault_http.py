@@ -0,0 +1,59 @@
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+VAULT_TIMEOUT = 5
+VAULT_POOL_SIZE = 10
+
+
+# Per endpoint request count and latency of the Vault HTTP API, recorded from
+# the response hook of the shared session.
+class LatencyStats:
+    def __init__(self):
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint, seconds):
+        with self._lock:
+            count, total, slowest = self._endpoints.get(endpoint, (0, 0.0, 0.0))
+            self._endpoints[endpoint] = (
+                count + 1,
+                total + seconds,
+                max(slowest, seconds),
+            )
+
+    def stats(self):
+        with self._lock:
+            return {
+                endpoint: {
+                    "count": count,
+                    "avg_ms": round(total / count * 1000, 3),
+                    "max_ms": round(slowest * 1000, 3),
+                }
+                for endpoint, (count, total, slowest) in self._endpoints.items()
+            }
+
+
+def _endpoint(request):
+    path = urlsplit(request.url).path
+    return f"{request.method} {path.removeprefix('/v1/')}"
+
+
+# Builds the keep-alive session which hvac and the raw Transform calls share,
+# so connections, TLS sessions and DNS lookups are reused between calls.
+def create_session(pool_size=VAULT_POOL_SIZE, verify=False, stats=None):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.verify = verify
+    if stats is not None:
+
+        # requests passes the send() arguments as keywords, they are not needed
+        def record(response, **_kwargs):
+            stats.observe(_endpoint(response.request), response.elapsed.total_seconds())
+
+        session.hooks["response"].append(record)
+    return session